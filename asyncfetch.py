@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Asynchronous downloads of the TLE and bulletin sources on a shared httpx.AsyncClient,
+so that fetching can run on an existing event loop (e.g. the bot's) without blocking it.
+"""
+
+import asyncio
+import datetime as dt
+import importlib.util
+
+import httpx
+
+#%% Shared client
+# Connections are reused across sources and updates; HTTP/2 is used if the h2 package is installed
+client_limits = httpx.Limits(max_connections=10, max_keepalive_connections=5)
+client_timeout = httpx.Timeout(60.0, connect=10.0)
+
+_client = None
+
+def getAsyncClient():
+    """
+    Returns the shared AsyncClient, creating it on first use.
+    It should only be used from a single event loop.
+    """
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            http2=importlib.util.find_spec("h2") is not None,
+            limits=client_limits,
+            timeout=client_timeout,
+            follow_redirects=True
+        )
+    return _client
+
+async def closeAsyncClient():
+    """
+    Closes the shared AsyncClient, if it was created.
+    """
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+#%% Fetching
+async def fetchOne(key: str, link: str, client: httpx.AsyncClient=None):
+    """
+    Downloads one source. Returns (key, text, time_retrieved), with text as None on failure.
+    """
+    client = getAsyncClient() if client is None else client
+    try:
+        r = await client.get(link)
+        r.raise_for_status()
+        print("Retrieved %s from %s" % (key, link))
+        return key, r.text, int(dt.datetime.utcnow().timestamp())
+    except httpx.HTTPError as e:
+        print("Could not download from %s (%s)" % (link, str(e)))
+        return key, None, None
+
+async def fetchAll(links: dict, client: httpx.AsyncClient=None):
+    """
+    Downloads every source concurrently.
+
+    Parameters
+    ----------
+    links : dict
+        Links (value) for each source (key).
+    client : httpx.AsyncClient, optional
+        Client to use. Default is the shared client.
+
+    Returns
+    -------
+    data : dict
+        Raw data (value) for each source (key) that was downloaded.
+    time_retrieved : dict
+        Time retrieved (value) for each source (key) that was downloaded.
+    """
+    results = await asyncio.gather(*[fetchOne(key, link, client) for key, link in links.items()])
+
+    data = dict()
+    time_retrieved = dict()
+    for key, text, tr in results:
+        if text is not None:
+            data[key] = text
+            time_retrieved[key] = tr
+
+    return data, time_retrieved
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Parallel backfill of historical TLE archive files into a TleDatabase.
+
+Archive files (plain text, or compressed with gzip/xz/bz2) are parsed in worker processes,
+while the main process is the single writer that bulk inserts each file's TLEs.
+Every file is recorded in the backfill checkpoint table in the same transaction as its rows,
+so an interrupted run can simply be restarted and will skip the files that were completed.
+"""
+
+import os
+import glob
+import gzip
+import lzma
+import bz2
+import datetime as dt
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from tledatabase import TleDatabase
+from tlereader import TleFileReader
+
+#%% Worker-side functions (must be top-level to be picklable)
+openers = {
+    ".gz": gzip.open,
+    ".xz": lzma.open,
+    ".bz2": bz2.open
+}
+
+def readArchiveFile(filepath: str):
+    """
+    Reads the text of an archive file, decompressing based on the file extension.
+    """
+    opener = openers.get(os.path.splitext(filepath)[1].lower(), open)
+    with opener(filepath, "rt") as fid:
+        return fid.read()
+
+def parseArchiveFile(filepath: str):
+    """
+    Parses an archive file into a dictionary of satellite names to lists of (line1, line2).
+    Runs in the worker processes.
+    """
+    tles = dict()
+    if os.path.splitext(filepath)[1].lower() in openers:
+        records = TleDatabase.parseTleRecords(readArchiveFile(filepath))
+        for name, line1, line2 in records:
+            tles.setdefault(name, []).append((line1, line2))
+
+    else:
+        # Uncompressed files can be memory-mapped instead of read into a string
+        with TleFileReader(filepath) as reader:
+            tles = reader.groupRecords()
+
+    return filepath, tles
+
+#%%
+class Backfill:
+    """
+    Backfills a directory of archive files into a TleDatabase, using all cores for parsing.
+
+    Example
+    -------
+    d = TleDatabase("tles.db")
+    b = Backfill(d, "active")
+    b.run("archives/", "*.txt.gz")
+    """
+    def __init__(self, db: TleDatabase, src: str, workers: int=None, timeFunc=None):
+        """
+        Parameters
+        ----------
+        db : TleDatabase
+            Database to insert into. Only this process writes to it.
+        src : str
+            Source to file the TLEs under e.g. 'active'.
+        workers : int, optional
+            Number of parsing processes. Default is the number of cores.
+        timeFunc : callable, optional
+            Called with the file path to get the time_retrieved for that file's rows.
+            Default uses the file modification time.
+        """
+        self.db = db
+        self.src = src
+        self.workers = workers if workers is not None else os.cpu_count()
+        self.timeFunc = timeFunc if timeFunc is not None else (lambda filepath: int(os.path.getmtime(filepath)))
+
+        # Create the checkpoint table if it doesn't exist
+        self.db.createTable(
+            self.db.backfill_checkpoint_fmt,
+            self.db.backfill_checkpoint_tblname,
+            ifNotExists=True,
+            commitNow=True
+        )
+
+    def completedFiles(self):
+        """
+        Returns the set of file paths already backfilled for this source.
+        """
+        self.db.execute(
+            "select filepath from %s where src=?" % (self.db.backfill_checkpoint_tblname),
+            (self.src,)
+        )
+        return set(i[0] for i in self.db.fetchall())
+
+    def run(self, dirpath: str, pattern: str="*", verbose: bool=True):
+        """
+        Backfills every file in the directory matching the pattern, skipping completed files.
+
+        Returns
+        -------
+        numInserted : int
+            Total number of new rows inserted.
+        """
+        filepaths = sorted(glob.glob(os.path.join(dirpath, pattern)))
+        completed = self.completedFiles()
+        pending = [os.path.abspath(f) for f in filepaths if os.path.abspath(f) not in completed]
+        if verbose:
+            print("Backfilling %d files (%d already completed)" % (len(pending), len(filepaths) - len(pending)))
+
+        numInserted = 0
+        numDone = 0
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            # Keep a bounded number of files in flight, so parsed results don't pile up in memory
+            remaining = iter(pending)
+            inflight = set()
+            for filepath in remaining:
+                inflight.add(executor.submit(parseArchiveFile, filepath))
+                if len(inflight) >= 2 * self.workers:
+                    break
+
+            while len(inflight) > 0:
+                done, inflight = wait(inflight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    filepath, tles = future.result()
+                    inserted = self._writeFile(filepath, tles)
+                    numInserted += inserted
+                    numDone += 1
+                    if verbose:
+                        print("[%d/%d] %s: %d satellites, %d new rows" % (
+                            numDone, len(pending), filepath, len(tles), inserted))
+
+                    # Top up with the next file
+                    nextpath = next(remaining, None)
+                    if nextpath is not None:
+                        inflight.add(executor.submit(parseArchiveFile, nextpath))
+
+        return numInserted
+
+    def _writeFile(self, filepath: str, tles: dict):
+        # Bulk insert everything, making tables only as needed
+        time_retrieved = self.timeFunc(filepath)
+        inserted = self.db.insertTleGroups(self.src, time_retrieved, tles)
+
+        # Record the checkpoint in the same transaction, then commit everything together
+        self.db.execute(
+            "insert or replace into %s values(?,?,?,?,?)" % (self.db.backfill_checkpoint_tblname),
+            (filepath, self.src, time_retrieved, sum(len(i) for i in tles.values()),
+             int(dt.datetime.utcnow().timestamp()))
+        )
+        self.db.commit()
+
+        return inserted
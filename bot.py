@@ -3,9 +3,9 @@
 
 """
 status - Checks if bot is alive.
-begin - Starts the recurring update job. Run once, after every restart.
+begin - Starts the recurring update jobs, one per source. Optional: (initial interval). Run once, after every restart.
 update - Forces an update of the database right now.
-download - Downloads either or both the databases. Optional: (starttime) (stoptime).
+download - Downloads either or both the databases. Optional: (starttime) (stoptime), or 'new' for TLEs since your last download.
 add - Adds a TLE table to the download selection.
 selection - Views your current TLE download selection.
 clear - Clears your download selection.
@@ -14,9 +14,14 @@ clear - Clears your download selection.
 
 from bulletindatabase import BulletinDatabase
 from tledatabase import TleDatabase
+from satsearch import SatelliteSearchIndex
+from updatescheduler import AdaptiveSchedule
+from asyncfetch import fetchOne
+from exportcache import ExportCache
 
 import common_bot_interfaces as cbi
 
+import asyncio
 import datetime as dt
 import sys
 import os
@@ -30,9 +35,15 @@ class TleBulletinInterface:
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-        # Placeholder
-        self.updateJob = None
-        self.updateFrequency = 7200.0 # How often to update in seconds
+        # Each source is polled by its own job, at an interval adapted to how often it changes
+        self.updateJobs = dict()
+        self.updateFrequency = 7200.0 # Initial interval in seconds for sources with no history
+        self.schedule = AdaptiveSchedule(
+            "UpdateSchedule.json",
+            minInterval=600.0,
+            maxInterval=86400.0,
+            initialInterval=self.updateFrequency
+        )
 
         # We fix the filepaths, not much point making it configurable
         self.tledbpath = "tles.db"
@@ -40,6 +51,13 @@ class TleBulletinInterface:
         self.tledb = TleDatabase(self.tledbpath)
         self.bulletindb = BulletinDatabase(self.bulletindbpath)
 
+        # Exports are cached until the database changes, and each user's last download is remembered
+        self.exportCache = ExportCache(self.tledb, "exports")
+
+        # Search index for /add, refreshed incrementally after every update
+        self.satIndex = SatelliteSearchIndex()
+        self._refreshSatIndex()
+
         # Container to hold user download tables
         self.downloadTablesPicklePath = "UserDownloadTables.pkl"
         if os.path.exists(self.downloadTablesPicklePath):
@@ -49,6 +67,15 @@ class TleBulletinInterface:
             self.downloadTables = dict()
         print(self.downloadTables)
 
+        # Position in the TLE change feed up to which users have been notified.
+        # On first run, start from now rather than notifying about the whole history
+        self.changeCursorPath = "ChangeCursor.txt"
+        if os.path.exists(self.changeCursorPath):
+            with open(self.changeCursorPath, "r") as f:
+                self.changeCursor = int(f.read())
+        else:
+            self._saveChangeCursor(self.tledb.getLatestChangeSeq())
+
     def _addInterfaceHandlers(self):
         super()._addInterfaceHandlers()
 
@@ -103,32 +130,79 @@ class TleBulletinInterface:
 
     ##########################
     async def begin(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        # Check if the job has already begun?
-        if self.updateJob is not None:
+        # Check if the jobs have already begun?
+        if len(self.updateJobs) > 0:
             await context.bot.send_message(
                 chat_id=update.effective_chat.id,
-                text="The update job has already begun. I will update every %d seconds." % (
-                    self.updateFrequency)
+                text="The update jobs have already begun. Current intervals:\n%s" % (self._describeSchedule())
             )
 
-        # Otherwise begin the job with the specified frequency
+        # Otherwise begin one job per source, staggered by the schedule
         else:
             if len(context.args) > 0:
                 self.updateFrequency = int(context.args[0])
-            
-            # Start the job and recur forever
-            self.updateJob = context.job_queue.run_repeating(
-                self._update, self.updateFrequency, first=1.0,
-                data=update.effective_chat.id
-            )
-            # For some reason when first=0.0 seconds it bugs out, so leave it at 1.0
+                self.schedule.initialInterval = self.updateFrequency
+
+            for key in self._scheduleKeys():
+                self._scheduleSource(context, key)
 
             await context.bot.send_message(
                 chat_id=update.effective_chat.id,
-                text="Okay, I just began the update job. I will update every %d seconds." % (
-                    self.updateFrequency)
+                text="Okay, I just began the update jobs. Current intervals:\n%s" % (self._describeSchedule())
             )
 
+    def _scheduleKeys(self):
+        # Sources are namespaced by database, as keys may overlap
+        return ["tle:%s" % key for key in self.tledb.usedSrcs] + [
+            "bulletin:%s" % key for key in self.bulletindb.usedSrcs]
+
+    def _rescheduleSources(self, context: ContextTypes.DEFAULT_TYPE):
+        # Stop polling removed sources and start polling added ones
+        keys = self._scheduleKeys()
+        for key in list(self.updateJobs):
+            if key not in keys:
+                self.updateJobs.pop(key).schedule_removal()
+        for key in keys:
+            if key not in self.updateJobs:
+                self._scheduleSource(context, key)
+
+    def _describeSchedule(self):
+        return "\n".join(
+            "%s: every %d seconds" % (key, self.schedule.interval(key)) for key in self._scheduleKeys())
+
+    def _scheduleSource(self, context: ContextTypes.DEFAULT_TYPE, key: str):
+        # One-off job that reschedules itself, so the delay can change each time
+        self.updateJobs[key] = context.job_queue.run_once(
+            self._updateSource, self.schedule.nextDelay(key),
+            data=key, name=key
+        )
+
+    async def _updateSource(self, context: ContextTypes.DEFAULT_TYPE):
+        """
+        Recurring job to update a single source, only inserting when its content changed.
+        """
+        key = context.job.data
+        dbtype, src = key.split(":", 1)
+        db = self.tledb if dbtype == "tle" else self.bulletindb
+        if src not in db.usedSrcs:
+            # Removed with /sources since this run was scheduled
+            self.updateJobs.pop(key, None)
+            return
+
+        try:
+            _, text, time_retrieved = await fetchOne(src, db.usedSrcs[src])
+            if text is not None:
+                if self.schedule.observe(key, text):
+                    db.ingest({src: text}, {src: time_retrieved})
+                    if dbtype == "tle":
+                        self._refreshSatIndex()
+                        await self._notifyChanges(context)
+                else:
+                    print("%s is unchanged; next check in about %d seconds" % (key, self.schedule.interval(key)))
+        finally:
+            # Always keep polling, even if this attempt failed
+            self._scheduleSource(context, key)
+
     ##########################
     async def update(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         await context.bot.send_message(
@@ -136,30 +210,16 @@ class TleBulletinInterface:
             text="Please wait while I update the databases."
         )
 
-        # Force an update right now
-        self.tledb.update()
-        self.bulletindb.update()
+        # Force an update right now, fetching everything concurrently
+        await asyncio.gather(self.tledb.aupdate(), self.bulletindb.aupdate())
+        self._refreshSatIndex()
+        await self._notifyChanges(context)
 
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
             text="Okay, I just updated the databases. This will not affect my recurring updates."
         )
 
-    async def _update(self, context: ContextTypes.DEFAULT_TYPE):
-        """
-        Recurring job to update both databases.
-        """
-        print("Starting database updates...")
-
-        # Update databases
-        self.tledb.update()
-        self.bulletindb.update()
-
-        await context.bot.send_message(
-            chat_id = context.job.data,
-            text = "Okay, I just updated the databases. This was a part of my recurring updates."
-        )
-
     ##########################
     async def download(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """
@@ -171,6 +231,7 @@ class TleBulletinInterface:
                 chat_id=update.effective_chat.id,
                 text="Invalid number of arguments. Calling args are:\n" + 
                 "/download (optional: start time) (optional: stop time)\n" + 
+                "/download new (only TLEs since your last download)\n" + 
                 "Example: /download 1672800000 1672900000"
             )
 
@@ -182,6 +243,10 @@ class TleBulletinInterface:
                 chat_id=update.effective_chat.id,
                 text="Timed out while uploading your TLE database. Try specifying a smaller time window."
             )
+        # Deltas are only for TLEs
+        if len(context.args) == 1 and context.args[0] == "new":
+            return
+
         # Send bulletin db
         try:
             await self._downloadUserBulletins(update, context)
@@ -206,69 +271,37 @@ class TleBulletinInterface:
                 text="Please wait while I prepare your selection."
             )
 
-            # Create a db for this user on disk
-            userdbpath = "tles_%d.db" % (update.effective_user.id)
-            userdb = TleDatabase(userdbpath)
-
-            # Create the user's tables in the db
-            for tablename in usertables:
-                userdb.makeSatelliteTable(None, tablename)
-            userdb.close() # We don't need it to be open any more
-
-            # Attach the user db for inserts
-            if len(context.args) <= 2:
-                self.tledb.execute(
-                    "ATTACH DATABASE '%s' AS userdb" % (userdbpath)
-                )
-
-            try:
-                # Insert the user's tables' rows into the new db in full
-                if len(context.args) == 0:
-                    for tablename in usertables:
-                        self.tledb.execute(
-                            "INSERT INTO userdb.'%s' SELECT * FROM '%s'" % (tablename, tablename)
-                        )
-                    self.tledb.commit()
-
-                # Or insert rows starting from a certain time
-                elif len(context.args) == 1:
-                    for tablename in usertables:
-                        self.tledb.execute(
-                            "INSERT INTO userdb.'%s' SELECT * FROM '%s' WHERE time_retrieved > ?" % (tablename, tablename),
-                            (float(context.args[0]),)
-                        )
-                    self.tledb.commit()
-
-                # Or insert rows starting from a certain time and stopping at a certain time
-                elif len(context.args) == 2:
-                    for tablename in usertables:
-                        self.tledb.execute(
-                            "INSERT INTO userdb.'%s' SELECT * FROM '%s' WHERE time_retrieved > ? AND time_retrieved < ?" % (tablename, tablename),
-                            (float(context.args[0]), float(context.args[1]))
-                        )
-                    self.tledb.commit()
-
-                # We don't need a separate message here for showing the calling structure
-
-            except sq.IntegrityError as e: # We must catch this so that the detach database proceeds
-                await context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text="There was an error while creating your TLE database:\n" + str(e)
-                )
+            userid = update.effective_user.id
+            usertables = sorted(usertables)
 
+            # Only the rows since the user's last download
+            if len(context.args) == 1 and context.args[0] == "new":
+                userdbpath, upto = self.exportCache.exportDelta(userid, usertables)
+                if userdbpath is None:
+                    await context.bot.send_message(
+                        chat_id=update.effective_chat.id,
+                        text="There are no new TLEs since your last download."
+                    )
+                    return
 
-            # Cleanup and Delete the user db from disk
-            if len(context.args) <= 2:
-                self.tledb.execute(
-                    "DETACH DATABASE userdb"
-                )
-                # Send the newly created user db
+            # Or the full tables, or the rows in a time window; these are reused until the tables change
+            else:
+                start = float(context.args[0]) if len(context.args) >= 1 else None
+                stop = float(context.args[1]) if len(context.args) >= 2 else None
+                userdbpath = self.exportCache.export(usertables, start, stop)
+                # A full download also brings the user up to date
+                upto = self.tledb.getMaxTimeRetrieved(usertables) if len(context.args) == 0 else None
+
+            # Send the user db; the file belongs to the cache, so it is not deleted
+            with open(userdbpath, "rb") as fid:
                 await context.bot.send_document(
                     chat_id=update.effective_chat.id,
-                    document=open(userdbpath, "rb"),
+                    document=fid,
+                    filename="tles_%d.db" % (userid),
                     write_timeout=60 # Have a longer timeout
                 )
-            os.remove(userdbpath)
+            # Only move the watermark once the file was delivered
+            self.exportCache.commitDelta(userid, usertables, upto)
 
     async def _downloadUserBulletins(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         # For bulletins, we just download according to the time selection, if specified
@@ -289,7 +322,7 @@ class TleBulletinInterface:
             userbulletinsdb = BulletinDatabase(userbulletindbpath)
 
             # Recreate the same tables in the current database
-            for src in self.bulletindb.tablenames:
+            for src in self.bulletindb.bulletinTablenames:
                 userbulletinsdb.makeBulletinTable(src)
             userbulletinsdb.close() # We don't need it to be open any more
             # Then attach the user db to the current one
@@ -297,7 +330,7 @@ class TleBulletinInterface:
                 "ATTACH DATABASE '%s' AS userbulletinsdb" % (userbulletindbpath)
             )
 
-            for src in self.bulletindb.tablenames:
+            for src in self.bulletindb.bulletinTablenames:
                 if start is not None:
                     if end is not None:
                         # Slice between the two timings and insert
@@ -316,6 +349,11 @@ class TleBulletinInterface:
             self.bulletindb.execute(
                 "DETACH DATABASE userbulletinsdb"
             )
+            # Fill in the latest values from the copied history
+            userbulletinsdb = BulletinDatabase(userbulletindbpath)
+            for src in userbulletinsdb.bulletinTablenames:
+                userbulletinsdb.rebuildLatestTable(src)
+            userbulletinsdb.close()
             await context.bot.send_document(
                 chat_id=update.effective_chat.id,
                 document=open(userbulletindbpath, "rb"),
@@ -359,37 +397,84 @@ class TleBulletinInterface:
         else:
             await self._addUserTable(update, context)
 
+    def _refreshSatIndex(self):
+        """
+        Adds new satellite tables to the search index (and drops removed ones).
+        """
+        added = self.satIndex.update(self.tledb.satelliteTablenames)
+        for tablename in added:
+            self.satIndex.add(tablename, self.tledb.getSatelliteNumber(tablename))
+        print("Indexed %d new satellite tables" % (len(added)))
+
+    def _saveChangeCursor(self, seq: int):
+        self.changeCursor = seq
+        with open(self.changeCursorPath, "w") as f:
+            f.write(str(seq))
+
+    async def _notifyChanges(self, context: ContextTypes.DEFAULT_TYPE, maxListed: int=20):
+        """
+        Tells each user which satellites in their download selection got new TLEs since the last notification.
+        """
+        changes = self.tledb.getChanges(self.changeCursor)
+        if len(changes) == 0:
+            return
+
+        # Latest new epoch of each satellite
+        newEpochs = dict()
+        for seq, src, name, epoch, time_retrieved in changes:
+            tablename = "%s_%s" % (src, name)
+            newEpochs[tablename] = max(epoch, newEpochs.get(tablename, epoch))
+        print("%d new TLEs for %d satellites" % (len(changes), len(newEpochs)))
+
+        for userid, usertables in self.downloadTables.items():
+            updated = sorted(usertables.intersection(newEpochs))
+            if len(updated) == 0:
+                continue
+
+            lines = [
+                "%s (epoch %s)" % (tablename, dt.datetime.utcfromtimestamp(newEpochs[tablename]).strftime("%Y-%m-%d %H:%M:%S"))
+                for tablename in updated[:maxListed]
+            ]
+            if len(updated) > maxListed:
+                lines.append("...and %d more" % (len(updated) - maxListed))
+            try:
+                await context.bot.send_message(
+                    chat_id=userid,
+                    text="New TLEs for your selection:\n%s\nUse /download new to get them." % ("\n".join(lines))
+                )
+            except telegram.error.TelegramError as e:
+                # e.g. the user has blocked the bot; the others should still be notified
+                print("Could not notify %d: %s" % (userid, e))
+
+        self._saveChangeCursor(changes[-1][0])
+
     async def _addUserTable(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        # Check if the tablename exists
+        # Check if the tablename (or a satellite number) exists
         userid = update.effective_user.id
-        sats = self.tledb.tablenames
         tablename = " ".join(context.args)
         print("%d asked for: %s" % (userid, tablename))
 
         found = False
-        for sat in sats:
-            if tablename in sat:
-                # Add the table to the set for this user
-                if userid not in self.downloadTables:
-                    self.downloadTables[userid] = set()
-                self.downloadTables[userid].add(sat)
-
-                # Dump to file for caching user selections
-                with open(self.downloadTablesPicklePath, "wb") as f:
-                    pickle.dump(self.downloadTables, f)
-
-                # Update the user
-                await context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text="Okay, I have added %s to your download list." % sat
-                )
-                found = True
+        for sat in self.satIndex.contains(tablename):
+            # Add the table to the set for this user
+            if userid not in self.downloadTables:
+                self.downloadTables[userid] = set()
+            self.downloadTables[userid].add(sat)
+
+            # Dump to file for caching user selections
+            with open(self.downloadTablesPicklePath, "wb") as f:
+                pickle.dump(self.downloadTables, f)
+
+            # Update the user
+            await context.bot.send_message(
+                chat_id=update.effective_chat.id,
+                text="Okay, I have added %s to your download list." % sat
+            )
+            found = True
 
         if not found:
-            # Just do a coarse contains for now; we do fuzzy matching later
-            closeMatches = [sat for sat in sats if tablename.lower() in sat.lower()]
-            print(closeMatches)
-            print(sats)
+            # Suggest the closest few by fuzzy matching
+            closeMatches = [sat for sat, score in self.satIndex.search(tablename, k=10)]
 
             # Update the user
             if len(closeMatches) > 0:
@@ -435,6 +520,8 @@ class TleBulletinInterface:
         else:
             # Replace with specified sources
             self.tledb.setSrcs(context.args)
+            if len(self.updateJobs) > 0:
+                self._rescheduleSources(context)
 
         # No matter what, show what is used now
         await context.bot.send_message(
@@ -5,7 +5,6 @@ Created on Mon Dec  5 17:30:22 2022
 @author: lken
 """
 
-import requests
 import datetime as dt
 from hashlib import blake2s
 import sqlite3 as sq
@@ -54,8 +53,8 @@ class BulletinDatabase(sew.Database):
             ["blake2b_32bit_checksum", "INTEGER"]
         ],
         'conds': [
-            "UNIQUE(mjd, blake2b_32bit_checksum)"
-        ] # Is there a short way to include all columns as UNIQUE?
+            "UNIQUE(mjd, time_retrieved)"
+        ] # One row per vintage of each MJD; unchanged rows are skipped on insert, see insertIntoTableIncremental()
     }
     
     bulletins2000_table_fmt = {
@@ -88,10 +87,43 @@ class BulletinDatabase(sew.Database):
             ["blake2b_32bit_checksum", "INTEGER"]
         ],
         'conds': [
-            "UNIQUE(mjd, blake2b_32bit_checksum)"
-        ] # Is there a short way to include all columns as UNIQUE?
+            "UNIQUE(mjd, time_retrieved)"
+        ] # One row per vintage of each MJD; unchanged rows are skipped on insert, see insertIntoTableIncremental()
     }
 
+    # Fixed-width column specification shared by the IAU1980 and IAU2000 finals layouts,
+    # as per https://maia.usno.navy.mil/ser7/readme.finals and readme.finals2000A.
+    # Each entry is (start, stop, kind, group), in the same order as the table format columns
+    # (excluding time_retrieved and the checksum), which is where the names come from.
+    # Fields in a group are optional and are either all present or all blank.
+    finals_colspec = [
+        (0, 2, "int", None), # year
+        (2, 4, "int", None), # month
+        (4, 6, "int", None), # day
+        (7, 15, "float", None), # mjd
+        (16, 17, "str", None), # ip_A_polar
+        (18, 27, "float", None), # A_pmx_arcsec
+        (27, 36, "float", None), # A_pmx_err_arcsec
+        (37, 46, "float", None), # A_pmy_arcsec
+        (46, 55, "float", None), # A_pmy_err_arcsec
+        (57, 58, "str", None), # ip_A_dut1
+        (58, 68, "float", None), # A_dut1_sec
+        (68, 78, "float", None), # A_dut1_err_sec
+        (79, 86, "float", "lod"), # A_lod_msec
+        (86, 93, "float", "lod"), # A_lod_err_msec
+        (95, 96, "str", "nutation"), # ip_A_nutation
+        (97, 106, "float", "nutation"), # A_dpsi_arcmsec / A_dX_arcmsec
+        (106, 115, "float", "nutation"), # A_dpsi_err_arcmsec / A_dX_err_arcmsec
+        (116, 125, "float", "nutation"), # A_deps_arcmsec / A_dY_arcmsec
+        (125, 134, "float", "nutation"), # A_deps_err_arcmsec / A_dY_err_arcmsec
+        (134, 144, "float", "B"), # B_pmx_arcsec
+        (144, 154, "float", "B"), # B_pmy_arcsec
+        (154, 165, "float", "B"), # B_dut1_sec
+        (165, 175, "float", "B"), # B_dpsi_arcmsec / B_dX_arcmsec
+        (175, 185, "float", "B") # B_deps_arcmsec / B_dY_arcmsec
+    ]
+    finals_linewidth = 185
+
     srcfmts = {
         "dailyiau2000": bulletins2000_table_fmt,
         "dailyiau1980": bulletins1980_table_fmt,
@@ -100,15 +132,50 @@ class BulletinDatabase(sew.Database):
         "dataiau2000": bulletins2000_table_fmt,
         "dataiau1980": bulletins1980_table_fmt
     }
+
+    # Revision layout: changed fields only, keyed by the column index in the source's table format.
+    # Values may be numbers, flags or NULL, so the value column has no type affinity.
+    bulletin_revisions_fmt = {
+        'cols': [
+            ["mjd", "REAL"],
+            ["time_retrieved", "INTEGER"],
+            ["col", "INTEGER"],
+            ["value", "BLOB"]
+        ],
+        'conds': [
+            "PRIMARY KEY(mjd, time_retrieved, col)"
+        ]
+    }
     
     #%% Constructor
-    def __init__(self, dbpath: str):
+    def __init__(self, dbpath: str, revisionSrcs: list=None):
+        """
+        Parameters
+        ----------
+        dbpath : str
+            File path of the database.
+        revisionSrcs : list, optional
+            Sources to store in the revision layout, where each MJD has a baseline row in "<src>_base"
+            and later vintages only record their changed fields in "<src>_revisions".
+            Sources already stored this way are detected automatically. The default is None.
+        """
         super().__init__(dbpath)
         
         self._usedSrcs = None
         
         # We enable Rows for this
         self.con.row_factory = sq.Row
+
+        self._revisionSrcs = set() if revisionSrcs is None else set(revisionSrcs)
+        self._revisionSrcs.update(
+            src for src in self.srcfmts if self._baseTablename(src) in self._tables)
+
+        # Databases from before the latest-value tables and indexes existed are filled in on open
+        for src in self.bulletinTablenames:
+            self._migrateHistoryKey(src)
+            self.makeBulletinIndexes(src)
+        for src in self.bulletinSrcs:
+            self.makeLatestTable(src)
         
     #%% Common use-case methods
     def update(self):
@@ -125,20 +192,40 @@ class BulletinDatabase(sew.Database):
         """
         # Download
         data, time_retrieved = self.download()
+        # Parse and insert
+        self.ingest(data, time_retrieved)
+        
+        # Return for debugging purposes
+        return data, time_retrieved 
+
+    async def aupdate(self, client=None):
+        """
+        Asynchronous version of update(), which downloads all sources concurrently, see adownload().
+        Parsing and inserting still run on the calling thread once the downloads complete.
+        """
+        data, time_retrieved = await self.adownload(client)
+        self.ingest(data, time_retrieved)
+
+        return data, time_retrieved
+
+    def ingest(self, data: dict, time_retrieved: dict):
+        """
+        Parses and stores raw downloaded data, in the format returned by download().
+        """
         # Loop over the sources
         for src, raw in data.items():
             # Parse it into rows with typing
             bulletins = self.parseBulletins(src, raw)
             # Create the table if necessary
             self.makeBulletinTable(src)
-            # Insert the bulletins
-            self.insertIntoTable(src, bulletins, time_retrieved[src])
+            # Insert only the new or revised bulletins
+            if src in self._revisionSrcs:
+                self.insertIntoRevisionTables(src, bulletins, time_retrieved[src])
+            else:
+                self.insertIntoTableIncremental(src, bulletins, time_retrieved[src])
             
         # Commit changes
         self.commit()
-        
-        # Return for debugging purposes
-        return data, time_retrieved 
     
     @property
     def usedSrcs(self):
@@ -160,6 +247,7 @@ class BulletinDatabase(sew.Database):
         """
         if self._usedSrcs is None:
             raise ValueError("No sources are activated. Please call setSrcs().")
+        import requests # Only needed here, so don't slow down imports
         
         data = dict()
         time_retrieved = dict()
@@ -173,17 +261,387 @@ class BulletinDatabase(sew.Database):
                 print("Could not download from %s" % link)
         
         return data, time_retrieved
+
+    async def adownload(self, client=None):
+        """
+        Asynchronous version of download(), fetching every activated source concurrently
+        on a shared httpx.AsyncClient, see asyncfetch.py.
+        """
+        if self._usedSrcs is None:
+            raise ValueError("No sources are activated. Please call setSrcs().")
+        from asyncfetch import fetchAll # Only needed here, so don't slow down imports
+
+        return await fetchAll(self._usedSrcs, client)
         
     #%% Table handling
+    @property
+    def bulletinTablenames(self):
+        """
+        Names of the bulletin history tables, excluding the latest-value tables and revision layout sources.
+        """
+        return [name for name in self.tablenames if name in self.srcfmts]
+
+    @property
+    def bulletinSrcs(self):
+        """
+        Sources with stored bulletins, in either layout.
+        """
+        return self.bulletinTablenames + sorted(
+            src for src in self._revisionSrcs if self._baseTablename(src) in self._tables)
+
     def makeBulletinTable(self, src: str):
-        # Directly create with the appropriate table formatspec
+        if src in self._revisionSrcs:
+            self.makeRevisionTables(src)
+
+        # Nothing to do if the table is already registered
+        elif src not in self._tables:
+            # Directly create with the appropriate table formatspec
+            self.createTable(
+                self.srcfmts[src],
+                src,
+                ifNotExists=True, encloseTableName=True,
+                commitNow=True
+            )   
+            self.reloadTables()
+            self.makeBulletinIndexes(src)
+
+        # Always keep the latest-value table alongside it
+        self.makeLatestTable(src)
+
+    def makeBulletinIndexes(self, src: str):
+        """
+        Creates the indexes used for lookups by date and by MJD on a bulletin history table, if they don't exist.
+        """
+        self.execute(
+            'create index if not exists "%s_date" on "%s"(year, month, day, time_retrieved)' % (src, src))
+        self.execute(
+            'create index if not exists "%s_mjd" on "%s"(mjd, time_retrieved)' % (src, src))
+        self.commit()
+
+    def _migrateHistoryKey(self, src: str):
+        # History tables used to be UNIQUE(mjd, checksum), which dropped a value reverted to an earlier
+        # vintage's; rebuild them keyed by vintage instead, keeping the row order
+        self.execute("select sql from sqlite_master where type='table' and name=?", (src,))
+        sql = self.fetchone()[0]
+        if "unique(mjd,blake2b_32bit_checksum)" not in sql.lower().replace(" ", ""):
+            return
+        print("Rekeying %s by (mjd, time_retrieved)" % (src))
+        old = "%s_old" % (src)
+        self.execute('alter table "%s" rename to "%s"' % (src, old))
+        self.createTable(self.srcfmts[src], src, encloseTableName=True, commitNow=False)
+        self.execute('insert or ignore into "%s" select * from "%s" order by rowid' % (src, old))
+        self.execute('drop table "%s"' % (old)) # Its indexes go with it, and are remade by makeBulletinIndexes()
+        self.commit()
+        self.reloadTables()
+
+    #%% Latest-value tables
+    @staticmethod
+    def _latestTablename(src: str):
+        return "%s_latest" % (src)
+
+    @staticmethod
+    def _getLatestFmt(key: str):
+        # Same columns as the history, without the checksum, plus when each optional group was last seen.
+        # There is only one row per MJD, so it is the primary key.
+        fmt = BulletinDatabase._getFmt(key)
+        groups = sorted(set(group for *_, group in BulletinDatabase.finals_colspec if group is not None))
+        return {
+            'cols': fmt['cols'][:-1] + [["%s_time_retrieved" % group, "INTEGER"] for group in groups],
+            'conds': [
+                "PRIMARY KEY(mjd)"
+            ]
+        }
+
+    @staticmethod
+    def _makeLatestUpsert(src: str, select: str=None):
+        # Upsert into the latest table, either from VALUES or from a SELECT over the history table.
+        # Older vintages never overwrite newer ones, so rows can be applied in any order.
+        # The mandatory columns take the newest vintage; each optional group takes its newest non-null vintage.
+        fmt = BulletinDatabase._getFmt(src)
+        names = [col[0] for col in fmt['cols'][1:-1]]
+        groupcols = dict()
+        for name, (*_, group) in zip(names, BulletinDatabase.finals_colspec):
+            groupcols.setdefault(group, []).append(name)
+        groups = sorted(group for group in groupcols if group is not None)
+
+        insertcols = ["time_retrieved"] + names + ["%s_time_retrieved" % group for group in groups]
+        if select is None:
+            source = "values(%s)" % (",".join(["?"] * len(insertcols)))
+        else:
+            # Each group is present if its first column is
+            source = "select time_retrieved, %s, %s from %s where %s" % (
+                ", ".join(names),
+                ", ".join("case when %s is not null then time_retrieved end" % groupcols[group][0] for group in groups),
+                src, select)
+
+        # Note that on the right-hand side, unqualified columns refer to the existing row
+        sets = ["time_retrieved=max(time_retrieved, excluded.time_retrieved)"]
+        sets.extend(
+            "%s=case when excluded.time_retrieved >= time_retrieved then excluded.%s else %s end" % (name, name, name)
+            for name in groupcols[None] if name != "mjd"
+        )
+        for group in groups:
+            newer = "excluded.{0}_time_retrieved >= coalesce({0}_time_retrieved, -1)".format(group)
+            sets.extend(
+                "%s=case when %s then excluded.%s else %s end" % (name, newer, name, name)
+                for name in groupcols[group]
+            )
+            sets.append("{0}_time_retrieved=case when {1} then excluded.{0}_time_retrieved else {0}_time_retrieved end".format(
+                group, newer))
+
+        return "insert into %s(%s) %s on conflict(mjd) do update set %s" % (
+            BulletinDatabase._latestTablename(src), ", ".join(insertcols), source, ", ".join(sets))
+
+    def makeLatestTable(self, src: str):
+        """
+        Creates the latest-value table for a source if it doesn't exist yet,
+        filling it from any history that is already stored.
+        """
+        latest = self._latestTablename(src)
+        if latest in self._tables:
+            return
+
         self.createTable(
-            self.srcfmts[src],
-            src,
+            self._getLatestFmt(src),
+            latest,
+            ifNotExists=True, encloseTableName=True,
+            commitNow=False
+        )
+        self.rebuildLatestTable(src) # Commits
+        self.reloadTables()
+
+    def rebuildLatestTable(self, src: str):
+        """
+        Recomputes the latest-value table for a source from its full history.
+        """
+        self.execute("delete from %s" % (self._latestTablename(src)))
+        if src in self._revisionSrcs:
+            # Replay every stored vintage; the upsert doesn't depend on the order
+            self._upsertLatestRows(src, list(self._iterRevisionRows(src)))
+        else:
+            self.execute(self._makeLatestUpsert(src, select="true"))
+        self.commit()
+
+    def upsertLatest(self, src: str, bulletins: list, time_retrieved: int):
+        """
+        Applies newly inserted bulletin rows to the latest-value table. Does not commit.
+        """
+        self._upsertLatestRows(src, ((time_retrieved, *bulletin) for bulletin in bulletins))
+
+    def _upsertLatestRows(self, src: str, rows):
+        # Rows are full history rows i.e. (time_retrieved, *bulletin)
+        # Each group is present if its first column is
+        groupidx = dict()
+        for i, (*_, group) in enumerate(self.finals_colspec):
+            if group is not None:
+                groupidx.setdefault(group, i + 1)
+        groupidx = [groupidx[group] for group in sorted(groupidx)]
+
+        self.cur.executemany(
+            self._makeLatestUpsert(src),
+            ((*row[:-1], *[row[0] if row[i] is not None else None for i in groupidx])
+             for row in rows)
+        )
+
+    #%% Revision layout
+    @staticmethod
+    def _baseTablename(src: str):
+        return "%s_base" % (src)
+
+    @staticmethod
+    def _revisionsTablename(src: str):
+        return "%s_revisions" % (src)
+
+    def makeRevisionTables(self, src: str):
+        """
+        Creates the baseline and revision tables for a source, if they don't exist.
+        """
+        base = self._baseTablename(src)
+        if base in self._tables:
+            return
+
+        # The baseline has the same columns as the history, but only the first vintage of each MJD
+        fmt = self.srcfmts[src]
+        self.createTable(
+            {'cols': fmt['cols'], 'conds': ["PRIMARY KEY(mjd)"]},
+            base,
+            ifNotExists=True, encloseTableName=True,
+            commitNow=False
+        )
+        self.createTable(
+            self.bulletin_revisions_fmt,
+            self._revisionsTablename(src),
             ifNotExists=True, encloseTableName=True,
             commitNow=True
-        )   
+        )
+        self._revisionSrcs.add(src)
         self.reloadTables()
+
+    def _iterRevisionRows(self, src: str, asOf: int=None, mjdStart: float=None, mjdStop: float=None):
+        # Yields the full row (time_retrieved, *bulletin) of every stored vintage, in order of MJD and then vintage,
+        # by applying each vintage's revisions to the baseline in turn
+        conds = []
+        params = []
+        if asOf is not None:
+            conds.append("time_retrieved<=?")
+            params.append(asOf)
+        if mjdStart is not None:
+            conds.append("mjd>=?")
+            params.append(mjdStart)
+        if mjdStop is not None:
+            conds.append("mjd<=?")
+            params.append(mjdStop)
+        where = " where %s" % (" and ".join(conds)) if len(conds) > 0 else ""
+
+        self.execute("select * from %s%s order by mjd" % (self._baseTablename(src), where), params)
+        bases = [list(row) for row in self.fetchall()]
+        self.execute(
+            "select mjd, time_retrieved, col, value from %s%s order by mjd, time_retrieved" % (
+                self._revisionsTablename(src), where),
+            params)
+        revisions = self.fetchall()
+
+        # Both are sorted by MJD, so walk them together
+        r = 0
+        for row in bases:
+            mjd = row[4]
+            yield tuple(row)
+            while r < len(revisions) and revisions[r][0] < mjd:
+                r += 1 # Revisions without a baseline in range; shouldn't happen
+            while r < len(revisions) and revisions[r][0] == mjd:
+                tr = revisions[r][1]
+                while r < len(revisions) and revisions[r][0] == mjd and revisions[r][1] == tr:
+                    row[revisions[r][2]] = revisions[r][3]
+                    r += 1
+                row[0] = tr
+                yield tuple(row)
+
+    def insertIntoRevisionTables(self, src: str, bulletins: list, time_retrieved: int, verbose: bool=True):
+        """
+        Revision layout equivalent of insertIntoTableIncremental().
+        Rows for new MJDs become baselines, while rows that differ from the current values for their MJD
+        only store the changed fields.
+
+        Returns
+        -------
+        numNew : int
+            Number of rows for MJDs that were not previously stored.
+        numRevised : int
+            Number of rows for previously stored MJDs, but with different values.
+        """
+        if len(bulletins) == 0:
+            return 0, 0
+
+        # Reconstruct the current values over the covered range
+        mjds = [bulletin[3] for bulletin in bulletins]
+        current = dict()
+        for row in self._iterRevisionRows(src, mjdStart=min(mjds), mjdStop=max(mjds)):
+            current[row[4]] = row
+
+        bases = []
+        revisions = []
+        changed = []
+        for bulletin in bulletins:
+            row = (time_retrieved, *bulletin)
+            existing = current.get(bulletin[3])
+            if existing is None:
+                bases.append(row)
+            elif existing[-1] != row[-1]:
+                # Any difference shows up in the checksum, so only then compare the fields
+                revisions.extend(
+                    (bulletin[3], time_retrieved, i, row[i])
+                    for i in range(1, len(row)) if row[i] != existing[i])
+            else:
+                continue
+            changed.append(bulletin)
+            current[bulletin[3]] = row # In case the file repeats an MJD
+
+        # Write them all at once
+        self.cur.executemany(
+            "insert or ignore into %s values(%s)" % (self._baseTablename(src), ",".join(["?"] * len(self.srcfmts[src]['cols']))),
+            bases
+        )
+        self.cur.executemany(
+            "insert or replace into %s values(?,?,?,?)" % (self._revisionsTablename(src)),
+            revisions
+        )
+        # Keep the latest values in step, in the same transaction
+        self.upsertLatest(src, changed, time_retrieved)
+        self.commit()
+
+        numNew = len(bases)
+        numRevised = len(changed) - numNew
+        if verbose:
+            print("%s: %d new and %d revised rows (%d fields, %d unchanged)" % (
+                src, numNew, numRevised, len(revisions), len(bulletins) - len(changed)))
+
+        return numNew, numRevised
+
+    def migrateToRevisions(self, src: str, dropHistory: bool=False):
+        """
+        Converts a source stored as full history rows to the revision layout, by replaying every vintage in order.
+        The history table is kept unless dropHistory is True.
+        """
+        self.execute("select * from %s order by time_retrieved, mjd" % (src))
+        rows = self.fetchall()
+
+        self.makeRevisionTables(src)
+        i = 0
+        while i < len(rows):
+            j = i
+            while j < len(rows) and rows[j][0] == rows[i][0]:
+                j += 1
+            self.insertIntoRevisionTables(src, [tuple(row)[1:] for row in rows[i:j]], rows[i][0], verbose=False)
+            i = j
+
+        if dropHistory:
+            self.execute('drop table "%s"' % (src))
+            self.commit()
+            self.reloadTables()
+
+    def getBulletinAsOf(self, src: str, time_retrieved: int, mjdStart: float=None, mjdStop: float=None):
+        """
+        Reconstructs the bulletin rows as they were known at the given time, i.e. the latest vintage
+        retrieved at or before it for each MJD, for either layout.
+
+        Returns
+        -------
+        list
+            Full rows (time_retrieved, *bulletin) in order of MJD.
+        """
+        if src in self._revisionSrcs:
+            latest = dict()
+            for row in self._iterRevisionRows(src, time_retrieved, mjdStart, mjdStop):
+                latest[row[4]] = row
+            return list(latest.values())
+
+        conds = ["time_retrieved<=?"]
+        params = [time_retrieved]
+        if mjdStart is not None:
+            conds.append("mjd>=?")
+            params.append(mjdStart)
+        if mjdStop is not None:
+            conds.append("mjd<=?")
+            params.append(mjdStop)
+        # The (mjd, time_retrieved) index serves both the grouping and the join
+        stmt = (
+            "select h.* from %s h join (select mjd, max(time_retrieved) as tr from %s where %s group by mjd) m "
+            "on h.mjd=m.mjd and h.time_retrieved=m.tr order by h.mjd" % (src, src, " and ".join(conds))
+        )
+        self.execute(stmt, params)
+        return [tuple(row) for row in self.fetchall()]
+
+    def getHistorySignature(self, src: str):
+        """
+        Returns a string that changes whenever bulletins are stored for a source, in either layout.
+        History rows are only ever appended, so the largest rowids are enough.
+        """
+        tables = [self._baseTablename(src), self._revisionsTablename(src)] if src in self._revisionSrcs else [src]
+        maxrowids = []
+        for table in tables:
+            self.execute("select max(rowid) from %s" % (table))
+            maxrowids.append(self.fetchone()[0])
+        return ",".join(str(i) for i in maxrowids)
     
     def insertIntoTable(self, src: str, bulletins: list, time_retrieved: int, replace: bool=False):
         # We can directly insert, since the table knows the format in sew now
@@ -195,6 +653,52 @@ class BulletinDatabase(sew.Database):
                 encloseTableName=True)
         except sq.IntegrityError as e:
             print("Skipping due to unique constraint failure.")
+
+    def insertIntoTableIncremental(self, src: str, bulletins: list, time_retrieved: int, verbose: bool=True):
+        """
+        Inserts only the bulletin rows that are new or revised, in one transaction.
+        Rows are compared by their line checksums against the latest stored vintage of each MJD,
+        so unchanged rows are not rewritten, while any change is recorded as a new vintage; this
+        includes reverting to an earlier vintage's values, and blanking an optional group.
+
+        Returns
+        -------
+        numNew : int
+            Number of rows for MJDs that were not previously stored.
+        numRevised : int
+            Number of rows for previously stored MJDs, but with different values.
+        """
+        if len(bulletins) == 0:
+            return 0, 0
+
+        # Fetch the checksum of the latest vintage of each MJD over the covered range, rather than of any
+        # stored vintage, so that a value reverted to an earlier one is not taken as unchanged.
+        # A bare column with max() comes from the row with the maximum; the (mjd, time_retrieved) index serves this
+        mjds = [bulletin[3] for bulletin in bulletins]
+        self.execute(
+            "select mjd, blake2b_32bit_checksum, max(time_retrieved) from %s where mjd between ? and ? group by mjd" % (src),
+            (min(mjds), max(mjds))
+        )
+        current = {mjd: checksum for mjd, checksum, _ in self.fetchall()}
+
+        changed = [bulletin for bulletin in bulletins if current.get(bulletin[3]) != bulletin[-1]]
+        numRevised = sum(1 for bulletin in changed if bulletin[3] in current)
+        numNew = len(changed) - numRevised
+
+        # Write them all at once; duplicates within the file itself are ignored
+        self.cur.executemany(
+            "insert or ignore into %s values(%s)" % (src, ",".join(["?"] * len(self.srcfmts[src]['cols']))),
+            ((time_retrieved, *bulletin) for bulletin in changed)
+        )
+        # Keep the latest values in step, in the same transaction
+        self.upsertLatest(src, changed, time_retrieved)
+        self.commit()
+
+        if verbose:
+            print("%s: %d new and %d revised rows (%d unchanged)" % (
+                src, numNew, numRevised, len(bulletins) - len(changed)))
+
+        return numNew, numRevised
             
     ######### These getters are a bit useless by themselves, usually you would want to extract the latest values for each individual variable
     def getBulletin1980(self, src: str, nearest_time_retrieved: int=None):
@@ -225,11 +729,21 @@ class BulletinDatabase(sew.Database):
         results = self.fetchall()
         return results
     
+    @staticmethod
+    def dateToMjd(year: int, month: int, day: int):
+        """
+        Converts a calendar date to the MJD. Two-digit years (as stored in the tables) are taken as
+        1973-2072, since the IERS series start in 1973.
+        """
+        if year < 100:
+            year += 1900 if year >= 73 else 2000
+        return dt.date(year, month, day).toordinal() - dt.date(1858, 11, 17).toordinal()
+
     def getPolMotionDut1(self, src: str, year: int, month: int, day: int):
-        # Extract each variable individually, and always pick the latest time_retrieved where it's not null
+        # The latest table already holds the newest time_retrieved for each day
         # These 3 come together, and are always present
-        stmt = "select time_retrieved, A_pmx_arcsec, A_pmy_arcsec, A_dut1_sec from %s where year=? and month=? and day=? ORDER BY time_retrieved DESC limit 1" % src
-        self.execute(stmt, (year, month, day))
+        stmt = "select time_retrieved, A_pmx_arcsec, A_pmy_arcsec, A_dut1_sec from %s where mjd=?" % self._latestTablename(src)
+        self.execute(stmt, (self.dateToMjd(year, month, day),))
         try:
             tr0, pmx_arcsec, pmy_arcsec, dut1_sec = self.fetchone()
             return tr0, pmx_arcsec, pmy_arcsec, dut1_sec
@@ -237,20 +751,28 @@ class BulletinDatabase(sew.Database):
             raise TypeError("No results; make sure year/month/day exists. %s" % str(e))
             
     def getLod(self, src: str, mjday: float):
-        # LOD may not be present, so the best case is to list in order of mjday (which is generally monotonically increasing)
-        # and then find the nearest date which is not empty
-        stmt = "select time_retrieved, mjd, A_lod_msec from %s where A_lod_msec is not null ORDER BY ABS(mjd-?) ASC, time_retrieved DESC limit 1" % src
-        self.execute(stmt, (mjday,))
+        # LOD may not be present, so find the nearest non-empty day on either side along the primary key
+        latest = self._latestTablename(src)
+        candidates = []
+        for stmt in (
+            "select lod_time_retrieved, mjd, A_lod_msec from %s where mjd<=? and A_lod_msec is not null ORDER BY mjd DESC limit 1",
+            "select lod_time_retrieved, mjd, A_lod_msec from %s where mjd>? and A_lod_msec is not null ORDER BY mjd ASC limit 1"
+        ):
+            self.execute(stmt % latest, (mjday,))
+            result = self.fetchone()
+            if result is not None:
+                candidates.append(tuple(result))
         try:
-            tr0, mjd, lod_msec = self.fetchone()
+            # Ties go to the newer vintage
+            tr0, mjd, lod_msec = min(candidates, key=lambda c: (abs(c[1] - mjday), -c[0]))
             return tr0, mjd, lod_msec
-        except TypeError as e:
+        except ValueError as e:
             raise TypeError("No results; maybe check mjday value? %s" % str(e))
             
     def getMjday(self, src: str, year: int, month: int, day: int):
-        # Use this if you wish to get the mjday for a calendar date
-        stmt = "select mjd from %s where year=? and month=? and day=? limit 1" % (src)
-        self.execute(stmt, (year, month, day))
+        # Use this if you wish to get the mjday for a calendar date; this also checks that it exists
+        stmt = "select mjd from %s where mjd=?" % (self._latestTablename(src))
+        self.execute(stmt, (self.dateToMjd(year, month, day),))
         try:
             mjday, = self.fetchone()
             return mjday
@@ -263,15 +785,75 @@ class BulletinDatabase(sew.Database):
         tr_pol, pmx_arcsec, pmy_arcsec, dut1_sec = self.getPolMotionDut1(src, year, month, day)
         tr_lod, mjd_actual, lod_msec = self.getLod(src, mjday)
         return tr_pol, pmx_arcsec, pmy_arcsec, dut1_sec, tr_lod, mjd_actual, lod_msec
+
+    def getTeme2EcefParamsRange(self, src: str, start: float, stop: float):
+        """
+        Batched version of getTeme2EcefParams() for every day with MJD in [start, stop], using one query
+        over the latest-value table. Use dateToMjd() to convert calendar dates.
+        LOD is filled from the nearest day that has it, which may lie outside the range.
+
+        Returns
+        -------
+        mjd : np.ndarray
+            MJD of each day.
+        tr_pol : np.ndarray
+            Time retrieved of the polar motion and DUT1 values.
+        pmx_arcsec : np.ndarray
+        pmy_arcsec : np.ndarray
+        dut1_sec : np.ndarray
+        tr_lod : np.ndarray
+            Time retrieved of the LOD values.
+        mjd_lod : np.ndarray
+            MJD the LOD was taken from.
+        lod_msec : np.ndarray
+        """
+        import numpy as np
+
+        # The days themselves, plus the nearest LOD on either side; all of these are primary key scans
+        cols = "mjd, time_retrieved, A_pmx_arcsec, A_pmy_arcsec, A_dut1_sec, lod_time_retrieved, A_lod_msec"
+        latest = self._latestTablename(src)
+        stmt = (
+            "select 0, {0} from {1} where mjd between ? and ? "
+            "union all select * from (select 1, {0} from {1} where mjd<? and A_lod_msec is not null order by mjd desc limit 1) "
+            "union all select * from (select 1, {0} from {1} where mjd>? and A_lod_msec is not null order by mjd asc limit 1) "
+            "order by 2"
+        ).format(cols, latest)
+        self.execute(stmt, (start, stop, start, stop))
+        rows = np.array([tuple(row) for row in self.fetchall()], dtype=np.float64).reshape(-1, 8)
+
+        days = rows[rows[:, 0] == 0]
+        mjd = days[:, 1]
+
+        # Nearest LOD to each day, with ties going to the newer vintage
+        haslod = rows[~np.isnan(rows[:, 7])]
+        if len(haslod) == 0:
+            if len(mjd) > 0:
+                raise TypeError("No LOD results; maybe check mjday values?")
+            haslod = np.full((1, 8), np.nan) # Nothing to fill anyway
+        right = np.clip(np.searchsorted(haslod[:, 1], mjd), 0, len(haslod) - 1)
+        left = np.clip(right - 1, 0, len(haslod) - 1)
+        dleft = np.abs(haslod[left, 1] - mjd)
+        dright = np.abs(haslod[right, 1] - mjd)
+        useright = (dright < dleft) | ((dright == dleft) & (haslod[right, 6] > haslod[left, 6]))
+        nearest = haslod[np.where(useright, right, left)]
+
+        return (
+            mjd, days[:, 2].astype(np.int64), days[:, 3], days[:, 4], days[:, 5],
+            nearest[:, 6].astype(np.int64), nearest[:, 1], nearest[:, 7]
+        )
         
     #%% Hash functions used for comparisons
     @staticmethod
     def _hashLine(line: str):
+        return BulletinDatabase._hashBytes(line.encode('utf-8'))
+
+    @staticmethod
+    def _hashBytes(line: bytes):
         # We always strip for consistency
         line = line.strip()
         # Then hash into a short 32-bit sequence using blake2s
         # Note that we use a short bit sequence so that sqlite can convert it from python integers
-        hashed = blake2s(line.encode('utf-8'), digest_size=7).digest()
+        hashed = blake2s(line, digest_size=7).digest()
         # Save as integer
         hashed = int.from_bytes(hashed, 'big')
         
@@ -288,161 +870,135 @@ class BulletinDatabase(sew.Database):
             raise KeyError("Key was invalid. No appropraite parse found.")
     
     
+    @staticmethod
+    def parseFinals(data: str, key: str, hashLines: bool=True):
+        """
+        Decodes a whole finals file into NumPy arrays in one pass, using finals_colspec.
+        Lines shorter than 79 characters (i.e. without the mandatory fields) are skipped.
+
+        Parameters
+        ----------
+        data : str
+            Raw text of the finals file.
+        key : str
+            Source key, which selects the IAU1980 or IAU2000 column names.
+        hashLines : bool, optional
+            Compute the per-line checksums, which are needed for inserts. The default is True.
+
+        Returns
+        -------
+        columns : dict
+            Column name to array. Numeric fields are NaN where blank; flags are 'S1' arrays.
+        masks : dict
+            Group name ('lod', 'nutation', 'B') to boolean array; True where the group is present.
+        checksums : list
+            Hash of each decoded line, as used for the blake2b_32bit_checksum column.
+            None if hashLines is False.
+        """
+        import numpy as np
+
+        fmt = BulletinDatabase._getFmt(key)
+        names = [col[0] for col in fmt['cols'][1:-1]] # Skip time_retrieved and the checksum
+
+        # Find the line boundaries directly in the bytes
+        raw = data.encode()
+        buf = np.frombuffer(raw, dtype=np.uint8)
+        ends = np.flatnonzero(buf == 10)
+        if len(buf) > 0 and buf[-1] != 10:
+            ends = np.append(ends, len(buf))
+        starts = np.concatenate(([0], ends[:-1] + 1)).astype(np.int64)[:len(ends)]
+        keep = ends - starts >= 79
+        starts = starts[keep]
+        ends = ends[keep]
+
+        # Gather into a (width, N) block padded with spaces, so that each column is contiguous;
+        # carriage returns count as blanks too
+        width = BulletinDatabase.finals_linewidth
+        offsets = np.arange(width)[:, None]
+        padded = np.concatenate((buf, np.full(width, 32, dtype=np.uint8)))
+        block = padded[starts + offsets]
+        block[(offsets >= ends - starts) | (block == 13)] = 32
+
+        columns = dict()
+        groupblanks = dict()
+        for name, (start, stop, kind, group) in zip(names, BulletinDatabase.finals_colspec):
+            sub = block[start:stop]
+            blank = np.all(sub == 32, axis=0)
+            if kind == "str":
+                columns[name] = np.ascontiguousarray(sub.T).view("S%d" % (stop - start)).reshape(-1)
+            else:
+                values = BulletinDatabase._parseFixedPoint(sub)
+                values[blank] = np.nan
+                columns[name] = values.astype(np.int64) if kind == "int" else values
+                # Only numeric fields decide whether a group is present
+                if group is not None:
+                    groupblanks[group] = groupblanks.get(group, np.zeros(len(blank), bool)) | blank
+
+        masks = {group: ~blank for group, blank in groupblanks.items()}
+
+        # Hash each line to easily test uniqueness
+        checksums = [
+            BulletinDatabase._hashBytes(raw[a:b]) for a, b in zip(starts.tolist(), ends.tolist())
+        ] if hashLines else None
+
+        return columns, masks, checksums
+
+    @staticmethod
+    def _parseFixedPoint(sub):
+        # Converts a (width, N) block of fixed-point decimal text to floats by accumulating digits
+        # column by column, which is much faster than converting via strings.
+        # Only digits, '.' and '-' are meaningful. The mantissa is exact in float64, so dividing by
+        # the (exact) power of ten rounds the same way as float() would.
+        import numpy as np
+        n = sub.shape[1]
+        mantissa = np.zeros(n)
+        decimals = np.zeros(n, dtype=np.int64)
+        seendot = np.zeros(n, dtype=bool)
+        negative = np.zeros(n, dtype=bool)
+        for col in sub:
+            isdigit = (col >= 48) & (col <= 57)
+            mantissa = np.where(isdigit, mantissa * 10 + (col.astype(np.float64) - 48), mantissa)
+            decimals += isdigit & seendot
+            seendot |= col == 46
+            negative |= col == 45
+        values = mantissa / 10.0**decimals
+        values[negative] *= -1
+        return values
+
+    @staticmethod
+    def _getFmt(key: str):
+        if '1980' in key:
+            return BulletinDatabase.bulletins1980_table_fmt
+        elif '2000' in key:
+            return BulletinDatabase.bulletins2000_table_fmt
+        else:
+            raise KeyError("Key was invalid. No appropraite parse found.")
+
+    @staticmethod
+    def _finalsToRows(columns: dict, masks: dict, checksums: list, key: str):
+        # Convert the arrays to row tuples for inserts, with Nones for blank optional groups
+        fmt = BulletinDatabase._getFmt(key)
+        names = [col[0] for col in fmt['cols'][1:-1]]
+        lists = []
+        for name, (start, stop, kind, group) in zip(names, BulletinDatabase.finals_colspec):
+            values = columns[name]
+            values = values.astype(str) if kind == "str" else values
+            values = values.tolist()
+            if group is not None:
+                values = [v if m else None for v, m in zip(values, masks[group].tolist())]
+            lists.append(values)
+        lists.append(checksums)
+        return list(zip(*lists))
+
     @staticmethod
     def parseBulletins1980(data: str):
-        bulletins = []
-        # Split into lines
-        data = data.split("\n")
-        # Read each line according to https://maia.usno.navy.mil/ser7/readme.finals
-        for line in data:
-            if len(line) < 79:
-                continue
-            
-            year = int(line[0:2])
-            month = int(line[2:4])
-            day = int(line[4:6])
-            mjday = float(line[7:15])
-            
-            ip_A_polar = str(line[16])
-            A_pmx_arcsec = float(line[18:27])
-            A_pmx_err_arcsec = float(line[27:36])
-            A_pmy_arcsec = float(line[37:46])
-            A_pmy_err_arcsec = float(line[46:55])
-            
-            ip_A_dut1 = str(line[57])
-            A_dut1_sec = float(line[58:68])
-            A_dut1_err_sec = float(line[68:78])
-            
-            # From here onwards, the fields may be blank, in which case we save Nones
-            try:
-                A_lod_msec = float(line[79:86])
-                A_lod_err_msec = float(line[86:93])
-            except:
-                A_lod_msec = None
-                A_lod_err_msec = None
-            
-            # This is another group that appears together
-            try:
-                ip_A_nutation = str(line[95])
-                A_dpsi_arcmsec = float(line[97:106])
-                A_dpsi_err_arcmsec = float(line[106:115])
-                A_deps_arcmsec = float(line[116:125])
-                A_deps_err_arcmsec = float(line[125:134])
-            except:
-                ip_A_nutation = None
-                A_dpsi_arcmsec = None
-                A_dpsi_err_arcmsec = None
-                A_deps_arcmsec = None
-                A_deps_err_arcmsec = None
-                
-            # And the final group from bulletin B
-            try:
-                B_pmx_arcsec = float(line[134:144])
-                B_pmy_arcsec = float(line[144:154])
-                B_dut1_sec = float(line[154:165])
-                B_dpsi_arcmsec = float(line[165:175])
-                B_deps_arcmsec = float(line[175:185])
-            except:
-                B_pmx_arcsec = None
-                B_pmy_arcsec = None
-                B_dut1_sec = None
-                B_dpsi_arcmsec = None
-                B_deps_arcmsec = None
-                
-            # Hash it to easily test uniqueness
-            hashed = BulletinDatabase._hashLine(line)
-                
-            # We append as list of tuples, for ease of inserts later
-            bulletins.append(
-                (year, month, day, mjday,
-                 ip_A_polar, A_pmx_arcsec, A_pmx_err_arcsec, A_pmy_arcsec, A_pmy_err_arcsec,
-                 ip_A_dut1, A_dut1_sec, A_dut1_err_sec,
-                 A_lod_msec, A_lod_err_msec,
-                 ip_A_nutation,
-                 A_dpsi_arcmsec, A_dpsi_err_arcmsec, A_deps_arcmsec, A_deps_err_arcmsec,
-                 B_pmx_arcsec, B_pmy_arcsec, B_dut1_sec, B_dpsi_arcmsec, B_deps_arcmsec,
-                 hashed)    
-            )
-            
-        return bulletins
-        
+        columns, masks, checksums = BulletinDatabase.parseFinals(data, "1980")
+        return BulletinDatabase._finalsToRows(columns, masks, checksums, "1980")
+
     @staticmethod
     def parseBulletins2000(data: str):
-        bulletins = []
-        # Split into lines
-        data = data.split("\n")
-        # Read each line according to https://maia.usno.navy.mil/ser7/readme.finals2000A
-        for line in data:
-            if len(line) < 79:
-                continue
-            
-            year = int(line[0:2])
-            month = int(line[2:4])
-            day = int(line[4:6])
-            mjday = float(line[7:15])
-            
-            ip_A_polar = str(line[16])
-            A_pmx_arcsec = float(line[18:27])
-            A_pmx_err_arcsec = float(line[27:36])
-            A_pmy_arcsec = float(line[37:46])
-            A_pmy_err_arcsec = float(line[46:55])
-            
-            ip_A_dut1 = str(line[57])
-            A_dut1_sec = float(line[58:68])
-            A_dut1_err_sec = float(line[68:78])
-            
-            # From here onwards, the fields may be blank, in which case we save Nones
-            try:
-                A_lod_msec = float(line[79:86])
-                A_lod_err_msec = float(line[86:93])
-            except:
-                A_lod_msec = None
-                A_lod_err_msec = None
-            
-            # This is another group that appears together
-            try:
-                ip_A_nutation = str(line[95])
-                A_dX_arcmsec = float(line[97:106]) # Here is where it differs from 1980
-                A_dX_err_arcmsec = float(line[106:115])
-                A_dY_arcmsec = float(line[116:125])
-                A_dY_err_arcmsec = float(line[125:134])
-            except:
-                ip_A_nutation = None
-                A_dX_arcmsec = None
-                A_dX_err_arcmsec = None
-                A_dY_arcmsec = None
-                A_dY_err_arcmsec = None
-                
-            # And the final group from bulletin B
-            try:
-                B_pmx_arcsec = float(line[134:144])
-                B_pmy_arcsec = float(line[144:154])
-                B_dut1_sec = float(line[154:165])
-                B_dX_arcmsec = float(line[165:175]) # This also differs from 1980
-                B_dY_arcmsec = float(line[175:185])
-            except:
-                B_pmx_arcsec = None
-                B_pmy_arcsec = None
-                B_dut1_sec = None
-                B_dX_arcmsec = None
-                B_dY_arcmsec = None
-                
-            # Hash it to easily test uniqueness
-            hashed = BulletinDatabase._hashLine(line)
-                
-            # We append as list of tuples, for ease of inserts later
-            bulletins.append(
-                (year, month, day, mjday,
-                 ip_A_polar, A_pmx_arcsec, A_pmx_err_arcsec, A_pmy_arcsec, A_pmy_err_arcsec,
-                 ip_A_dut1, A_dut1_sec, A_dut1_err_sec,
-                 A_lod_msec, A_lod_err_msec,
-                 ip_A_nutation,
-                 A_dX_arcmsec, A_dX_err_arcmsec, A_dY_arcmsec, A_dY_err_arcmsec,
-                 B_pmx_arcsec, B_pmy_arcsec, B_dut1_sec, B_dX_arcmsec, B_dY_arcmsec,
-                 hashed)    
-            )
-            
-        return bulletins
+        columns, masks, checksums = BulletinDatabase.parseFinals(data, "2000")
+        return BulletinDatabase._finalsToRows(columns, masks, checksums, "2000")
         
     
     
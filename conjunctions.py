@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+Close-approach screening over a catalog of TLEs.
+
+An all-vs-all screen is quadratic in the catalog size, so pairs are narrowed down in stages:
+1. Apogee/perigee filter: two objects can only meet if their radial bands [perigee, apogee]
+   overlap (within the threshold). Objects that overlap no other object are not propagated at all.
+2. Spatial hash: at each step of a time grid, positions are binned into cubic cells sized so that
+   any pair that could come within the threshold before the next sample lies in neighbouring cells.
+   Only pairs in neighbouring cells, whose sampled distance is within the same bound, are kept.
+3. Refinement: the time of closest approach around each run of candidate samples is found by
+   golden-section search on the pair's distance, for all candidates at once.
+
+Example
+-------
+catalog = d.getLatestCatalog("active")
+found = screenConjunctions(catalog, dt.datetime(2024, 1, 1), dt.datetime(2024, 1, 2), threshold=5.0)
+"""
+
+import numpy as np
+
+from orbitprop import OrbitPropagator, MU_EARTH, apsides, toUnixSeconds
+
+#%% Output format
+def makeConjunctionDtype(namewidth: int):
+    return np.dtype([
+        ("name1", "U%d" % max(namewidth, 1)),
+        ("name2", "U%d" % max(namewidth, 1)),
+        ("satnumber1", np.int32),
+        ("satnumber2", np.int32),
+        ("tca", "datetime64[ms]"), # Time of closest approach
+        ("miss_km", np.float64),
+        ("relative_speed_km_s", np.float64)
+    ])
+
+#%% Apogee/perigee filter
+def apsisBands(decoded: np.ndarray):
+    """
+    Returns the perigee and apogee radii (km) of every TLE in a tlearrays.tle_dtype array.
+    """
+    return apsides(decoded["mean_motion_revperday"], decoded["eccentricity"])
+
+def apsisOverlap(perigee, apogee, threshold: float):
+    """
+    Returns, for every object, whether its radial band overlaps that of any other object,
+    with the bands padded by the threshold. Runs in O(N log N) by sweeping the sorted bands.
+    """
+    perigee = np.asarray(perigee)
+    apogee = np.asarray(apogee)
+    n = len(perigee)
+    if n < 2:
+        return np.zeros(n, dtype=bool)
+    order = np.argsort(perigee, kind="stable")
+    lo = perigee[order]
+    hi = apogee[order] + threshold # Padding one end pads the gap between any two bands
+    # With the bands sorted by start, a band overlaps an earlier one if it starts before the
+    # furthest end so far, and a later one if the next band starts before its own end
+    reach = np.maximum.accumulate(hi)
+    overlapsPrev = np.zeros(n, dtype=bool)
+    overlapsPrev[1:] = lo[1:] <= reach[:-1]
+    overlapsNext = np.zeros(n, dtype=bool)
+    overlapsNext[:-1] = lo[1:] <= hi[:-1]
+    out = np.empty(n, dtype=bool)
+    out[order] = overlapsPrev | overlapsNext
+    return out
+
+def apsisPairFilter(perigee, apogee, i, j, threshold: float):
+    """
+    Returns whether the radial bands of the pairs (i[k], j[k]) overlap, padded by the threshold.
+    """
+    return (np.maximum(perigee[i], perigee[j]) - np.minimum(apogee[i], apogee[j])) <= threshold
+
+#%% Spatial hash
+# Cell coordinates are packed into one integer key, 20 bits per axis
+_cellBits = 20
+_cellOffset = 1 << (_cellBits - 1)
+
+def _packCells(cells):
+    c = cells + _cellOffset
+    return (c[..., 0] << (2 * _cellBits)) | (c[..., 1] << _cellBits) | c[..., 2]
+
+# The cell itself and half of its 26 neighbours, so that each neighbouring pair is found once
+_halfNeighbours = np.array(
+    [(0, 0, 0)] + [
+        (dx, dy, dz) for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1)
+        if (dx, dy, dz) > (0, 0, 0)
+    ], dtype=np.int64)
+
+def spatialHashPairs(positions: np.ndarray, cellSize: float):
+    """
+    Returns the index pairs (i, j), i != j, of positions that lie in the same or neighbouring cells.
+    Every pair within cellSize of each other is included. Rows with NaNs are ignored.
+
+    Parameters
+    ----------
+    positions : np.ndarray
+        Positions shaped (N, 3).
+    cellSize : float
+        Edge length of the cubic cells.
+    """
+    valid = np.flatnonzero(~np.isnan(positions).any(axis=1))
+    cells = np.floor(positions[valid] / cellSize).astype(np.int64)
+    keys = _packCells(cells)
+    order = np.argsort(keys, kind="stable")
+    sortedKeys = keys[order]
+
+    pairs_i = []
+    pairs_j = []
+    for offset in _halfNeighbours:
+        nkeys = _packCells(cells + offset)
+        lo = np.searchsorted(sortedKeys, nkeys, "left")
+        counts = np.searchsorted(sortedKeys, nkeys, "right") - lo
+        total = counts.sum()
+        if total == 0:
+            continue
+        # Expand every object against every member of its neighbouring cell
+        i = np.repeat(np.arange(len(keys)), counts)
+        within = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        j = order[np.repeat(lo, counts) + within]
+        if not offset.any():
+            keep = i < j # Same cell: each pair once, and not with itself
+            i, j = i[keep], j[keep]
+        pairs_i.append(valid[i])
+        pairs_j.append(valid[j])
+
+    if len(pairs_i) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(pairs_i), np.concatenate(pairs_j)
+
+#%% Screening
+_golden = (np.sqrt(5.0) - 1.0) / 2.0
+
+def _refineClosestApproach(prop: OrbitPropagator, i, j, lo, hi, tolerance: float):
+    # Golden-section search for the minimum distance in [lo, hi], for all pairs at once
+    def distance(t):
+        return np.linalg.norm(prop.positionsAt(i, t) - prop.positionsAt(j, t), axis=1)
+
+    a = lo.copy()
+    b = hi.copy()
+    c = b - _golden * (b - a)
+    d = a + _golden * (b - a)
+    fc = distance(c)
+    fd = distance(d)
+    while np.max(b - a, initial=0.0) > tolerance:
+        left = fc < fd # The minimum is in [a, d] if so, otherwise in [c, b]
+        a, b = np.where(left, a, c), np.where(left, d, b)
+        newc = b - _golden * (b - a)
+        newd = a + _golden * (b - a)
+        f = distance(np.where(left, newc, newd))
+        c, d = np.where(left, newc, d), np.where(left, c, newd)
+        fc, fd = np.where(left, f, fd), np.where(left, fc, f)
+
+    tca = (a + b) / 2.0
+    # Relative speed by central difference about the closest approach
+    h = 0.5
+    rel = (prop.positionsAt(i, tca + h) - prop.positionsAt(j, tca + h)) - (prop.positionsAt(i, tca - h) - prop.positionsAt(j, tca - h))
+    return tca, distance(tca), np.linalg.norm(rel, axis=1) / (2.0 * h)
+
+def screenConjunctions(catalog, start, stop, threshold: float=5.0, step: float=30.0, chunk: int=60,
+                       tolerance: float=0.01, verbose: bool=False):
+    """
+    Screens every pair of objects in a catalog for close approaches within a time window.
+
+    Parameters
+    ----------
+    catalog : TleCatalog or dict
+        Satellite names to [line1, line2], e.g. from TleDatabase.getLatestCatalog().
+    start : datetime, datetime64 or float
+        Start of the window (UTC, or Unix seconds).
+    stop : datetime, datetime64 or float
+        End of the window.
+    threshold : float, optional
+        Miss distance in km below which approaches are reported. The default is 5.
+    step : float, optional
+        Grid step in seconds. Larger steps propagate less but make the spatial cells (and so the
+        number of candidate pairs) larger. The default is 30.
+    chunk : int, optional
+        Number of grid steps propagated at once. The default is 60.
+    tolerance : float, optional
+        Tolerance of the times of closest approach in seconds. The default is 0.01.
+    verbose : bool, optional
+        Print the progress of each stage. The default is False.
+
+    Returns
+    -------
+    np.ndarray
+        Structured array of makeConjunctionDtype(), sorted by miss distance.
+    """
+    from tlecatalog import TleCatalog
+    if not isinstance(catalog, TleCatalog):
+        catalog = TleCatalog.fromDict(catalog)
+    start = float(toUnixSeconds(start))
+    stop = float(toUnixSeconds(stop))
+    names = catalog.names
+    outDtype = makeConjunctionDtype(max([len(n) for n in names], default=1))
+
+    # Stage 1: only objects whose radial bands meet another's can be involved
+    decoded = catalog.decoded
+    perigee, apogee = apsisBands(decoded)
+    valid = (decoded["mean_motion_revperday"] > 0) & (decoded["eccentricity"] < 1.0)
+    idx = np.flatnonzero(valid & apsisOverlap(np.where(valid, perigee, np.inf), np.where(valid, apogee, -np.inf), threshold))
+    if verbose:
+        print("Apogee/perigee filter kept %d of %d objects" % (len(idx), len(catalog)))
+    if len(idx) < 2:
+        return np.zeros(0, dtype=outDtype)
+    perigee = perigee[idx]
+    apogee = apogee[idx]
+
+    # Fastest each object can move (at perigee), which bounds how far pairs close in between samples
+    a = (perigee + apogee) / 2.0
+    vmax = np.sqrt(MU_EARTH * (2.0 / perigee - 1.0 / a))
+    halfStepReach = vmax * step / 2.0
+    cellSize = threshold + 2.0 * halfStepReach.max()
+
+    prop = OrbitPropagator(catalog.line1[idx], catalog.line2[idx])
+    t = np.arange(start, stop, step)
+    t = np.append(t, stop) if t[-1] < stop else t
+
+    # Stage 2: spatial hash per grid step, collecting (i, j, step, sampled distance)
+    found = []
+    numHashed = 0
+    for k0 in range(0, len(t), chunk):
+        r = prop.positions(t[k0:k0 + chunk])
+        for k in range(r.shape[1]):
+            pi, pj = spatialHashPairs(r[:, k], cellSize)
+            numHashed += len(pi)
+            dist = np.linalg.norm(r[pi, k] - r[pj, k], axis=1)
+            # Within the threshold of a closest approach that could happen before the next or since the last sample
+            keep = (dist <= threshold + halfStepReach[pi] + halfStepReach[pj]) & apsisPairFilter(perigee, apogee, pi, pj, threshold)
+            if keep.any():
+                pi, pj = np.minimum(pi[keep], pj[keep]), np.maximum(pi[keep], pj[keep])
+                found.append(np.stack([pi, pj, np.full(len(pi), k0 + k), dist[keep]], axis=1))
+    if verbose:
+        print("Spatial hash gave %d neighbouring pairs over %d steps; %d candidate samples" % (
+            numHashed, len(t), sum(len(f) for f in found)))
+    if len(found) == 0:
+        return np.zeros(0, dtype=outDtype)
+    found = np.concatenate(found)
+
+    # Group consecutive candidate steps of each pair into runs, and refine around each run's closest sample
+    order = np.lexsort((found[:, 2], found[:, 1], found[:, 0]))
+    found = found[order]
+    pi, pj, k, dist = found[:, 0].astype(np.int64), found[:, 1].astype(np.int64), found[:, 2].astype(np.int64), found[:, 3]
+    newRun = np.ones(len(found), dtype=bool)
+    newRun[1:] = (pi[1:] != pi[:-1]) | (pj[1:] != pj[:-1]) | (k[1:] != k[:-1] + 1)
+    runs = np.cumsum(newRun) - 1
+    # Closest sample of each run
+    best = np.lexsort((dist, runs))
+    first = np.ones(len(best), dtype=bool)
+    first[1:] = runs[best][1:] != runs[best][:-1]
+    best = best[first]
+
+    # Stage 3: refine
+    lo = t[np.maximum(k[best] - 1, 0)]
+    hi = t[np.minimum(k[best] + 1, len(t) - 1)]
+    tca, miss, speed = _refineClosestApproach(prop, pi[best], pj[best], lo, hi, tolerance)
+    ok = miss <= threshold
+    if verbose:
+        print("Refined %d runs; %d within %.3f km" % (len(best), np.count_nonzero(ok), threshold))
+
+    gi = idx[pi[best][ok]]
+    gj = idx[pj[best][ok]]
+    out = np.zeros(len(gi), dtype=outDtype)
+    out["name1"] = [names[i] for i in gi.tolist()]
+    out["name2"] = [names[j] for j in gj.tolist()]
+    out["satnumber1"] = decoded["satnumber"][gi]
+    out["satnumber2"] = decoded["satnumber"][gj]
+    out["tca"] = np.round(tca[ok] * 1e3).astype("datetime64[ms]")
+    out["miss_km"] = miss[ok]
+    out["relative_speed_km_s"] = speed[ok]
+    return out[np.argsort(out["miss_km"], kind="stable")]
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory Earth orientation parameter series, interpolated at arbitrary (fractional) MJDs.
+
+The latest-vintage value of every parameter is loaded once per source, from its latest-value table,
+into sorted NumPy arrays, so that repeated lookups (e.g. inside frame conversions) do not touch the database.
+"""
+
+import os
+import time
+import numpy as np
+
+from bulletindatabase import BulletinDatabase
+
+#%%
+class EopSeries:
+    """
+    Interpolates polar motion, DUT1, LOD and the nutation corrections for one bulletin source.
+
+    Example
+    -------
+    d = BulletinDatabase("bulletins.db")
+    eop = EopSeries(d, "dailyiau2000")
+    pmx, pmy = eop.polarMotion(60000.25)
+    dut1 = eop.dut1(np.linspace(60000, 60010, 1000))
+    """
+    # Columns that are interpolated; the nutation columns are taken from the table format
+    # as they differ between the IAU1980 (dpsi/deps) and IAU2000 (dX/dY) layouts
+    pm_cols = ["A_pmx_arcsec", "A_pmy_arcsec"]
+    dut1_col = "A_dut1_sec"
+    lod_col = "A_lod_msec"
+
+    def __init__(self, db: BulletinDatabase, src: str, sidecar: str=None, recheckInterval: float=60.0):
+        """
+        Parameters
+        ----------
+        db : BulletinDatabase
+            Database to load from.
+        src : str
+            Bulletin source e.g. 'dailyiau2000'.
+        sidecar : str, optional
+            Path of a .npz file to cache the arrays in. If it matches the database contents,
+            it is loaded instead of querying the table.
+        recheckInterval : float, optional
+            Minimum seconds between checks for table changes. The default is 60.
+        """
+        self.db = db
+        self.src = src
+        self.sidecar = sidecar
+        self.recheckInterval = recheckInterval
+
+        fmtcols = [col[0] for col in BulletinDatabase._getFmt(src)['cols']]
+        self.nutation_cols = [fmtcols[16], fmtcols[18]]
+        self.cols = self.pm_cols + [self.dut1_col, self.lod_col] + self.nutation_cols
+
+        self._signature = None
+        self._lastCheck = None
+        self.mjd = None
+        self.values = None
+        self._dut1Steps = None
+
+    #%% Loading
+    def _getSignature(self):
+        # The latest-value table only changes along with the history
+        return self.db.getHistorySignature(self.src)
+
+    def _ensureLoaded(self):
+        # Only look at the table every so often, since this is called for every lookup
+        now = time.monotonic()
+        if self._lastCheck is not None and now - self._lastCheck < self.recheckInterval:
+            return
+        self._lastCheck = now
+
+        signature = self._getSignature()
+        if signature != self._signature or self.mjd is None:
+            self.reload(signature)
+
+    def reload(self, signature=None):
+        """
+        (Re)loads the arrays, from the side-car file if it is current, or else from the table.
+        """
+        signature = self._getSignature() if signature is None else signature
+
+        if self.sidecar is not None and os.path.exists(self.sidecar):
+            with np.load(self.sidecar) as npz:
+                if str(npz["signature"]) == signature:
+                    self._setArrays(npz["mjd"], {col: npz[col] for col in self.cols}, signature)
+                    return
+
+        mjd, values = self._loadFromTable()
+        self._setArrays(mjd, values, signature)
+
+        if self.sidecar is not None:
+            np.savez(self.sidecar, mjd=mjd, signature=signature, **values)
+
+    def _loadFromTable(self):
+        # The latest-value table already holds the newest vintage of each column per MJD
+        self.db.makeLatestTable(self.src)
+        self.db.execute(
+            "select mjd, %s from %s order by mjd" % (", ".join(self.cols), self.db._latestTablename(self.src))
+        )
+        rows = self.db.fetchall()
+        if len(rows) == 0:
+            return np.zeros(0), {col: np.zeros(0) for col in self.cols}
+
+        table = np.array([tuple(row) for row in rows], dtype=np.float64) # Nones become NaNs
+        values = {col: np.ascontiguousarray(table[:, 1 + i]) for i, col in enumerate(self.cols)}
+
+        return table[:, 0], values
+
+    def _setArrays(self, mjd: np.ndarray, values: dict, signature):
+        self.mjd = mjd
+        self.values = values
+        self._signature = signature
+
+        # DUT1 jumps by a whole second at leap seconds, so interpolate it without the jumps
+        dut1 = values[self.dut1_col]
+        valid = np.flatnonzero(~np.isnan(dut1))
+        jumps = np.round(np.diff(dut1[valid]))
+        steps = np.zeros(len(dut1))
+        # Each jump applies from the first day after it onwards
+        steps[valid[1:]] = np.where(np.abs(jumps) >= 1, jumps, 0)
+        self._dut1Steps = np.cumsum(steps)
+
+        # The non-blank samples of each column, so the lookups don't rebuild them on every call
+        self._valid = {}
+        for col, y in values.items():
+            keep = ~np.isnan(y)
+            self._valid[col] = (mjd[keep], y[keep])
+        self._dut1Smooth = (mjd[valid], (dut1 - self._dut1Steps)[valid])
+
+    #%% Interpolation
+    def interpolate(self, mjd, col: str):
+        """
+        Linearly interpolates a column at the given MJD(s). Returns NaN outside the loaded range,
+        and interpolates across any blank values.
+        """
+        self._ensureLoaded()
+        x = np.asarray(mjd, dtype=np.float64)
+        xp, fp = self._valid[col]
+        if len(xp) == 0:
+            out = np.full(x.shape, np.nan)
+        else:
+            out = np.interp(x, xp, fp, left=np.nan, right=np.nan)
+        return out if out.ndim > 0 else float(out)
+
+    def polarMotion(self, mjd):
+        """
+        Returns (pmx, pmy) in arcseconds.
+        """
+        return self.interpolate(mjd, self.pm_cols[0]), self.interpolate(mjd, self.pm_cols[1])
+
+    def dut1(self, mjd):
+        """
+        Returns UT1-UTC in seconds, with leap second jumps applied at the day boundary.
+        """
+        self._ensureLoaded()
+        x = np.asarray(mjd, dtype=np.float64)
+        xp, fp = self._dut1Smooth
+        if len(xp) == 0:
+            out = np.full(x.shape, np.nan)
+        else:
+            smooth = np.interp(x, xp, fp, left=np.nan, right=np.nan)
+            idx = np.clip(np.searchsorted(self.mjd, x, side="right") - 1, 0, len(self.mjd) - 1)
+            out = smooth + self._dut1Steps[idx]
+        return out if out.ndim > 0 else float(out)
+
+    def lod(self, mjd):
+        """
+        Returns the excess length of day in milliseconds.
+        """
+        return self.interpolate(mjd, self.lod_col)
+
+    def nutation(self, mjd):
+        """
+        Returns the nutation corrections in milliarcseconds; (dpsi, deps) for IAU1980 sources
+        and (dX, dY) for IAU2000 sources.
+        """
+        return self.interpolate(mjd, self.nutation_cols[0]), self.interpolate(mjd, self.nutation_cols[1])
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of exported TLE database files, and per-user watermarks for delta exports.
+
+Exports are keyed by the selection of tables, the time window and the database high-water mark,
+so repeated requests for unchanged data reuse the same file. Delta exports only contain the rows
+retrieved since the user's last download. Snapshots of the whole catalog as of an instant are
+cached in the same directory, see exportAsOf().
+"""
+
+import os
+import json
+import hashlib
+
+from tledatabase import TleDatabase
+
+#%%
+class ExportCache:
+    """
+    Serves exports of a TleDatabase from a directory of cached database files.
+
+    Example
+    -------
+    cache = ExportCache(d, "exports")
+    path = cache.export(["geo_MUOS-3"], start=1672800000)
+    path, upto = cache.exportDelta(userid, ["geo_MUOS-3"])
+    ... # Send the file
+    cache.commitDelta(userid, ["geo_MUOS-3"], upto)
+    path = cache.exportAsOf(1672790400, fmt="tle") # Catalog as of 2023-01-04 00:00 UTC
+    """
+    # File formats for exportAsOf()
+    asOfFormats = ("db", "tle", "npz")
+
+    def __init__(self, db: TleDatabase, cachedir: str, maxEntries: int=32, watermarkpath: str=None):
+        """
+        Parameters
+        ----------
+        db : TleDatabase
+            Database to export from.
+        cachedir : str
+            Directory to keep the exported files in. Created if necessary.
+        maxEntries : int, optional
+            Number of files to keep; the least recently used are removed first. The default is 32.
+        watermarkpath : str, optional
+            JSON file to persist the per-user watermarks in. The default is "watermarks.json" in cachedir.
+        """
+        self.db = db
+        self.cachedir = cachedir
+        self.maxEntries = maxEntries
+        self.watermarkpath = watermarkpath if watermarkpath is not None else os.path.join(cachedir, "watermarks.json")
+        os.makedirs(cachedir, exist_ok=True)
+
+        # User ID -> table name -> latest time_retrieved already sent
+        self.watermarks = dict()
+        if os.path.exists(self.watermarkpath):
+            with open(self.watermarkpath, "r") as fid:
+                self.watermarks = json.load(fid)
+
+    #%% Cached exports
+    def _makeKey(self, *spec):
+        # e.g. table names and window starts fully determine the contents, together with the high-water mark
+        spec = json.dumps(spec)
+        return hashlib.blake2s(spec.encode("utf-8"), digest_size=16).hexdigest()
+
+    def _exportWindows(self, windows: dict, stop: float=None):
+        # Export each table from its own start time, grouping tables that share one
+        mark = self.db.getHighWaterMark(list(windows))
+        path = os.path.join(self.cachedir, "%s.db" % self._makeKey(sorted(windows.items()), stop, mark))
+
+        if os.path.exists(path):
+            os.utime(path) # Mark as recently used
+            return path
+
+        # Build into a temporary file first, so a partial export is never served
+        tmppath = path + ".tmp"
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        groups = dict()
+        for tablename, start in windows.items():
+            groups.setdefault(start, []).append(tablename)
+        for start, tablenames in groups.items():
+            self.db.exportTables(sorted(tablenames), tmppath, start, stop)
+        os.replace(tmppath, path)
+
+        self._evict()
+        return path
+
+    def export(self, tablenames: list, start: float=None, stop: float=None):
+        """
+        Returns the path of a database file containing the tables' rows in the time window,
+        exporting it only if there is no cached file for the current state of the database.
+        The file belongs to the cache and should not be deleted by the caller.
+        """
+        return self._exportWindows({tablename: start for tablename in tablenames}, stop)
+
+    def exportAsOf(self, T: float, by: str="time_retrieved", src: str=None, fmt: str="db"):
+        """
+        Returns the path of a file with the TLE of every satellite that was current at an instant,
+        see TleDatabase.getTlesAsOf(). Files stay valid until TLEs from before the instant are
+        inserted, so frequently used instants (e.g. midnights) are only materialized once.
+        The file belongs to the cache and should not be deleted by the caller.
+
+        Parameters
+        ----------
+        T : float
+            Instant in Unix seconds.
+        by : str, optional
+            'time_retrieved' or 'epoch'. The default is 'time_retrieved'.
+        src : str, optional
+            Only include satellites from this source. The default is None.
+        fmt : str, optional
+            'db' for a database file, see TleDatabase.exportAsOf(); 'tle' for 3LE text, see
+            TleCatalog.toText(); 'npz' for arrays, see TleCatalog.save() and TleCatalog.load().
+            The text and array formats have one TLE per name across sources. The default is 'db'.
+        """
+        if fmt not in self.asOfFormats:
+            raise ValueError("fmt must be one of %s, not %s" % (self.asOfFormats, fmt))
+        mark = self.db.getAsOfMark(T, by, src)
+        path = os.path.join(self.cachedir, "%s.%s" % (self._makeKey("asof", T, by, src, mark), fmt))
+
+        if os.path.exists(path):
+            os.utime(path) # Mark as recently used
+            return path
+
+        tmppath = path + ".tmp"
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        if fmt == "db":
+            self.db.exportAsOf(T, tmppath, by, src)
+        elif fmt == "tle":
+            self.db.getCatalogAsOf(T, by, src).toText(tmppath)
+        else:
+            with open(tmppath, "wb") as fid: # A path would have .npz appended
+                self.db.getCatalogAsOf(T, by, src).save(fid)
+        os.replace(tmppath, path)
+
+        self._evict()
+        return path
+
+    def _evict(self):
+        # Remove the least recently used exports beyond the limit
+        paths = [os.path.join(self.cachedir, f) for f in os.listdir(self.cachedir) if f.endswith((".db", ".tle", ".npz"))]
+        paths.sort(key=os.path.getmtime, reverse=True)
+        for path in paths[self.maxEntries:]:
+            os.remove(path)
+
+    #%% Delta exports
+    def exportDelta(self, userid: int, tablenames: list):
+        """
+        Exports only the rows retrieved since the user's last committed download of each table.
+        Tables the user has not downloaded before are exported in full.
+        Rows inserted later with an older time_retrieved (e.g. from a backfill) are not picked up.
+
+        Returns
+        -------
+        path : str
+            Path of the exported file, or None if there are no new rows.
+        upto : int
+            Latest time_retrieved included; pass it to commitDelta() once the file has been delivered.
+        """
+        usermarks = self.watermarks.get(str(userid), dict())
+        upto = self.db.getMaxTimeRetrieved(tablenames)
+        windows = {tablename: usermarks.get(tablename) for tablename in tablenames}
+
+        if upto is None or all(mark is not None and mark >= upto for mark in windows.values()):
+            return None, upto
+
+        # Fix the end of the window, so the watermark matches what was exported
+        return self._exportWindows(windows, upto + 1), upto
+
+    def commitDelta(self, userid: int, tablenames: list, upto: int):
+        """
+        Records that the user has received the tables' rows up to the given time_retrieved.
+        """
+        if upto is None:
+            return
+        usermarks = self.watermarks.setdefault(str(userid), dict())
+        for tablename in tablenames:
+            usermarks[tablename] = upto
+
+        tmppath = self.watermarkpath + ".tmp"
+        with open(tmppath, "w") as fid:
+            json.dump(self.watermarks, fid)
+        os.replace(tmppath, self.watermarkpath)
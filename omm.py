@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Ingestion of CelesTrak GP data in the OMM CSV and JSON formats.
+
+The records are read column by column, converted with NumPy, and then written out as TLE lines,
+so that they can be stored exactly like data downloaded with FORMAT=tle.
+Catalog numbers above 99999 are written in the Alpha-5 scheme.
+"""
+
+import io
+import csv
+import json
+import numpy as np
+
+from tledatabase import TleDatabase
+from tlecatalog import TleCatalog
+
+#%% Readers
+def readOmmCsv(datasrc: str):
+    """
+    Reads OMM CSV text into a dictionary of column name to list of strings.
+    """
+    reader = csv.reader(io.StringIO(datasrc.strip()))
+    header = next(reader, None)
+    if header is None:
+        return dict()
+    rows = [row for row in reader if len(row) == len(header)]
+    if len(rows) == 0:
+        return {key: [] for key in header}
+    # Transpose once, rather than building a dictionary per row
+    return dict(zip(header, (list(column) for column in zip(*rows))))
+
+def readOmmJson(datasrc: str):
+    """
+    Reads OMM JSON text (a list of records) into a dictionary of column name to list of values.
+    """
+    records = json.loads(datasrc)
+    if len(records) == 0:
+        return dict()
+    return {key: [record.get(key) for record in records] for key in records[0]}
+
+#%% Conversion to TLE lines
+def _floats(values):
+    return np.array([v if v not in (None, "") else 0 for v in values], dtype=np.float64)
+
+def _ints(values):
+    return _floats(values).astype(np.int64)
+
+def _derivativeFits(values):
+    # The field has no integer digit, so only magnitudes that round to below 1 can be written
+    return np.round(np.abs(values), 8) < 1.0
+
+def _formatDerivative(values):
+    # Fields like ' .00001234' i.e. sign and no leading zero
+    if not _derivativeFits(values).all():
+        raise ValueError("Mean motion derivatives of magnitude 1 or more cannot be written in a TLE.")
+    return ["%s%s" % ("-" if v < 0 else " ", ("%.8f" % abs(v))[1:]) for v in values.tolist()]
+
+def _formatImpliedDecimal(values):
+    # Fields like ' 12345-3' meaning 0.12345e-3, as per tlearrays._impliedDecimal()
+    absvalues = np.abs(values)
+    nonzero = absvalues > 0
+    exponent = np.zeros(len(values), dtype=np.int64)
+    exponent[nonzero] = np.floor(np.log10(absvalues[nonzero])).astype(np.int64) + 1
+    mantissa = np.round(absvalues / 10.0**exponent * 1e5).astype(np.int64)
+    # Rounding may carry over into another digit
+    carry = mantissa >= 100000
+    mantissa[carry] //= 10
+    exponent[carry] += 1
+    # The exponent is a single digit; magnitudes below 1e-10 are written as zero
+    underflow = (exponent < -9) | (mantissa == 0)
+    mantissa[underflow] = 0
+    exponent[underflow] = 0
+    if (exponent > 9).any():
+        raise ValueError("Values of magnitude 1e9 or more cannot be written in a TLE.")
+    return [
+        "%s%05d%s%d" % ("-" if v < 0 and m > 0 else " ", m, "-" if e <= 0 else "+", abs(e))
+        for v, m, e in zip(values.tolist(), mantissa.tolist(), exponent.tolist())
+    ]
+
+def _checksums(lines: list):
+    # Sum of the digits, with each '-' counting as 1, modulo 10
+    block = np.array(lines, dtype="S68").view(np.uint8).reshape(-1, 68)
+    isdigit = (block >= 48) & (block <= 57)
+    total = np.where(isdigit, block.astype(np.int64) - 48, 0).sum(axis=1) + (block == 45).sum(axis=1)
+    return (total % 10).tolist()
+
+def ommToTles(columns: dict):
+    """
+    Converts OMM columns (from readOmmCsv() or readOmmJson()) to TLE lines.
+
+    Returns
+    -------
+    TleCatalog
+        Object names to [line1, line2], in the same format as TleDatabase.parseTleData().
+        Records whose catalog numbers or mean motion derivatives cannot be written in a TLE are skipped.
+    """
+    if len(columns) == 0 or len(columns["NORAD_CAT_ID"]) == 0:
+        return TleCatalog()
+
+    satnumbers = _ints(columns["NORAD_CAT_ID"])
+    valid = satnumbers <= TleDatabase.alpha5_max
+    if not valid.all():
+        print("Skipping %d records with catalog numbers above %d" % (
+            np.count_nonzero(~valid), TleDatabase.alpha5_max))
+
+    ndots = _floats(columns["MEAN_MOTION_DOT"])
+    ndotFits = _derivativeFits(ndots)
+    if not ndotFits.all():
+        print("Skipping %d records with mean motion derivatives of magnitude 1 or more" % (
+            np.count_nonzero(~ndotFits)))
+        valid &= ndotFits
+    satnums = [TleDatabase.toAlpha5(n) if ok else "" for n, ok in zip(satnumbers.tolist(), valid.tolist())]
+
+    # Epochs as 2-digit year and fractional day of year
+    epochs = np.array(columns["EPOCH"], dtype="datetime64[us]")
+    years = epochs.astype("datetime64[Y]")
+    epochdays = (epochs - years.astype("datetime64[us]")) / np.timedelta64(86400000000, "us") + 1.0
+    epochyrs = (years.astype(np.int64) + 1970) % 100
+
+    # International designators e.g. '1998-067A' becomes '98067A'
+    designators = [
+        ("%s%s" % (i[2:4], i[5:])) if i is not None and len(i) > 5 else "" for i in columns.get(
+            "OBJECT_ID", [None] * len(satnums))
+    ]
+    classifications = [c or "U" for c in columns.get("CLASSIFICATION_TYPE", ["U"] * len(satnums))]
+    ephemtypes = _ints(columns.get("EPHEMERIS_TYPE", [0] * len(satnums)))
+    elsets = _ints(columns.get("ELEMENT_SET_NO", [0] * len(satnums))) % 10000
+    ndot = _formatDerivative(np.where(ndotFits, ndots, 0.0)) # Skipped records are blanked
+    nddot = _formatImpliedDecimal(_floats(columns["MEAN_MOTION_DDOT"]))
+    bstar = _formatImpliedDecimal(_floats(columns["BSTAR"]))
+
+    inclinations = _floats(columns["INCLINATION"])
+    raans = _floats(columns["RA_OF_ASC_NODE"])
+    eccentricities = np.round(_floats(columns["ECCENTRICITY"]) * 1e7).astype(np.int64)
+    argps = _floats(columns["ARG_OF_PERICENTER"])
+    meananomalies = _floats(columns["MEAN_ANOMALY"])
+    meanmotions = _floats(columns["MEAN_MOTION"])
+    revs = _ints(columns["REV_AT_EPOCH"]) % 100000
+
+    line1s = [
+        "1 %5s%1s %-8s %02d%012.8f %10s %8s %8s %1d %4d" % row for row in zip(
+            satnums, classifications, designators, epochyrs.tolist(), epochdays.tolist(),
+            ndot, nddot, bstar, ephemtypes.tolist(), elsets.tolist())
+    ]
+    line2s = [
+        "2 %5s %8.4f %8.4f %07d %8.4f %8.4f %11.8f%5d" % row for row in zip(
+            satnums, inclinations.tolist(), raans.tolist(), eccentricities.tolist(),
+            argps.tolist(), meananomalies.tolist(), meanmotions.tolist(), revs.tolist())
+    ]
+
+    names = [name.strip() for name in columns["OBJECT_NAME"]]
+    line1s = ["%s%d" % (line1, check) for line1, check in zip(line1s, _checksums(line1s))]
+    line2s = ["%s%d" % (line2, check) for line2, check in zip(line2s, _checksums(line2s))]
+    keep = np.flatnonzero(valid)
+    return TleCatalog([names[i] for i in keep.tolist()], np.array(line1s)[keep], np.array(line2s)[keep])
+
+def parseOmmData(datasrc: str, fmt: str):
+    """
+    Parses OMM text in the given format ('csv' or 'json') into the format of TleDatabase.parseTleData().
+    """
+    if fmt == "csv":
+        return ommToTles(readOmmCsv(datasrc))
+    elif fmt == "json":
+        return ommToTles(readOmmJson(datasrc))
+    else:
+        raise ValueError("Unknown OMM format %s; expected 'csv' or 'json'." % fmt)
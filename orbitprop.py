@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorized orbit propagation of many TLEs at once, and the Earth-fixed frame helpers needed to use it.
+
+SGP4 is used through the sgp4 package's SatrecArray if it is installed. Otherwise a J2 secular
+two-body propagation of the mean elements is used, which drifts by kilometres per day; that is
+adequate for visibility and screening at coarse tolerances, but install sgp4 for anything finer.
+
+Times are floats of seconds since the Unix epoch (UTC) throughout; see toUnixSeconds().
+Positions are in km, in TEME (or the mean-of-date frame for the J2 fallback, which is close enough).
+"""
+
+import datetime as dt
+
+import numpy as np
+
+from tlearrays import decodeTles
+
+#%% Constants
+MU_EARTH = 398600.4418 # km^3/s^2
+R_EARTH = 6378.137 # km, WGS84 equatorial radius
+J2 = 1.08262668e-3
+OMEGA_EARTH = 7.292115e-5 # rad/s
+WGS84_F = 1.0 / 298.257223563
+SECONDS_PER_DAY = 86400.0
+UNIX_EPOCH_JD = 2440587.5
+
+#%% Element-derived quantities
+def semiMajorAxis(meanMotion):
+    """
+    Returns the semi-major axis in km, from the mean motion in revolutions per day.
+    """
+    n = np.asarray(meanMotion, dtype=np.float64) * 2.0 * np.pi / SECONDS_PER_DAY
+    with np.errstate(divide="ignore"):
+        return np.cbrt(MU_EARTH / n**2)
+
+def apsides(meanMotion, eccentricity):
+    """
+    Returns the perigee and apogee radii in km, from the mean motion (rev/day) and eccentricity.
+    Subtract R_EARTH for altitudes.
+    """
+    a = semiMajorAxis(meanMotion)
+    e = np.asarray(eccentricity, dtype=np.float64)
+    return a * (1.0 - e), a * (1.0 + e)
+
+# Semi-major axis band taken as geosynchronous, around the 42164 km of a sidereal-day orbit
+GEO_SMA_BAND = (41664.0, 42664.0)
+
+def orbitalRegime(sma, eccentricity, apogeeAlt):
+    """
+    Labels orbits as 'LEO' (apogee altitude up to 2000 km), 'GEO' (semi-major axis in GEO_SMA_BAND),
+    'MEO' (in between), or 'HEO' (eccentricity of 0.25 or more, or beyond the geosynchronous band).
+    """
+    sma = np.asarray(sma, dtype=np.float64)
+    e = np.asarray(eccentricity, dtype=np.float64)
+    apogeeAlt = np.asarray(apogeeAlt, dtype=np.float64)
+    return np.select(
+        [e >= 0.25, apogeeAlt <= 2000.0, (sma >= GEO_SMA_BAND[0]) & (sma <= GEO_SMA_BAND[1]), sma < GEO_SMA_BAND[0]],
+        ["HEO", "LEO", "GEO", "MEO"],
+        "HEO"
+    )
+
+#%% Time and frames
+def toUnixSeconds(t):
+    """
+    Converts datetimes (naive UTC or aware), datetime64s, or numbers (already seconds) to Unix seconds.
+    """
+    if isinstance(t, dt.datetime):
+        if t.tzinfo is None:
+            t = t.replace(tzinfo=dt.timezone.utc)
+        return t.timestamp()
+    t = np.asarray(t)
+    if np.issubdtype(t.dtype, np.datetime64):
+        return (t - np.datetime64(0, "us")) / np.timedelta64(1, "s")
+    return t.astype(np.float64)
+
+def gmst(t, dut1=0.0):
+    """
+    Greenwich mean sidereal time (IAU-82) in radians, for Unix seconds t (UTC) and UT1-UTC in seconds.
+    """
+    jd = UNIX_EPOCH_JD + (np.asarray(t, dtype=np.float64) + dut1) / SECONDS_PER_DAY
+    T = (jd - 2451545.0) / 36525.0
+    seconds = 67310.54841 + (876600.0 * 3600.0 + 8640184.812866) * T + 0.093104 * T**2 - 6.2e-6 * T**3
+    return np.mod(seconds, SECONDS_PER_DAY) * (2.0 * np.pi / SECONDS_PER_DAY)
+
+def temeToEcef(r, t, dut1=0.0):
+    """
+    Rotates TEME positions (..., 3) at times t (broadcastable to r.shape[:-1]) into the Earth-fixed frame.
+    Polar motion is ignored, which is well below a metre at the surface.
+    """
+    theta = gmst(t, dut1)
+    c = np.cos(theta)
+    s = np.sin(theta)
+    out = np.empty(np.broadcast_shapes(r.shape, np.shape(theta) + (3,)))
+    out[..., 0] = c * r[..., 0] + s * r[..., 1]
+    out[..., 1] = -s * r[..., 0] + c * r[..., 1]
+    out[..., 2] = r[..., 2]
+    return out
+
+def geodeticToEcef(lat, lon, alt=0.0):
+    """
+    Converts WGS84 geodetic latitude and longitude (degrees) and altitude (km) to Earth-fixed positions (..., 3),
+    and also returns the local up unit vectors.
+    """
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lon = np.radians(np.asarray(lon, dtype=np.float64))
+    e2 = WGS84_F * (2.0 - WGS84_F)
+    N = R_EARTH / np.sqrt(1.0 - e2 * np.sin(lat)**2)
+    up = np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+    pos = np.stack([
+        (N + alt) * np.cos(lat) * np.cos(lon),
+        (N + alt) * np.cos(lat) * np.sin(lon),
+        (N * (1.0 - e2) + alt) * np.sin(lat)
+    ], axis=-1)
+    return pos, up
+
+#%% Propagation
+def _solveKepler(M, e, iterations: int=10):
+    E = np.where(e < 0.8, M, np.pi)
+    for _ in range(iterations):
+        E = E - (E - e * np.sin(E) - M) / (1.0 - e * np.cos(E))
+    return E
+
+class OrbitPropagator:
+    """
+    Propagates many TLEs at once.
+
+    Example
+    -------
+    prop = OrbitPropagator(catalog.line1, catalog.line2)
+    r = prop.positions(toUnixSeconds(start) + np.arange(0, 3600, 60)) # (N, 60, 3)
+    """
+    def __init__(self, line1, line2, useSgp4: bool=None):
+        """
+        Parameters
+        ----------
+        line1 : array_like
+            First lines, as str/bytes or an 'S69' array.
+        line2 : array_like
+            Second lines, same length as line1.
+        useSgp4 : bool, optional
+            Use the sgp4 package. The default is None, which uses it if it is installed.
+        """
+        self.line1 = np.asarray(line1, dtype="S69").reshape(-1)
+        self.line2 = np.asarray(line2, dtype="S69").reshape(-1)
+        self.decoded = decodeTles(self.line1, self.line2)
+
+        if useSgp4 is None:
+            try:
+                import sgp4.api # noqa: F401
+                useSgp4 = True
+            except ImportError:
+                useSgp4 = False
+        self.useSgp4 = useSgp4
+
+        if useSgp4:
+            from sgp4.api import Satrec, SatrecArray
+            self._satrecs = [Satrec.twoline2rv(l1.decode(), l2.decode()) for l1, l2 in zip(self.line1.tolist(), self.line2.tolist())]
+            self._satrecArray = SatrecArray(self._satrecs) if len(self._satrecs) > 0 else None
+        else:
+            self._setSecularRates()
+
+    def __len__(self):
+        return len(self.line1)
+
+    def subset(self, idx):
+        """
+        Returns a propagator for the selected TLEs.
+        """
+        return type(self)(self.line1[idx], self.line2[idx], self.useSgp4)
+
+    @property
+    def epochs(self):
+        """
+        TLE epochs in Unix seconds.
+        """
+        return toUnixSeconds(self.decoded["epoch"])
+
+    #%% J2 secular fallback
+    def _setSecularRates(self):
+        d = self.decoded
+        n = d["mean_motion_revperday"] * 2.0 * np.pi / SECONDS_PER_DAY # rad/s
+        e = d["eccentricity"]
+        inc = np.radians(d["inclination_deg"])
+        a = semiMajorAxis(d["mean_motion_revperday"])
+        p = a * (1.0 - e**2)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            k = 1.5 * J2 * (R_EARTH / p)**2 * n
+
+        self._el = {
+            "a": a, "e": e, "inc": inc,
+            "raan": np.radians(d["right_ascension_deg"]),
+            "argp": np.radians(d["argument_perigee_deg"]),
+            "M": np.radians(d["mean_anomaly_deg"]),
+            "raandot": -k * np.cos(inc),
+            "argpdot": k * (2.0 - 2.5 * np.sin(inc)**2),
+            "Mdot": n + k * np.sqrt(1.0 - e**2) * (1.0 - 1.5 * np.sin(inc)**2),
+            # The TLE field is half the first derivative of the mean motion, in rev/day^2
+            "Mddot": d["mean_motion_firstderiv"] * 2.0 * np.pi / SECONDS_PER_DAY**2,
+            "epoch": self.epochs
+        }
+
+    def _secularPositions(self, idx, t):
+        # idx and t broadcast together; returns positions of shape broadcast(idx, t) + (3,)
+        el = {key: value[idx] for key, value in self._el.items()}
+        dt_ = t - el["epoch"]
+        M = el["M"] + el["Mdot"] * dt_ + el["Mddot"] * dt_**2
+        raan = el["raan"] + el["raandot"] * dt_
+        argp = el["argp"] + el["argpdot"] * dt_
+        e = el["e"]
+        E = _solveKepler(np.mod(M, 2.0 * np.pi), e)
+        xp = el["a"] * (np.cos(E) - e)
+        yp = el["a"] * np.sqrt(1.0 - e**2) * np.sin(E)
+
+        cO, sO = np.cos(raan), np.sin(raan)
+        cw, sw = np.cos(argp), np.sin(argp)
+        ci, si = np.cos(el["inc"]), np.sin(el["inc"])
+        return np.stack([
+            xp * (cO * cw - sO * sw * ci) - yp * (cO * sw + sO * cw * ci),
+            xp * (sO * cw + cO * sw * ci) - yp * (sO * sw - cO * cw * ci),
+            xp * (sw * si) + yp * (cw * si)
+        ], axis=-1)
+
+    #%% Public interface
+    @staticmethod
+    def _julian(t):
+        days = np.asarray(t, dtype=np.float64) / SECONDS_PER_DAY
+        whole = np.floor(days)
+        return UNIX_EPOCH_JD + whole, days - whole
+
+    def positions(self, t):
+        """
+        Returns the positions of every TLE at every time, shaped (N, T, 3). Failed propagations are NaN.
+        """
+        t = np.asarray(t, dtype=np.float64).reshape(-1)
+        if len(self) == 0:
+            return np.zeros((0, len(t), 3))
+        if not self.useSgp4:
+            return self._secularPositions(np.arange(len(self))[:, None], t[None, :])
+
+        jd, fr = self._julian(t)
+        err, r, _ = self._satrecArray.sgp4(jd, fr)
+        r[err != 0] = np.nan
+        return r
+
+    def positionsAt(self, idx, t):
+        """
+        Returns the positions of TLE idx[k] at time t[k], shaped (K, 3). Failed propagations are NaN.
+        """
+        idx = np.asarray(idx, dtype=np.int64).reshape(-1)
+        t = np.broadcast_to(np.asarray(t, dtype=np.float64), idx.shape)
+        if not self.useSgp4:
+            return self._secularPositions(idx, t)
+
+        out = np.full((len(idx), 3), np.nan)
+        jd, fr = self._julian(t)
+        # One call per satellite, over all of its requested times
+        order = np.argsort(idx, kind="stable")
+        unique, starts = np.unique(idx[order], return_index=True)
+        for sat, rows in zip(unique.tolist(), np.split(order, starts[1:])):
+            err, r, _ = self._satrecs[sat].sgp4_array(jd[rows], fr[rows])
+            r[err != 0] = np.nan
+            out[rows] = r
+        return out
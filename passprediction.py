@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""
+Ground-station pass prediction for a whole catalog of TLEs.
+
+Rather than finely propagating every satellite, the search narrows down in stages:
+1. Satellites that can never be seen from a station are pruned using only their elements:
+   the highest latitude the visibility footprint reaches (from the inclination and apogee),
+   and for geosynchronous orbits, the band of longitudes they drift over during the window.
+2. The survivors are propagated on a coarse time grid in vectorized batches, and each local
+   maximum of elevation near or above the mask is taken as a candidate pass.
+3. Culminations are refined by golden-section search, and rise and set times by bisection,
+   for all candidates at once.
+
+Example
+-------
+catalog = d.getLatestCatalog()
+stations = {"SG": (1.35, 103.8, 0.0), "LDN": (51.5, -0.1, 0.05)}
+passes = predictPasses(catalog, stations, dt.datetime(2024, 1, 1), dt.datetime(2024, 1, 2))
+"""
+
+import numpy as np
+
+from orbitprop import (OrbitPropagator, R_EARTH, OMEGA_EARTH, SECONDS_PER_DAY,
+                       apsides, gmst, temeToEcef, geodeticToEcef, toUnixSeconds)
+
+#%% Output format
+def makePassDtype(namewidth: int, stationwidth: int):
+    return np.dtype([
+        ("name", "U%d" % max(namewidth, 1)),
+        ("satnumber", np.int32),
+        ("station", "U%d" % max(stationwidth, 1)),
+        ("rise", "datetime64[ms]"),
+        ("culmination", "datetime64[ms]"),
+        ("set", "datetime64[ms]"),
+        ("max_elevation_deg", np.float64),
+        # Passes already in progress at the start, or not over by the end, are cut at the window
+        ("truncated", np.bool_)
+    ])
+
+def _toDatetime64(t):
+    return (np.round(np.asarray(t) * 1e3)).astype("datetime64[ms]")
+
+#%% Pruning
+def _footprintHalfAngle(radius, minElevation):
+    # Earth central angle from the sub-satellite point to where the satellite is at the elevation mask
+    el = np.radians(minElevation)
+    return np.arccos(np.clip(R_EARTH / radius * np.cos(el), -1.0, 1.0)) - el
+
+def pruneCandidates(decoded: np.ndarray, stationLatLon: np.ndarray, start: float, stop: float,
+                    minElevation: float=10.0, margin: float=1.0):
+    """
+    Returns a boolean array (satellites, stations) of the pairs that may have a pass in the window,
+    using only the orbital elements. Errs on the side of keeping pairs.
+
+    Parameters
+    ----------
+    decoded : np.ndarray
+        Structured array of tlearrays.tle_dtype.
+    stationLatLon : np.ndarray
+        Station latitudes and longitudes in degrees, shaped (stations, 2).
+    start : float
+        Start of the window in Unix seconds.
+    stop : float
+        End of the window in Unix seconds.
+    minElevation : float, optional
+        Elevation mask in degrees. The default is 10.
+    margin : float, optional
+        Angular margin in degrees, for the secular drift the checks do not model. The default is 1.
+    """
+    perigee, apogee = apsides(decoded["mean_motion_revperday"], decoded["eccentricity"])
+    valid = (decoded["mean_motion_revperday"] > 0) & (decoded["eccentricity"] < 1.0) & (perigee > R_EARTH)
+
+    # The furthest the footprint reaches from the ground track, which is widest at apogee
+    reach = np.degrees(_footprintHalfAngle(np.where(valid, apogee, R_EARTH), minElevation)) + margin
+    inc = decoded["inclination_deg"]
+    maxLat = np.minimum(inc, 180.0 - inc)
+    lat = np.radians(stationLatLon[:, 0])
+    keep = valid[:, None] & (np.abs(stationLatLon[None, :, 0]) <= maxLat[:, None] + reach[:, None])
+
+    # Geosynchronous orbits stay within a band of longitudes, over which they drift slowly
+    geo = valid & (np.abs(decoded["mean_motion_revperday"] - 1.00273791) < 0.05) & (decoded["eccentricity"] < 0.05)
+    if geo.any():
+        g = decoded[geo]
+        epoch = toUnixSeconds(g["epoch"])
+        n = g["mean_motion_revperday"] * 2.0 * np.pi / SECONDS_PER_DAY
+        # Right ascension minus sidereal angle, for a near-circular, near-equatorial orbit
+        lon0 = np.radians(g["right_ascension_deg"] + g["argument_perigee_deg"] + g["mean_anomaly_deg"]) - gmst(epoch)
+        drift = n - OMEGA_EARTH
+        lonStart = lon0 + drift * (start - epoch)
+        sweep = np.abs(drift) * (stop - start)
+        lonLow = np.where(drift >= 0, lonStart, lonStart - sweep)
+
+        # Shortest longitude difference from each station to the swept band
+        offset = np.mod(np.radians(stationLatLon[None, :, 1]) - lonLow[:, None], 2.0 * np.pi)
+        dlon = np.where(offset <= sweep[:, None], 0.0, np.minimum(offset - sweep[:, None], 2.0 * np.pi - offset))
+        # Central angle to the nearest equatorial point of the band, less the latitude excursion
+        angle = np.degrees(np.arccos(np.cos(lat)[None, :] * np.cos(dlon))) - g["inclination_deg"][:, None]
+        keep[geo] &= (angle <= reach[geo][:, None]) | (sweep[:, None] >= 2.0 * np.pi)
+
+    return keep
+
+#%% Search
+class _Elevations:
+    # Elevation of satellites above stations, for the grid and for refinement at arbitrary times
+    def __init__(self, prop: OrbitPropagator, stationPos: np.ndarray, stationUp: np.ndarray, eop=None):
+        self.prop = prop
+        self.stationPos = stationPos
+        self.stationUp = stationUp
+        self.eop = eop
+
+    def _dut1(self, t):
+        if self.eop is None:
+            return 0.0
+        dut1 = self.eop.dut1(np.asarray(t) / SECONDS_PER_DAY + 40587.0)
+        return np.nan_to_num(dut1) # Zero outside the bulletins' coverage
+
+    def elevation(self, ecef, station):
+        rho = ecef - self.stationPos[station]
+        sinel = np.sum(rho * self.stationUp[station], axis=-1) / np.linalg.norm(rho, axis=-1)
+        return np.degrees(np.arcsin(sinel))
+
+    def grid(self, sats, t):
+        # (len(sats), len(t)) Earth-fixed positions; elevations are taken per station from these
+        r = self.prop.subset(sats).positions(t) if len(sats) != len(self.prop) else self.prop.positions(t)
+        return temeToEcef(r, t[None, :], self._dut1(t))
+
+    def at(self, sats, stations, t):
+        r = self.prop.positionsAt(sats, t)
+        return self.elevation(temeToEcef(r, t, self._dut1(t)), stations)
+
+_golden = (np.sqrt(5.0) - 1.0) / 2.0
+
+def _refineMaximum(elev: _Elevations, sats, stations, lo, hi, tolerance: float):
+    # Golden-section search for the elevation maximum in [lo, hi], for all candidates at once
+    a = lo.copy()
+    b = hi.copy()
+    c = b - _golden * (b - a)
+    d = a + _golden * (b - a)
+    fc = elev.at(sats, stations, c)
+    fd = elev.at(sats, stations, d)
+    while np.max(b - a, initial=0.0) > tolerance:
+        left = fc > fd # The maximum is in [a, d] if so, otherwise in [c, b]
+        a, b = np.where(left, a, c), np.where(left, d, b)
+        # The surviving interior point is reused, so only one new evaluation is needed per step
+        newc = b - _golden * (b - a)
+        newd = a + _golden * (b - a)
+        f = elev.at(sats, stations, np.where(left, newc, newd))
+        c, d = np.where(left, newc, d), np.where(left, c, newd)
+        fc, fd = np.where(left, f, fd), np.where(left, fc, f)
+    tmax = (a + b) / 2.0
+    return tmax, elev.at(sats, stations, tmax)
+
+def _bisectCrossing(elev: _Elevations, sats, stations, below, above, minElevation: float, tolerance: float):
+    # Bisection for the time the elevation crosses the mask, between a time below and a time above it
+    below = below.copy()
+    above = above.copy()
+    while np.max(np.abs(above - below), initial=0.0) > tolerance:
+        mid = (below + above) / 2.0
+        up = elev.at(sats, stations, mid) >= minElevation
+        above = np.where(up, mid, above)
+        below = np.where(up, below, mid)
+    return (below + above) / 2.0
+
+def predictPasses(catalog, stations: dict, start, stop, minElevation: float=10.0, step: float=60.0,
+                  batchSize: int=256, tolerance: float=0.5, eop=None, verbose: bool=False):
+    """
+    Predicts every pass of every satellite in a catalog over a set of ground stations.
+
+    Parameters
+    ----------
+    catalog : TleCatalog or dict
+        Satellite names to [line1, line2], e.g. from TleDatabase.getLatestCatalog().
+    stations : dict
+        Station names to (latitude_deg, longitude_deg, altitude_km), geodetic WGS84.
+    start : datetime, datetime64 or float
+        Start of the window (UTC, or Unix seconds).
+    stop : datetime, datetime64 or float
+        End of the window.
+    minElevation : float, optional
+        Elevation mask in degrees. The default is 10.
+    step : float, optional
+        Coarse grid step in seconds. Passes much shorter than this, that barely clear the mask,
+        may be missed. The default is 60.
+    batchSize : int, optional
+        Satellites propagated together on the grid. The default is 256.
+    tolerance : float, optional
+        Tolerance of the refined times in seconds. The default is 0.5.
+    eop : EopSeries, optional
+        Used for UT1-UTC in the Earth rotation. The default is None, which takes UT1 as UTC.
+    verbose : bool, optional
+        Print the progress of each stage. The default is False.
+
+    Returns
+    -------
+    np.ndarray
+        Structured array of makePassDtype(), sorted by rise time.
+    """
+    from tlecatalog import TleCatalog
+    if not isinstance(catalog, TleCatalog):
+        catalog = TleCatalog.fromDict(catalog)
+    start = float(toUnixSeconds(start))
+    stop = float(toUnixSeconds(stop))
+    names = catalog.names
+    stationNames = list(stations)
+    stationArr = np.array([stations[s] for s in stationNames], dtype=np.float64).reshape(-1, 3)
+    stationPos, stationUp = geodeticToEcef(stationArr[:, 0], stationArr[:, 1], stationArr[:, 2])
+    passDtype = makePassDtype(max([len(n) for n in names], default=1), max([len(s) for s in stationNames], default=1))
+
+    # Stage 1: prune by elements alone
+    keep = pruneCandidates(catalog.decoded, stationArr[:, :2], start, stop, minElevation)
+    survivors = np.flatnonzero(keep.any(axis=1))
+    if verbose:
+        print("Pruned to %d of %d satellites, %d of %d satellite-station pairs" % (
+            len(survivors), len(catalog), np.count_nonzero(keep), keep.size))
+    if len(survivors) == 0:
+        return np.zeros(0, dtype=passDtype)
+
+    prop = OrbitPropagator(catalog.line1[survivors], catalog.line2[survivors])
+    elev = _Elevations(prop, stationPos, stationUp, eop)
+    t = np.arange(start, stop, step)
+    t = np.append(t, stop) if t[-1] < stop else t
+    # Grid peaks this far below the mask are still refined, as the true maximum may lie between samples
+    peakMargin = 5.0
+
+    # Stage 2: coarse grid, collecting candidate peaks as (satellite, station, grid index)
+    cand = []
+    gridEls = dict() # (satellite, station) -> grid elevations, for finding rise and set brackets later
+    for b0 in range(0, len(survivors), batchSize):
+        sats = np.arange(b0, min(b0 + batchSize, len(survivors)))
+        ecef = elev.grid(sats, t)
+        for s in range(len(stationNames)):
+            rows = np.flatnonzero(keep[survivors[sats], s])
+            if len(rows) == 0:
+                continue
+            el = elev.elevation(ecef[rows], s)
+            el = np.where(np.isnan(el), -90.0, el)
+            # Local maxima, including at either end of the window
+            padded = np.pad(el, ((0, 0), (1, 1)), constant_values=-np.inf)
+            peak = (el >= padded[:, :-2]) & (el >= padded[:, 2:]) & (el > minElevation - peakMargin)
+            r, k = np.nonzero(peak)
+            if len(r) == 0:
+                continue
+            for row in np.unique(r).tolist():
+                gridEls[(int(sats[rows[row]]), s)] = el[row]
+            cand.append(np.stack([sats[rows[r]], np.full(len(r), s), k], axis=1))
+    if len(cand) == 0:
+        return np.zeros(0, dtype=passDtype)
+    cand = np.concatenate(cand)
+    if verbose:
+        print("Refining %d candidate peaks" % len(cand))
+
+    # Stage 3: refine the culminations, and keep those that clear the mask
+    csat, cst, k = cand[:, 0], cand[:, 1], cand[:, 2]
+    lo = t[np.maximum(k - 1, 0)]
+    hi = t[np.minimum(k + 1, len(t) - 1)]
+    tmax, elmax = _refineMaximum(elev, csat, cst, lo, hi, tolerance)
+    ok = elmax >= minElevation
+    csat, cst, tmax, elmax = csat[ok], cst[ok], tmax[ok], elmax[ok]
+
+    # Rise and set brackets from the grid: the last sample below the mask before the culmination,
+    # and the first after it
+    riseLo = np.empty(len(csat))
+    riseHi = np.empty(len(csat))
+    setLo = np.empty(len(csat))
+    setHi = np.empty(len(csat))
+    truncated = np.zeros(len(csat), dtype=bool)
+    riseIdx = np.empty(len(csat), dtype=np.int64)
+    for i, (sat, st, tm) in enumerate(zip(csat.tolist(), cst.tolist(), tmax.tolist())):
+        el = gridEls[(sat, st)]
+        kmax = np.searchsorted(t, tm)
+        below = np.flatnonzero(el[:kmax] < minElevation)
+        if len(below) == 0:
+            riseIdx[i] = -1
+            riseLo[i] = riseHi[i] = start
+            truncated[i] = True
+        else:
+            j = below[-1]
+            riseIdx[i] = j
+            riseLo[i], riseHi[i] = t[j], min(t[j + 1], tm)
+        after = np.flatnonzero(el[kmax:] < minElevation)
+        if len(after) == 0:
+            setLo[i] = setHi[i] = stop
+            truncated[i] = True
+        else:
+            j = kmax + after[0]
+            setLo[i], setHi[i] = max(t[j - 1], tm), t[j]
+
+    rise = np.where(riseIdx >= 0, _bisectCrossing(elev, csat, cst, riseLo, riseHi, minElevation, tolerance), start)
+    sett = np.where(setLo < setHi, _bisectCrossing(elev, csat, cst, setHi, setLo, minElevation, tolerance), stop)
+
+    # Several grid peaks can fall in one pass; keep the highest
+    order = np.lexsort((-elmax, riseIdx, cst, csat))
+    key = np.stack([csat, cst, riseIdx], axis=1)[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = np.any(key[1:] != key[:-1], axis=1)
+    sel = order[first]
+
+    out = np.zeros(len(sel), dtype=passDtype)
+    out["name"] = [names[i] for i in survivors[csat[sel]].tolist()]
+    out["satnumber"] = catalog.decoded["satnumber"][survivors[csat[sel]]]
+    out["station"] = [stationNames[i] for i in cst[sel].tolist()]
+    out["rise"] = _toDatetime64(rise[sel])
+    out["culmination"] = _toDatetime64(tmax[sel])
+    out["set"] = _toDatetime64(sett[sel])
+    out["max_elevation_deg"] = elmax[sel]
+    out["truncated"] = truncated[sel]
+    return out[np.argsort(out["rise"], kind="stable")]
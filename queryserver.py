@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+"""
+Local asyncio HTTP server for TLE and EOP lookups, so that many processes can share one warmed
+set of database connections and in-memory indexes instead of each opening the databases.
+
+Concurrent TLE requests are coalesced (identical ones are answered once) and batched into
+compound SQL queries. Responses are JSON by default, or binary with format=bin.
+
+Endpoints
+---------
+GET /tle?name=<name>[&name=<name>...][&src=<src>][&time=<time_retrieved>][&format=json|bin]
+    The TLE retrieved nearest to the time (default now) for each name. Binary responses are
+    tlearrays.tle_dtype records, all zeros where nothing was found.
+GET /eop?src=<src>&mjd=<mjd>[,<mjd>...][&format=json|bin]
+    Interpolated EOPs, see eopseries.py. Binary responses are float64 rows of
+    (mjd, pmx, pmy, dut1, lod, nutation1, nutation2).
+GET /teme2ecef?src=<src>&start=<mjd>&stop=<mjd>
+    Daily parameters over a range, see BulletinDatabase.getTeme2EcefParamsRange().
+GET /health
+
+Examples
+--------
+python queryserver.py serve --tledb tles.db --bulletindb bulletins.db --port 8765
+python queryserver.py loadtest --port 8765 --names "ISS (ZARYA)" "MUOS-3" --concurrency 50 --requests 5000
+"""
+
+import asyncio
+import argparse
+import json
+import math
+import time
+import sqlite3 as sq
+import datetime as dt
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+
+#%% Request batching
+class RequestBatcher:
+    """
+    Collects requests made within a short window and answers them with one call.
+    Identical keys that are pending together are only looked up once.
+    """
+    def __init__(self, func, window: float=0.002, maxBatch: int=512):
+        """
+        Parameters
+        ----------
+        func : callable
+            Called with a list of unique keys; returns a dictionary of key to result.
+            Keys missing from the dictionary get None.
+        window : float, optional
+            Seconds to wait for more requests after the first. The default is 0.002.
+        maxBatch : int, optional
+            Number of unique keys at which the batch is run immediately. The default is 512.
+        """
+        self.func = func
+        self.window = window
+        self.maxBatch = maxBatch
+        self._pending = dict() # key -> list of futures
+        self._handle = None
+        self.numBatches = 0
+        self.numKeys = 0
+
+    async def submit(self, key):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.setdefault(key, []).append(future)
+
+        if len(self._pending) >= self.maxBatch:
+            self._flush()
+        elif self._handle is None:
+            self._handle = loop.call_later(self.window, self._flush)
+
+        return await future
+
+    def _flush(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        pending = self._pending
+        self._pending = dict()
+        if len(pending) == 0:
+            return
+
+        self.numBatches += 1
+        self.numKeys += len(pending)
+        try:
+            results = self.func(list(pending))
+        except Exception as e:
+            for futures in pending.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+
+        for key, futures in pending.items():
+            for future in futures:
+                if not future.done():
+                    future.set_result(results.get(key))
+
+#%% Lookups
+class UnknownSourceError(LookupError):
+    """
+    Raised for a bulletin source that the database does not hold; served as 404.
+    """
+    pass
+
+class QueryService:
+    """
+    Holds the open databases and their in-memory indexes, and answers the lookups.
+    """
+    def __init__(self, tledbpath: str=None, bulletindbpath: str=None, dedup: bool=False, window: float=0.002):
+        self.tledb = None
+        self.bulletindb = None
+        self.satIndex = None
+        self._dataVersion = None
+        self.eops = dict()
+
+        if tledbpath is not None:
+            from tledatabase import TleDatabase
+            from satsearch import SatelliteSearchIndex
+            self.tledb = TleDatabase(tledbpath, dedup=dedup)
+            self.satIndex = SatelliteSearchIndex()
+            self._refreshIndex()
+        if bulletindbpath is not None:
+            from bulletindatabase import BulletinDatabase
+            self.bulletindb = BulletinDatabase(bulletindbpath)
+
+        self.tleBatcher = RequestBatcher(self._lookupTles, window)
+
+    def _refreshIndex(self):
+        # data_version changes when another connection (e.g. the updater) commits
+        self.tledb.execute("pragma data_version")
+        version = self.tledb.fetchone()[0]
+        if version == self._dataVersion:
+            return
+        self._dataVersion = version
+        self.tledb.reloadTables()
+        self.satIndex.update(self.tledb.satelliteTablenames)
+
+    def _resolveTables(self, name: str, src: str):
+        # Same matching as TleDatabase.getSatelliteTle(), but from the in-memory index
+        if src is not None:
+            tablename = "%s_%s" % (src, name)
+            return [tablename] if tablename in self.satIndex else []
+        return self.satIndex.contains(name)
+
+    def _lookupTles(self, keys: list):
+        # keys are (name, src, time); one batched query for every candidate table of every key
+        self._refreshIndex()
+        now = int(dt.datetime.utcnow().timestamp())
+        candidates = dict()
+        for key in keys:
+            name, src, nearest = key
+            nearest = now if nearest is None else nearest
+            candidates[key] = [(tablename, nearest) for tablename in self._resolveTables(name, src)]
+
+        rows = self.tledb.getNearestTles([req for reqs in candidates.values() for req in reqs])
+
+        results = dict()
+        for key, reqs in candidates.items():
+            # Pick the closest in time over the matching tables, as getSatelliteTle() does
+            best = None
+            for req in reqs:
+                row = rows.get(req)
+                if row is not None and (best is None or abs(row[0] - req[1]) < abs(best[1][0] - req[1])):
+                    best = (req[0], row)
+            if best is not None:
+                results[key] = {
+                    "table": best[0], "time_retrieved": best[1][0], "line1": best[1][1], "line2": best[1][2]}
+        return results
+
+    async def getTles(self, names: list, src: str=None, nearest: int=None):
+        return await asyncio.gather(*[self.tleBatcher.submit((name, src, nearest)) for name in names])
+
+    def checkBulletinSrc(self, src: str):
+        """
+        Raises UnknownSourceError unless the bulletin database holds the source.
+        """
+        if src not in self.bulletindb.bulletinSrcs:
+            # It may have been made by another connection since the database was opened
+            self.bulletindb.reloadTables()
+            if src not in self.bulletindb.bulletinSrcs:
+                raise UnknownSourceError("Unknown bulletin source %s" % (src))
+
+    def getEopSeries(self, src: str):
+        if src not in self.eops:
+            self.checkBulletinSrc(src) # Before anything is made and cached for it
+            from eopseries import EopSeries
+            self.eops[src] = EopSeries(self.bulletindb, src)
+        return self.eops[src]
+
+#%% HTTP handling
+def _jsonable(value):
+    # NaN is not valid JSON
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+def _makeResponse(status: str, body: bytes, contentType: str, keepAlive: bool):
+    header = "HTTP/1.1 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: %s\r\n\r\n" % (
+        status, contentType, len(body), "keep-alive" if keepAlive else "close")
+    return header.encode("latin-1") + body
+
+class QueryServer:
+    """
+    Minimal HTTP/1.1 server (GET only, with keep-alive) over a QueryService.
+    Listens on TCP, or on a Unix socket if a path is given.
+    """
+    def __init__(self, service: QueryService, host: str="127.0.0.1", port: int=8765, unixPath: str=None):
+        self.service = service
+        self.host = host
+        self.port = port
+        self.unixPath = unixPath
+        self._server = None
+
+    async def start(self):
+        if self.unixPath is not None:
+            self._server = await asyncio.start_unix_server(self._handleConnection, path=self.unixPath)
+            print("Serving on %s" % (self.unixPath))
+        else:
+            self._server = await asyncio.start_server(self._handleConnection, self.host, self.port)
+            self.port = self._server.sockets[0].getsockname()[1] # In case port 0 was given
+            print("Serving on http://%s:%d" % (self.host, self.port))
+
+    async def serveForever(self):
+        await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handleConnection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                lines = head.decode("latin-1").split("\r\n")
+                method, target, version = (lines[0].split(" ") + ["", "", ""])[:3]
+                headers = dict(
+                    (k.strip().lower(), v.strip()) for k, _, v in (line.partition(":") for line in lines[1:] if line))
+                # Bodies are not used, but must be consumed to keep the connection in sync
+                length = int(headers.get("content-length", 0))
+                if length > 0:
+                    await reader.readexactly(length)
+                keepAlive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+
+                status, body, contentType = await self._dispatch(method, target)
+                writer.write(_makeResponse(status, body, contentType, keepAlive))
+                await writer.drain()
+                if not keepAlive:
+                    break
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method: str, target: str):
+        if method != "GET":
+            return "405 Method Not Allowed", b"", "text/plain"
+        url = urlsplit(target)
+        query = parse_qs(url.query)
+        binary = query.get("format", ["json"])[0] == "bin"
+        try:
+            if url.path == "/tle":
+                return await self._handleTle(query, binary)
+            elif url.path == "/eop":
+                return self._handleEop(query, binary)
+            elif url.path == "/teme2ecef":
+                return self._handleTeme2Ecef(query)
+            elif url.path == "/health":
+                return "200 OK", b'{"status": "ok"}', "application/json"
+            else:
+                return "404 Not Found", b"", "text/plain"
+        except UnknownSourceError as e:
+            return "404 Not Found", json.dumps({"error": str(e)}).encode(), "application/json"
+        except KeyError as e:
+            return "400 Bad Request", json.dumps({"error": "Missing parameter %s" % str(e)}).encode(), "application/json"
+        except (ValueError, TypeError) as e:
+            return "400 Bad Request", json.dumps({"error": str(e)}).encode(), "application/json"
+        except sq.Error as e:
+            return "500 Internal Server Error", json.dumps({"error": str(e)}).encode(), "application/json"
+
+    async def _handleTle(self, query: dict, binary: bool):
+        if self.service.tledb is None:
+            raise ValueError("No TLE database is being served.")
+        names = query["name"]
+        src = query.get("src", [None])[0]
+        nearest = int(float(query["time"][0])) if "time" in query else None
+        results = await self.service.getTles(names, src, nearest)
+
+        if binary:
+            from tlearrays import decodeTles, tle_dtype
+            found = [i for i, r in enumerate(results) if r is not None]
+            out = np.zeros(len(results), dtype=tle_dtype)
+            if len(found) > 0:
+                out[found] = decodeTles(
+                    [results[i]["line1"] for i in found], [results[i]["line2"] for i in found],
+                    [results[i]["time_retrieved"] for i in found])
+            return "200 OK", out.tobytes(), "application/octet-stream"
+
+        body = [dict(name=name, **result) if result is not None else None for name, result in zip(names, results)]
+        return "200 OK", json.dumps(body).encode(), "application/json"
+
+    def _handleEop(self, query: dict, binary: bool):
+        if self.service.bulletindb is None:
+            raise ValueError("No bulletin database is being served.")
+        eop = self.service.getEopSeries(query["src"][0])
+        mjd = np.array([float(m) for value in query["mjd"] for m in value.split(",")])
+        pmx, pmy = eop.polarMotion(mjd)
+        nut1, nut2 = eop.nutation(mjd)
+        columns = [mjd, pmx, pmy, eop.dut1(mjd), eop.lod(mjd), nut1, nut2]
+
+        if binary:
+            return "200 OK", np.column_stack(columns).astype(np.float64).tobytes(), "application/octet-stream"
+
+        names = ["mjd", "pmx_arcsec", "pmy_arcsec", "dut1_sec", "lod_msec"] + eop.nutation_cols
+        body = {name: [_jsonable(v) for v in column.tolist()] for name, column in zip(names, columns)}
+        return "200 OK", json.dumps(body).encode(), "application/json"
+
+    def _handleTeme2Ecef(self, query: dict):
+        if self.service.bulletindb is None:
+            raise ValueError("No bulletin database is being served.")
+        self.service.checkBulletinSrc(query["src"][0])
+        arrays = self.service.bulletindb.getTeme2EcefParamsRange(
+            query["src"][0], float(query["start"][0]), float(query["stop"][0]))
+        names = ["mjd", "tr_pol", "pmx_arcsec", "pmy_arcsec", "dut1_sec", "tr_lod", "mjd_lod", "lod_msec"]
+        body = {name: [_jsonable(v) for v in array.tolist()] for name, array in zip(names, arrays)}
+        return "200 OK", json.dumps(body).encode(), "application/json"
+
+#%% Load testing
+async def runLoadTest(paths: list, host: str="127.0.0.1", port: int=8765, unixPath: str=None,
+                      concurrency: int=50, requests: int=5000):
+    """
+    Sends GET requests for the given paths (cycled) from concurrent keep-alive connections,
+    and returns throughput and latency statistics.
+    """
+    import httpx
+    transport = httpx.AsyncHTTPTransport(uds=unixPath) if unixPath is not None else None
+    latencies = []
+    errors = 0
+    counter = iter(range(requests))
+
+    async def worker(client):
+        nonlocal errors
+        for i in counter:
+            t0 = time.perf_counter()
+            try:
+                r = await client.get(paths[i % len(paths)])
+                if r.status_code != 200:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append(time.perf_counter() - t0)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url="http://%s:%d" % (host, port), limits=limits, transport=transport) as client:
+        t0 = time.perf_counter()
+        await asyncio.gather(*[worker(client) for _ in range(concurrency)])
+        elapsed = time.perf_counter() - t0
+
+    latencies = np.array(latencies) * 1e3
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": elapsed,
+        "requests_per_sec": len(latencies) / elapsed,
+        "latency_ms_p50": float(np.percentile(latencies, 50)),
+        "latency_ms_p99": float(np.percentile(latencies, 99)),
+    }
+
+#%%
+def main(argv: list=None):
+    parser = argparse.ArgumentParser(description="Local TLE/EOP query server.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    p = subparsers.add_parser("serve", help="Run the server.")
+    p.add_argument("--tledb", help="TLE database path.")
+    p.add_argument("--bulletindb", help="Bulletin database path.")
+    p.add_argument("--dedup", action="store_true", help="The TLE database uses the deduplicated layout.")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8765)
+    p.add_argument("--unix", help="Listen on this Unix socket path instead.")
+    p.add_argument("--window", type=float, default=0.002, help="Batching window in seconds.")
+
+    p = subparsers.add_parser("loadtest", help="Load test a running server.")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8765)
+    p.add_argument("--unix", help="Connect to this Unix socket path instead.")
+    p.add_argument("--names", nargs="*", default=[], help="Satellite names to query.")
+    p.add_argument("--eop", help="Bulletin source to also query EOPs from.")
+    p.add_argument("--concurrency", type=int, default=50)
+    p.add_argument("--requests", type=int, default=5000)
+
+    args = parser.parse_args(argv)
+    if args.command == "serve":
+        service = QueryService(args.tledb, args.bulletindb, args.dedup, args.window)
+        server = QueryServer(service, args.host, args.port, args.unix)
+        asyncio.run(server.serveForever())
+    else:
+        from urllib.parse import quote
+        paths = ["/tle?name=%s" % quote(name) for name in args.names]
+        if args.eop is not None:
+            paths.append("/eop?src=%s&mjd=%f" % (args.eop, time.time() / 86400.0 + 40587.0))
+        if len(paths) == 0:
+            parser.error("Specify --names and/or --eop.")
+        stats = asyncio.run(runLoadTest(paths, args.host, args.port, args.unix, args.concurrency, args.requests))
+        print(json.dumps(stats, indent=2))
+
+if __name__ == "__main__":
+    main()
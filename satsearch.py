@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory n-gram index over satellite table names and NORAD IDs, for quick lookups and
+ranked fuzzy suggestions (e.g. for the bot's /add command).
+"""
+
+import re
+from collections import Counter
+
+#%%
+class SatelliteSearchIndex:
+    """
+    Indexes keys such as satellite table names "<src>_<name>" by their character n-grams.
+
+    Example
+    -------
+    index = SatelliteSearchIndex()
+    index.update(tledb.satelliteTablenames)
+    index.search("starlnk 1007", k=5)
+    """
+    def __init__(self, n: int=3):
+        self.n = n
+        self._postings = dict() # n-gram -> set of keys
+        self._grams = dict() # key -> set of n-grams
+        self._norms = dict() # key -> normalized text
+        self._ids = dict() # satellite number -> set of keys
+
+    def __len__(self):
+        return len(self._grams)
+
+    def __contains__(self, key: str):
+        return key in self._grams
+
+    #%% Building
+    @staticmethod
+    def _normalize(text: str):
+        # Case and punctuation are ignored for fuzzy matching
+        return " ".join(re.split("[^0-9a-z]+", text.lower())).strip()
+
+    def _makeGrams(self, text: str, normalized: bool=False):
+        # Pad so that short queries and word starts/ends still produce n-grams
+        padded = " %s " % (text if normalized else self._normalize(text))
+        return set(padded[i:i+self.n] for i in range(max(len(padded) - self.n + 1, 1)))
+
+    def add(self, key: str, satnumber: int=None):
+        """
+        Adds a key to the index, optionally with its NORAD satellite number.
+        """
+        if key not in self._grams:
+            self._norms[key] = self._normalize(key)
+            grams = self._makeGrams(self._norms[key], normalized=True)
+            self._grams[key] = grams
+            for gram in grams:
+                self._postings.setdefault(gram, set()).add(key)
+
+        if satnumber is not None:
+            self._ids.setdefault(int(satnumber), set()).add(key)
+
+    def remove(self, key: str):
+        """
+        Removes a key from the index.
+        """
+        grams = self._grams.pop(key, None)
+        if grams is None:
+            return
+        del self._norms[key]
+        for gram in grams:
+            self._postings[gram].discard(key)
+            if len(self._postings[gram]) == 0:
+                del self._postings[gram]
+        for keys in self._ids.values():
+            keys.discard(key)
+
+    def update(self, keys: list):
+        """
+        Incrementally synchronises the index with the given keys.
+
+        Returns
+        -------
+        added : list
+            Keys that were not previously indexed. Use add() to attach their satellite numbers.
+        """
+        keys = set(keys)
+        for key in set(self._grams) - keys:
+            self.remove(key)
+        added = [key for key in keys if key not in self._grams]
+        for key in added:
+            self.add(key)
+        return added
+
+    #%% Lookups
+    def contains(self, text: str):
+        """
+        Returns all keys containing the text exactly, or matching it as a satellite number.
+        Only keys sharing every n-gram of the text are checked.
+        """
+        results = set()
+        if text.strip().isdigit():
+            results.update(self._ids.get(int(text), set()))
+
+        # Padding n-grams need not appear mid-key, so don't require them
+        inner = [g for g in self._makeGrams(text) if not g.startswith(" ") and not g.endswith(" ")]
+        if len(inner) > 0:
+            postings = sorted((self._postings.get(g, set()) for g in inner), key=len)
+            candidates = set.intersection(*postings)
+        else:
+            # Too short to have any n-grams, so check everything
+            candidates = self._grams.keys()
+        results.update(key for key in candidates if text in key)
+
+        return sorted(results)
+
+    def search(self, query: str, k: int=10):
+        """
+        Returns the top-k keys ranked by n-gram similarity to the query.
+
+        Returns
+        -------
+        list
+            List of (key, score) with scores in [0, 1], best first.
+        """
+        scores = dict()
+        # Satellite numbers are exact matches
+        if query.strip().isdigit():
+            for key in self._ids.get(int(query), set()):
+                scores[key] = 1.0
+
+        grams = self._makeGrams(query)
+        counts = Counter()
+        for gram in grams:
+            counts.update(self._postings.get(gram, ()))
+
+        # Jaccard similarity of the n-gram sets, with a bonus for containing the query outright
+        normquery = self._normalize(query)
+        for key, common in counts.items():
+            score = common / (len(grams) + len(self._grams[key]) - common)
+            if normquery in self._norms[key]:
+                score = 0.5 + 0.5 * score
+            scores[key] = max(scores.get(key, 0.0), score)
+
+        return sorted(scores.items(), key=lambda i: (-i[1], i[0]))[:k]
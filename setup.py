@@ -1,8 +1,29 @@
-from distutils.core import setup
+from setuptools import setup
 setup(
     name="tledb",
     version="1.0",
     py_modules=[
+        "asyncfetch",
+        "backfill",
         "bulletindatabase",
-        "tledatabase"],
-    )
\ No newline at end of file
+        "conjunctions",
+        "eopseries",
+        "exportcache",
+        "omm",
+        "orbitprop",
+        "passprediction",
+        "queryserver",
+        "satsearch",
+        "sharedcatalog",
+        "tlearrays",
+        "tlecatalog",
+        "tledatabase",
+        "tledbcli",
+        "tlereader",
+        "updatescheduler"],
+    entry_points={
+        "console_scripts": [
+            "tledb=tledbcli:main"
+        ]
+    },
+    )
@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+"""
+Shared-memory snapshot of the latest TLE of every satellite, for multi-process consumers.
+
+A publisher writes each snapshot into its own multiprocessing.shared_memory block, as a NumPy
+structured array sorted by name, together with an index by satellite number. A small header
+block holds a version counter that names the current snapshot block, so that readers can attach
+to it without copying and detect when a newer snapshot has been published.
+
+Snapshot blocks are never modified once published; the publisher only unlinks old ones.
+
+Example
+-------
+# In the updating process
+d = TleDatabase("tles.db")
+publisher = SharedCatalogPublisher("tlecatalog")
+publisher.publishFrom(d)
+d.addUpdateHook(publisher.publishFrom) # Republish after every update
+
+# In each worker
+reader = SharedCatalogReader("tlecatalog")
+rec = reader.find("ISS (ZARYA)")
+...
+if reader.refresh():
+    print("Now at version %d" % reader.version)
+"""
+
+import os
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from tlearrays import tle_dtype, decodeTles
+
+#%% Block layouts
+header_dtype = np.dtype([
+    ("version", np.int64), # 0 means nothing has been published yet
+    ("published", np.float64),
+    ("count", np.int64)
+])
+
+# Each snapshot block starts with (count, namewidth, srcwidth, reserved), followed by the records,
+# the sorted satellite numbers, and the record index of each of those numbers
+_meta_dtype = np.dtype((np.int64, 4))
+
+def makeRecordDtype(namewidth: int, srcwidth: int):
+    """
+    Returns the record dtype of a snapshot: the name, source and TLE lines, followed by the
+    decoded fields of tlearrays.tle_dtype.
+    """
+    return np.dtype([
+        ("name", "S%d" % max(namewidth, 1)),
+        ("src", "S%d" % max(srcwidth, 1)),
+        ("line1", "S69"),
+        ("line2", "S69")
+    ] + [(field, tle_dtype.fields[field][0]) for field in tle_dtype.names])
+
+def _align(offset: int, alignment: int=8):
+    return (offset + alignment - 1) // alignment * alignment
+
+def _layout(count: int, recordDtype: np.dtype):
+    # Offsets of the records, numbers and number index, and the total size
+    recordsOffset = _align(_meta_dtype.itemsize)
+    numbersOffset = _align(recordsOffset + count * recordDtype.itemsize)
+    orderOffset = _align(numbersOffset + count * 4)
+    return recordsOffset, numbersOffset, orderOffset, orderOffset + count * 4
+
+def _blockName(name: str, version: int):
+    return "%s_%d" % (name, version)
+
+def _attachShm(name: str):
+    # Attaching must not register the block for cleanup, or it is unlinked when the reader exits
+    try:
+        return shared_memory.SharedMemory(name=name, track=False) # Python 3.13+
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        if os.name == "posix":
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+#%% Publisher
+class SharedCatalogPublisher:
+    """
+    Publishes snapshots of the latest TLEs into shared memory. There should be one per name.
+    """
+    def __init__(self, name: str="tlecatalog", keep: int=2):
+        """
+        Parameters
+        ----------
+        name : str, optional
+            Name of the header block; snapshot blocks are named "<name>_<version>".
+            The default is "tlecatalog".
+        keep : int, optional
+            Number of snapshot blocks to keep linked, so that readers that have just read the
+            version can still attach to it. The default is 2.
+        """
+        self.name = name
+        self.keep = max(keep, 1)
+        self._blocks = [] # Oldest first
+
+        try:
+            self._headerShm = shared_memory.SharedMemory(name=name, create=True, size=header_dtype.itemsize)
+            self.header = np.frombuffer(self._headerShm.buf, dtype=header_dtype, count=1)
+            self.header[0] = (0, 0.0, 0)
+        except FileExistsError:
+            # Left behind by a previous publisher; carry on from its version so readers see a change
+            self._headerShm = shared_memory.SharedMemory(name=name)
+            self.header = np.frombuffer(self._headerShm.buf, dtype=header_dtype, count=1)
+            print("Reusing existing shared catalog header %s at version %d" % (name, self.version))
+
+    @property
+    def version(self):
+        return int(self.header["version"][0])
+
+    def publish(self, tles: dict):
+        """
+        Publishes a snapshot and returns its version.
+
+        Parameters
+        ----------
+        tles : dict
+            Table name i.e. "<src>_<name>" to (time_retrieved, line1, line2),
+            as returned by TleDatabase.getLatestTles().
+        """
+        tablenames = list(tles)
+        srcs, names = zip(*(i.split("_", 1) for i in tablenames)) if len(tablenames) > 0 else ((), ())
+        names = np.array([i.encode("utf-8") for i in names], dtype=bytes)
+        srcs = np.array([i.encode("utf-8") for i in srcs], dtype=bytes)
+        recordDtype = makeRecordDtype(names.dtype.itemsize, srcs.dtype.itemsize)
+        count = len(tablenames)
+
+        version = self.version + 1
+        recordsOffset, numbersOffset, orderOffset, size = _layout(count, recordDtype)
+        try:
+            shm = shared_memory.SharedMemory(name=_blockName(self.name, version), create=True, size=size)
+        except FileExistsError:
+            # A previous publisher stopped before bumping the version; its block was never read
+            stale = shared_memory.SharedMemory(name=_blockName(self.name, version))
+            stale.close()
+            stale.unlink()
+            shm = shared_memory.SharedMemory(name=_blockName(self.name, version), create=True, size=size)
+
+        meta = np.frombuffer(shm.buf, dtype=_meta_dtype, count=1)
+        meta[0] = (count, recordDtype.fields["name"][0].itemsize, recordDtype.fields["src"][0].itemsize, 0)
+
+        if count > 0:
+            records = np.frombuffer(shm.buf, dtype=recordDtype, count=count, offset=recordsOffset)
+            time_retrieved, line1, line2 = (np.array(i) for i in zip(*(tles[i] for i in tablenames)))
+            decoded = decodeTles(line1.astype("S69"), line2.astype("S69"), time_retrieved)
+
+            # Sorted by name then source, so that names can be looked up by bisection
+            order = np.lexsort((srcs, names))
+            records["name"] = names[order]
+            records["src"] = srcs[order]
+            records["line1"] = line1.astype("S69")[order]
+            records["line2"] = line2.astype("S69")[order]
+            for field in tle_dtype.names:
+                records[field] = decoded[field][order]
+
+            # Index by satellite number
+            numberOrder = np.argsort(records["satnumber"], kind="stable").astype(np.int32)
+            np.frombuffer(shm.buf, dtype=np.int32, count=count, offset=numbersOffset)[:] = records["satnumber"][numberOrder]
+            np.frombuffer(shm.buf, dtype=np.int32, count=count, offset=orderOffset)[:] = numberOrder
+            del records
+        del meta
+
+        # Only bump the version once the block is complete
+        self.header["published"] = time.time()
+        self.header["count"] = count
+        self.header["version"] = version
+
+        self._blocks.append(shm)
+        while len(self._blocks) > self.keep:
+            old = self._blocks.pop(0)
+            old.close()
+            old.unlink()
+
+        return version
+
+    def publishFrom(self, db, src: str=None):
+        """
+        Publishes the latest TLEs of a TleDatabase. Can be registered with TleDatabase.addUpdateHook().
+        """
+        return self.publish(db.getLatestTles(src))
+
+    def close(self, unlink: bool=True):
+        """
+        Closes all blocks, and by default unlinks them so that they are freed once readers detach.
+        """
+        del self.header
+        for shm in self._blocks + [self._headerShm]:
+            shm.close()
+            if unlink:
+                shm.unlink()
+        self._blocks = []
+
+#%% Reader
+class SharedCatalogReader:
+    """
+    Attaches to snapshots published by a SharedCatalogPublisher, without copying them.
+    Arrays returned by the reader are views into shared memory; records is replaced on refresh(),
+    but views taken earlier stay valid for as long as they are referenced.
+    """
+    def __init__(self, name: str="tlecatalog"):
+        self.name = name
+        self._headerShm = _attachShm(name)
+        self.header = np.frombuffer(self._headerShm.buf, dtype=header_dtype, count=1)
+
+        self.version = 0
+        self.records = np.zeros(0, dtype=makeRecordDtype(1, 1))
+        self._numbers = np.zeros(0, dtype=np.int32)
+        self._numberOrder = np.zeros(0, dtype=np.int32)
+        self._shm = None
+        self._retired = []
+        self.refresh()
+
+    def refresh(self, retries: int=10):
+        """
+        Attaches to the newest snapshot if the version has changed. Returns True if it did.
+        """
+        for _ in range(retries):
+            version = int(self.header["version"][0])
+            if version == self.version:
+                return False
+            try:
+                shm = _attachShm(_blockName(self.name, version))
+            except FileNotFoundError:
+                continue # Already replaced by a newer snapshot; read the version again
+            self._setBlock(shm, version)
+            return True
+
+        raise RuntimeError("Could not attach to shared catalog %s; it is being republished too often." % (self.name))
+
+    def _setBlock(self, shm, version: int):
+        count, namewidth, srcwidth, _ = np.frombuffer(shm.buf, dtype=_meta_dtype, count=1)[0].tolist()
+        recordDtype = makeRecordDtype(namewidth, srcwidth)
+        recordsOffset, numbersOffset, orderOffset, _ = _layout(count, recordDtype)
+
+        if self._shm is not None:
+            self._retired.append(self._shm)
+        self._shm = shm
+        self.version = version
+        self.records = np.frombuffer(shm.buf, dtype=recordDtype, count=count, offset=recordsOffset)
+        self._numbers = np.frombuffer(shm.buf, dtype=np.int32, count=count, offset=numbersOffset)
+        self._numberOrder = np.frombuffer(shm.buf, dtype=np.int32, count=count, offset=orderOffset)
+        for arr in (self.records, self._numbers, self._numberOrder):
+            arr.flags.writeable = False # Snapshots are shared and immutable
+        self._closeRetired()
+
+    def _closeRetired(self):
+        # Old blocks can only be closed once no views into them are left
+        remaining = []
+        for shm in self._retired:
+            try:
+                shm.close()
+            except BufferError:
+                remaining.append(shm)
+        self._retired = remaining
+
+    def __len__(self):
+        return len(self.records)
+
+    def find(self, name: str, src: str=None):
+        """
+        Returns the records (a view) for a satellite name, one per source it appears in.
+        """
+        key = name.encode("utf-8")
+        names = self.records["name"]
+        start, stop = np.searchsorted(names, key, "left"), np.searchsorted(names, key, "right")
+        found = self.records[start:stop]
+        if src is not None:
+            found = found[found["src"] == src.encode("utf-8")]
+        return found
+
+    def findNumber(self, satnumber: int):
+        """
+        Returns the records for a satellite number, one per source it appears in.
+        """
+        start, stop = np.searchsorted(self._numbers, satnumber, "left"), np.searchsorted(self._numbers, satnumber, "right")
+        return self.records[self._numberOrder[start:stop]]
+
+    def close(self):
+        """
+        Detaches from shared memory. Views obtained from the reader must be released first.
+        """
+        self.records = self._numbers = self._numberOrder = self.header = None
+        if self._shm is not None:
+            self._retired.append(self._shm)
+            self._shm = None
+        self._retired.append(self._headerShm)
+        self._closeRetired()
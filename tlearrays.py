@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorized decoding of TLE lines into NumPy structured arrays.
+
+Rather than calling TleDatabase.parseTle() per row, every field is sliced out of an (N, 69)
+byte block at once and converted column by column.
+"""
+
+import numpy as np
+
+#%% Array format
+tle_dtype = np.dtype([
+    ("time_retrieved", np.int64),
+    # Line 1 Parameters
+    ("satnumber", np.int32),
+    ("classification", "S1"),
+    ("launch_yr", np.int16),
+    ("launch_number", np.int16),
+    ("launch_piece", "S3"),
+    ("epoch", "datetime64[us]"),
+    ("mean_motion_firstderiv", np.float64),
+    ("mean_motion_secondderiv", np.float64),
+    ("bstar", np.float64),
+    ("ephem_type", np.int8),
+    ("element_set_number", np.int16),
+    # Line 2 Parameters
+    ("inclination_deg", np.float64),
+    ("right_ascension_deg", np.float64),
+    ("eccentricity", np.float64),
+    ("argument_perigee_deg", np.float64),
+    ("mean_anomaly_deg", np.float64),
+    ("mean_motion_revperday", np.float64),
+    ("rev_at_epoch", np.int32)
+])
+
+#%% Field helpers
+def _asBlock(lines):
+    # Accept lists of str/bytes or 'S' arrays, and view as an (N, 69) block of bytes
+    lines = np.asarray(lines, dtype="S69")
+    return np.ascontiguousarray(lines).view(np.uint8).reshape(-1, 69)
+
+def _field(block, start: int, stop: int):
+    return np.ascontiguousarray(block[:, start:stop]).view("S%d" % (stop - start)).reshape(-1)
+
+def _blankTo(field, fill: bytes):
+    # Some optional fields are left blank; substitute before numeric conversion
+    blank = np.char.strip(field) == b""
+    if blank.any():
+        field = np.where(blank, fill, field)
+    return field
+
+def _float(block, start: int, stop: int):
+    return _blankTo(_field(block, start, stop), b"0").astype(np.float64)
+
+def _int(block, start: int, stop: int):
+    return _blankTo(_field(block, start, stop), b"0").astype(np.int64)
+
+def _satnumber(block, start: int):
+    # Alpha-5 numbers replace the leading digit with a letter (skipping I and O) for 10-33
+    first = block[:, start].astype(np.int64)
+    isletter = (first >= 65) & (first <= 90)
+    if not isletter.any():
+        return _int(block, start, start + 5)
+    tens = first - 55 - (first > 73) - (first > 79) # 'A' is 10
+    lead = np.where(isletter, tens, np.where(first == 32, 0, first - 48))
+    return lead * 10000 + _int(block, start + 1, start + 5)
+
+def _impliedDecimal(block, start: int):
+    # Fields like ' 12345-3' mean 0.12345e-3, with the sign on the mantissa
+    mantissa = _int(block, start, start + 6)
+    exponent = _int(block, start + 6, start + 8)
+    return mantissa * 1e-5 * 10.0**exponent
+
+def epochFromFields(epoch_yr, epoch_day):
+    """
+    Converts 2-digit epoch years and fractional days of year to datetime64[us].
+    Years 57-99 are 1957-1999, and 00-56 are 2000-2056, as per the TLE convention.
+    """
+    epoch_yr = np.asarray(epoch_yr)
+    years = np.where(epoch_yr < 57, 2000 + epoch_yr, 1900 + epoch_yr)
+    start = (years - 1970).astype("datetime64[Y]").astype("datetime64[us]")
+    # Round rather than truncate, as e.g. 0.1 days is just under 8640000000 us in floating point
+    return start + np.round((np.asarray(epoch_day) - 1.0) * 86400e6).astype("timedelta64[us]")
+
+#%% Decoding
+def decodeTles(line1, line2, time_retrieved=None):
+    """
+    Decodes TLE lines into a structured array of tle_dtype.
+
+    Parameters
+    ----------
+    line1 : array_like
+        First lines, as str/bytes or an 'S69' array.
+    line2 : array_like
+        Second lines, same length as line1.
+    time_retrieved : array_like, optional
+        Times retrieved for each row. Default is 0.
+
+    Returns
+    -------
+    np.ndarray
+        Structured array with fields given by tle_dtype.
+    """
+    b1 = _asBlock(line1)
+    b2 = _asBlock(line2)
+    if len(b1) != len(b2):
+        raise ValueError("line1 and line2 have different lengths.")
+
+    out = np.empty(len(b1), dtype=tle_dtype)
+    out["time_retrieved"] = 0 if time_retrieved is None else time_retrieved
+
+    # Line 1 Parameters
+    out["satnumber"] = _satnumber(b1, 2)
+    out["classification"] = _field(b1, 7, 8)
+    out["launch_yr"] = _int(b1, 9, 11)
+    out["launch_number"] = _int(b1, 11, 14)
+    out["launch_piece"] = np.char.strip(_field(b1, 14, 17))
+    out["epoch"] = epochFromFields(_int(b1, 18, 20), _float(b1, 20, 32))
+    out["mean_motion_firstderiv"] = _float(b1, 33, 43)
+    out["mean_motion_secondderiv"] = _impliedDecimal(b1, 44)
+    out["bstar"] = _impliedDecimal(b1, 53)
+    out["ephem_type"] = _int(b1, 62, 63)
+    out["element_set_number"] = _int(b1, 64, 68)
+
+    # Line 2 Parameters
+    out["inclination_deg"] = _float(b2, 8, 16)
+    out["right_ascension_deg"] = _float(b2, 17, 25)
+    out["eccentricity"] = _int(b2, 26, 33) * 1e-7 # Leading decimal point is implied
+    out["argument_perigee_deg"] = _float(b2, 34, 42)
+    out["mean_anomaly_deg"] = _float(b2, 43, 51)
+    out["mean_motion_revperday"] = _float(b2, 52, 63)
+    out["rev_at_epoch"] = _int(b2, 63, 68)
+
+    return out
+
+def saveNpz(filepath: str, arr: np.ndarray, compressed: bool=True):
+    """
+    Saves each field of a structured array as a separate array in a .npz file.
+    """
+    save = np.savez_compressed if compressed else np.savez
+    save(filepath, **{field: arr[field] for field in arr.dtype.names})
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""
+Array-backed container for a catalog of TLEs, i.e. one element set per satellite name.
+
+The lines are kept in contiguous fixed-width byte arrays rather than as many small Python
+strings, with a dictionary from name to row for lookups. The catalog is a read-only Mapping of
+names to [line1, line2], so it can be used wherever the dictionaries returned by
+TleDatabase.parseTleData() used to be.
+"""
+
+from collections.abc import Mapping
+
+import numpy as np
+
+#%%
+class TleCatalog(Mapping):
+    """
+    Catalog of TLEs keyed by satellite name.
+
+    Example
+    -------
+    catalog = TleDatabase.parseTleData(text)
+    line1, line2 = catalog["ISS (ZARYA)"]
+    leo = catalog[catalog.decoded["mean_motion_revperday"] > 11.25]
+    merged = TleCatalog.mergeSources({"geo": geocatalog, "active": activecatalog})
+    """
+    linewidth = 69
+
+    def __init__(self, names=(), line1=(), line2=(), srcs=None):
+        """
+        Parameters
+        ----------
+        names : list of str
+            Satellite names. If a name is repeated, the last of its rows is kept,
+            at the position of the first, as for a dictionary.
+        line1 : array_like
+            First lines, as str/bytes or an 'S69' array.
+        line2 : array_like
+            Second lines, as str/bytes or an 'S69' array.
+        srcs : array_like, optional
+            Source of each row. The default is None, for catalogs from a single source.
+        """
+        names = list(names)
+        line1 = np.asarray(line1, dtype="S%d" % self.linewidth).reshape(-1)
+        line2 = np.asarray(line2, dtype="S%d" % self.linewidth).reshape(-1)
+        if not (len(names) == len(line1) == len(line2)):
+            raise ValueError("names, line1 and line2 have different lengths.")
+
+        index = dict()
+        for i, name in enumerate(names):
+            index[name] = i # Reassigning keeps the first position, as for a dictionary
+
+        keep = None
+        if len(index) < len(names):
+            keep = np.fromiter(index.values(), dtype=np.int64, count=len(index))
+            names = list(index)
+            index = {name: i for i, name in enumerate(names)}
+
+        self._index = index
+        self._names = np.array([name.encode("utf-8") for name in names], dtype=bytes) if len(names) > 0 else np.zeros(0, "S1")
+        self._line1 = line1 if keep is None else line1[keep]
+        self._line2 = line2 if keep is None else line2[keep]
+        self._srcs = None
+        if srcs is not None:
+            srcs = np.asarray(srcs, dtype=bytes).reshape(-1)
+            self._srcs = srcs if keep is None else srcs[keep]
+        self._decoded = None
+
+    @classmethod
+    def fromRecords(cls, records: list, src: str=None):
+        """
+        Makes a catalog from (name, line1, line2) records, e.g. from TleDatabase.parseTleRecords().
+        """
+        names, line1, line2 = zip(*records) if len(records) > 0 else ((), (), ())
+        return cls(names, line1, line2, None if src is None else [src] * len(names))
+
+    @classmethod
+    def fromText(cls, text, src: str=None):
+        """
+        Parses 3LE text (str or bytes) into a catalog, as TleDatabase.parseTleData() does.
+        Lines are found and copied into the arrays with vectorized operations on the whole text,
+        so no intermediate string is made per line; only the names become Python strings.
+        """
+        data = np.frombuffer(text.encode("utf-8") if isinstance(text, str) else text, dtype=np.uint8)
+        if len(data) == 0:
+            return cls()
+
+        # Line boundaries, excluding the newline and any carriage return before it
+        ends = np.flatnonzero(data == ord("\n"))
+        if len(ends) == 0 or ends[-1] != len(data) - 1:
+            ends = np.append(ends, len(data))
+        starts = np.concatenate([[0], ends[:-1] + 1])
+        ends = ends - ((ends > starts) & (data[np.maximum(ends - 1, 0)] == ord("\r")))
+        lengths = ends - starts
+
+        # Element lines start with a digit, a space and a digit; anything else is a name line
+        padded = np.concatenate([data, np.zeros(cls.linewidth, dtype=np.uint8)])
+        first, second, third = padded[starts], padded[starts + 1], padded[starts + 2]
+        isElement = (lengths >= 3) & (first >= 48) & (first <= 57) & (second == 32) & (third >= 48) & (third <= 57)
+
+        # Complete entries are a name line followed by exactly two element lines
+        complete = np.flatnonzero(~isElement[:-2] & isElement[1:-1] & isElement[2:])
+
+        def gather(rows, width):
+            cols = np.arange(width)
+            chars = padded[np.minimum(starts[rows, None] + cols, len(padded) - 1)]
+            chars[cols >= lengths[rows, None]] = 0
+            return chars.view("S%d" % width).reshape(-1)
+
+        namewidth = max(int(lengths[complete].max()), 1) if len(complete) > 0 else 1
+        names = np.char.strip(gather(complete, namewidth))
+        return cls(
+            np.char.decode(names, "utf-8").tolist(),
+            gather(complete + 1, cls.linewidth),
+            gather(complete + 2, cls.linewidth),
+            None if src is None else [src] * len(complete))
+
+    @classmethod
+    def fromDict(cls, tles: dict, src: str=None):
+        """
+        Makes a catalog from a dictionary of names to [line1, line2].
+        """
+        return cls.fromRecords([(name, lines[0], lines[1]) for name, lines in tles.items()], src)
+
+    #%% Mapping interface
+    def __getitem__(self, key):
+        # Names give the lines, like the dictionaries this replaces; anything else selects rows
+        if isinstance(key, str):
+            i = self._index[key]
+            return [self._line1[i].decode(), self._line2[i].decode()]
+        return self.take(key)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __repr__(self):
+        return "%s(%d satellites)" % (type(self).__name__, len(self))
+
+    def asDict(self):
+        """
+        Returns a plain dictionary of names to [line1, line2], for callers that need to modify it.
+        """
+        return dict(self.items())
+
+    #%% Columns
+    @property
+    def names(self):
+        return list(self._index)
+
+    @property
+    def line1(self):
+        return self._line1
+
+    @property
+    def line2(self):
+        return self._line2
+
+    @property
+    def srcs(self):
+        return self._srcs
+
+    @property
+    def decoded(self):
+        """
+        Structured array of tlearrays.tle_dtype, decoded on first use.
+        """
+        if self._decoded is None:
+            from tlearrays import decodeTles
+            self._decoded = decodeTles(self._line1, self._line2)
+        return self._decoded
+
+    @property
+    def satnumbers(self):
+        return self.decoded["satnumber"]
+
+    def records(self):
+        """
+        Yields (name, line1, line2) as strings.
+        """
+        for name, line1, line2 in zip(self._index, self._line1.tolist(), self._line2.tolist()):
+            yield name, line1.decode(), line2.decode()
+
+    #%% Serialization
+    def toText(self, filepath: str=None):
+        """
+        Returns the catalog as 3LE text, i.e. the name line followed by the two TLE lines,
+        and also writes it to a file if a path is given.
+        """
+        text = "".join("%s\n%s\n%s\n" % record for record in self.records())
+        if filepath is not None:
+            with open(filepath, "w") as f:
+                f.write(text)
+        return text
+
+    def save(self, file):
+        """
+        Saves the lines, names and sources to a .npz file (a path or an open binary file); see load().
+        """
+        arrays = {"names": self._names, "line1": self._line1, "line2": self._line2}
+        if self._srcs is not None:
+            arrays["srcs"] = self._srcs
+        np.savez(file, **arrays)
+
+    @classmethod
+    def load(cls, file):
+        """
+        Loads a catalog written by save().
+        """
+        with np.load(file) as data:
+            srcs = data["srcs"] if "srcs" in data.files else None
+            return cls([name.decode("utf-8") for name in data["names"].tolist()], data["line1"], data["line2"], srcs)
+
+    #%% Selection and merging
+    def take(self, rows):
+        """
+        Returns a new catalog with the selected rows, given as a slice, indices or a boolean mask.
+        """
+        if isinstance(rows, slice):
+            rows = np.arange(len(self))[rows]
+        rows = np.asarray(rows)
+        if rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+
+        names = self.names
+        out = type(self)(
+            [names[i] for i in rows.tolist()], self._line1[rows], self._line2[rows],
+            self._srcs[rows] if self._srcs is not None else None)
+        if self._decoded is not None:
+            out._decoded = self._decoded[rows]
+        return out
+
+    def withSrc(self, src: str):
+        """
+        Returns a copy of the catalog with every row's source set.
+        """
+        out = self.take(slice(None))
+        out._srcs = np.full(len(out), src.encode("utf-8"), dtype="S%d" % max(len(src.encode("utf-8")), 1))
+        return out
+
+    def merge(self, other: "TleCatalog"):
+        """
+        Returns a new catalog with the rows of both, where the other catalog's rows replace
+        those with the same names, as for dict.update().
+        """
+        srcs = None
+        if self._srcs is not None or other._srcs is not None:
+            srcs = np.concatenate([
+                c._srcs if c._srcs is not None else np.full(len(c), b"", dtype="S1") for c in (self, other)])
+        return type(self)(
+            self.names + other.names,
+            np.concatenate([self._line1, other._line1]),
+            np.concatenate([self._line2, other._line2]),
+            srcs)
+
+    @classmethod
+    def mergeSources(cls, catalogs: dict):
+        """
+        Merges the catalogs of several sources into one, keeping the row with the latest epoch
+        for each name (the earlier source on ties), and recording its source in srcs.
+
+        Parameters
+        ----------
+        catalogs : dict
+            Sources to catalogs, e.g. as returned by TleDatabase.parseTleDataSrcs().
+        """
+        parts = [catalog.withSrc(src) for src, catalog in catalogs.items() if len(catalog) > 0]
+        if len(parts) == 0:
+            return cls()
+
+        names = [name for part in parts for name in part.names]
+        epochs = np.concatenate([part.decoded["epoch"] for part in parts])
+        # Latest epoch first, stably, so that the first row seen for each name is the one to keep
+        order = np.argsort(-epochs.astype(np.int64), kind="stable")
+        seen = dict()
+        for i in order.tolist():
+            seen.setdefault(names[i], i)
+        keep = np.sort(np.fromiter(seen.values(), dtype=np.int64, count=len(seen)))
+
+        srcs = np.concatenate([part._srcs for part in parts])
+        return cls(
+            [names[i] for i in keep.tolist()],
+            np.concatenate([part._line1 for part in parts])[keep],
+            np.concatenate([part._line2 for part in parts])[keep],
+            srcs[keep])
+
+    #%% Database
+    def insertInto(self, db, src: str, time_retrieved: int, verbose: bool=False):
+        """
+        Bulk inserts every row into a TleDatabase, see TleDatabase.insertCatalog(). Does not commit.
+        Returns the number of rows actually inserted.
+        """
+        return db.insertCatalog(src, time_retrieved, self, verbose)
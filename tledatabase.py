@@ -6,11 +6,9 @@ Created on Thu Dec  1 19:12:45 2022
 @author: seoxubuntu
 """
 
-import requests
 import sqlite3 as sq
 import re
 import datetime as dt
-import numpy as np
 
 import sew
 
@@ -28,6 +26,14 @@ class TleDatabase(sew.Database):
         'gnss': "https://celestrak.org/NORAD/elements/gp.php?GROUP=gnss&FORMAT=tle",
         'cubesat': "https://celestrak.org/NORAD/elements/gp.php?GROUP=cubesat&FORMAT=tle"
     } # Maybe can generate the link, if the celestrak website continues this format
+
+    # Download format for each source; sources not listed use 'tle'.
+    # 'csv' and 'json' request the same GP data as OMM records instead, see omm.py.
+    srcformats = dict()
+
+    # Largest catalog number that fits in a TLE, using the Alpha-5 scheme
+    alpha5_letters = "ABCDEFGHJKLMNPQRSTUVWXYZ" # I and O are skipped
+    alpha5_max = 339999
     
     #%% Table definitions
     satellite_table_fmt = {
@@ -81,8 +87,106 @@ class TleDatabase(sew.Database):
         ]
     }
     
+    # Progress of backfills from archive files, so interrupted runs can resume (see backfill.py)
+    backfill_checkpoint_tblname = "backfill_checkpoint"
+    backfill_checkpoint_fmt = {
+        'cols': [
+            ["filepath", "TEXT"],
+            ["src", "TEXT"],
+            ["time_retrieved", "INTEGER"],
+            ["num_tles", "INTEGER"],
+            ["time_completed", "INTEGER"]
+        ],
+        'conds': [
+            "UNIQUE(filepath, src)"
+        ]
+    }
+
+    # Deduplicated layout: each distinct TLE is stored once, with the sources that carried it
+    # (under which name, and when they were first seen) in a separate membership table
+    tle_elements_tblname = "tle_elements"
+    tle_elements_fmt = {
+        'cols': [
+            ["id", "INTEGER PRIMARY KEY"],
+            ["line1", "TEXT"],
+            ["line2", "TEXT"]
+        ],
+        'conds': [
+            "UNIQUE(line1, line2)"
+        ]
+    }
+
+    tle_sources_tblname = "tle_sources"
+    tle_sources_fmt = {
+        'cols': [
+            ["tle_id", "INTEGER"],
+            ["src", "TEXT"],
+            ["name", "TEXT"], # Sources may carry the same lines under different names
+            ["time_retrieved", "INTEGER"]
+        ],
+        'conds': [
+            "UNIQUE(tle_id, src, name)"
+        ]
+    }
+
+    # Quantities derived from the latest TLE (by epoch) of each satellite, for range queries
+    satellite_state_tblname = "satellite_state"
+    satellite_state_fmt = {
+        'cols': [
+            ["src", "TEXT"],
+            ["name", "TEXT"],
+            ["satnumber", "INTEGER"],
+            ["epoch", "REAL"], # Unix seconds
+            ["time_retrieved", "INTEGER"],
+            ["inclination_deg", "REAL"],
+            ["eccentricity", "REAL"],
+            ["mean_motion_revperday", "REAL"],
+            ["semi_major_axis_km", "REAL"],
+            ["period_min", "REAL"],
+            ["apogee_alt_km", "REAL"],
+            ["perigee_alt_km", "REAL"],
+            ["regime", "TEXT"]
+        ],
+        'conds': [
+            "PRIMARY KEY(src, name)"
+        ]
+    }
+    # Each range-queryable column gets an index; the regime is usually combined with the inclination
+    satellite_state_indexes = {
+        "perigee": "perigee_alt_km",
+        "apogee": "apogee_alt_km",
+        "inclination": "inclination_deg",
+        "period": "period_min",
+        "sma": "semi_major_axis_km",
+        "regime": "regime, inclination_deg",
+        "satnumber": "satnumber"
+    }
+
+    # Change feed: one row per TLE that was actually inserted, in insertion order.
+    # seq is the rowid, so consumers can keep a cursor and ask only for later rows (see getChanges())
+    tle_changes_tblname = "tle_changes"
+    tle_changes_fmt = {
+        'cols': [
+            ["seq", "INTEGER PRIMARY KEY"],
+            ["src", "TEXT"],
+            ["name", "TEXT"],
+            ["epoch", "REAL"], # Unix seconds
+            ["time_retrieved", "INTEGER"]
+        ]
+    }
+
+    # Tables that do not hold satellite TLEs; these are excluded from satellite listings
+    aux_tablenames = {
+        satellite_metadata_tblname,
+        backfill_checkpoint_tblname,
+        tle_elements_tblname,
+        tle_sources_tblname,
+        satellite_state_tblname,
+        tle_changes_tblname
+    }
+    
     #%% Constructor and other miscellaneous methods
-    def __init__(self, dbpath: str):
+    def __init__(self, dbpath: str, dedup: bool=False):
         '''
         Instantiates a database on the file system.
 
@@ -90,9 +194,31 @@ class TleDatabase(sew.Database):
         ----------
         dbpath : str
             File path of the database.
+        dedup : bool, optional
+            Use the deduplicated layout, where each distinct TLE is stored once in tle_elements
+            and the sources that carried it are recorded in tle_sources, instead of one table per
+            "<src>_<name>". Satellites are still addressed by "<src>_<name>" in either layout.
+            Databases already stored this way are detected automatically. The default is False.
         '''
         super().__init__(dbpath)
         self._usedSrcs = None
+        self._updateHooks = []
+        # Note that reloadTables() has already populated the known table cache
+
+        self._dedup = dedup or self.tle_sources_tblname in self._tables
+        if self._dedup:
+            self._makeDedupTables()
+
+        # Databases from before the state table existed are populated once, when first opened
+        if self.satellite_state_tblname not in self._tables:
+            self._makeSatelliteStateTable()
+            if len(self.satelliteTablenames) > 0:
+                print("Building %s for existing satellites" % (self.satellite_state_tblname))
+                self.rebuildSatelliteState()
+
+        if self.tle_changes_tblname not in self._tables:
+            self.createTable(self.tle_changes_fmt, self.tle_changes_tblname, ifNotExists=True)
+            self.reloadTables()
 
         # Create the catalog metadata table if it doesn't exist
         # self.createMetaTable(
@@ -101,6 +227,28 @@ class TleDatabase(sew.Database):
         #     ifNotExists=True
         # ) # TODO: Don't enable until ready
         
+    def reloadTables(self):
+        '''
+        Reloads the table registry from the database, and resyncs the cache of known tables.
+        This queries sqlite_master, so avoid calling it in loops; makeSatelliteTable() keeps the cache updated.
+        '''
+        super().reloadTables()
+        self._knownTables = set(self._tables)
+        
+    @property
+    def satelliteTablenames(self):
+        '''
+        Returns the list of satellite table names i.e. "<src>_<name>", excluding any auxiliary tables.
+        For the deduplicated layout these are not real tables, but can be used in the same way.
+        '''
+        if self._dedup:
+            self.execute(
+                "select distinct src, name from %s" % (self.tle_sources_tblname)
+            )
+            return [self._makeSatelliteTableName(src, name) for src, name in self.fetchall()]
+
+        return [i for i in self._tables if i not in self.aux_tablenames]
+        
     #%% Discovery methods
     def getAvailableSrcs(self):
         '''
@@ -134,9 +282,7 @@ class TleDatabase(sew.Database):
             Returns a dict if remove_src is False, with keys specified by the source names.
         '''
         
-        stmt = 'select name from sqlite_master where type="table"'
-        self.execute(stmt)
-        results = [i[0] for i in self.cur.fetchall()]
+        results = self.satelliteTablenames
         
         # Return a set of strings (may have had repeated satellites in different sources)
         if remove_src:
@@ -164,60 +310,149 @@ class TleDatabase(sew.Database):
         '''
         # Download
         data, time_retrieved = self.download()
-        # Parse the data
-        alltles = self.parseTleDataSrcs(data)
+        # Parse and insert
+        self.ingest(data, time_retrieved, verbose)
 
-        # Make all the tables first
-        for src, tles in alltles.items():
-            for name, tlelines in tles.items():
-                if verbose:
-                    print("Making table %s" % (name))
-                # Create table if necessary
-                self.makeSatelliteTable(src, name, reloadNow=False) # Don't reload in this loop
-
-        # Reload only at the end
-        self.reloadTables()
+    async def aupdate(self, verbose: bool=True, client=None):
+        '''
+        Asynchronous version of update(), which downloads all sources concurrently, see adownload().
+        Parsing and inserting still run on the calling thread once the downloads complete.
+        '''
+        data, time_retrieved = await self.adownload(client)
+        self.ingest(data, time_retrieved, verbose)
 
-        # Then insert
-        for src, tles in alltles.items():
-             # Get the time for this source
-            src_tr = time_retrieved[src]
-            # Iterate over individual satellites
-            for name, tlelines in tles.items():
-                if verbose:
-                    print("Updating %s" % (name))
-                # Insert into it
-                self.insertSatelliteTle(src, name, src_tr, tlelines[0], tlelines[1])
-                
-        # Commit changes
-        self.commit()
+    def ingest(self, data: dict, time_retrieved: dict, verbose: bool=True):
+        '''
+        Parses and inserts raw downloaded data, in the format returned by download().
+        '''
+        # Parse the data
+        alltles = self.parseTleDataSrcs(data, self.srcformats)
 
+        # Create any new tables and insert
+        self._insertTles(alltles, time_retrieved, verbose)
 
-    def loadTleFile(self, filepath: str, src: str, time_retrieved: int=None):
-        data = dict()
-        with open(filepath, "r") as fid:
-            data[src] = fid.read()
+    def loadTleFile(self, filepath: str, src: str, time_retrieved: int=None, verbose: bool=True):
+        '''
+        Parses and inserts a local TLE text file, as if it had been downloaded from the source.
+        The file is memory-mapped rather than read into a string, see tlereader.py.
+        '''
+        from tlereader import TleFileReader
+        with TleFileReader(filepath) as reader:
+            tles = reader.toDict()
         if time_retrieved is None:
             time_retrieved = int(dt.datetime.utcnow().timestamp())
-            
-        # Parse the data
-        alltles = self.parseTleDataSrcs(data)
         
         # Insert rows
+        self._insertTles({src: tles}, {src: time_retrieved}, verbose)
+
+    def _insertTles(self, alltles: dict, time_retrieved: dict, verbose: bool=True):
         for src, tles in alltles.items():
-            # Get the time for this source
-            src_tr = time_retrieved[src]
-            # Iterate over individual satellites
-            for name, tlelines in tles.items():
-                print("Updating %s" % (name))
-                # Create table if necessary
-                self.makeSatelliteTable(src, name)
-                # Insert into it
-                self.insertSatelliteTle(src, name, src_tr, tlelines[0], tlelines[1])
+            if hasattr(tles, "line1"): # A TleCatalog, from parseTleDataSrcs()
+                inserted = self.insertCatalog(src, time_retrieved[src], tles, verbose)
+            else:
+                # Each satellite only has one TLE here
+                inserted = self.insertTleGroups(
+                    src, time_retrieved[src],
+                    {name: [(tlelines[0], tlelines[1])] for name, tlelines in tles.items()},
+                    verbose
+                )
+            if verbose:
+                print("Inserted %d new TLEs for %s" % (inserted, src))
                 
         # Commit changes
         self.commit()
+
+        # Let listeners (e.g. a SharedCatalogPublisher) see the committed data
+        for hook in self._updateHooks:
+            hook(self)
+
+    def addUpdateHook(self, hook):
+        '''
+        Registers a callable to be called with this database after each update(), aupdate(),
+        ingest() or loadTleFile() has committed its inserts.
+        '''
+        self._updateHooks.append(hook)
+
+    def removeUpdateHook(self, hook):
+        '''
+        Unregisters a callable added with addUpdateHook().
+        '''
+        self._updateHooks.remove(hook)
+
+    def insertTleGroups(self, src: str, time_retrieved: int, tles: dict, verbose: bool=False):
+        """
+        Bulk inserts TLEs for many satellites from one source, skipping those that already exist.
+        Works for either layout. Does not commit.
+
+        Parameters
+        ----------
+        src : str
+            Source of the TLEs.
+        time_retrieved : int
+            Time retrieved for all the rows.
+        tles : dict
+            Satellite names to lists of (line1, line2).
+        verbose : bool, optional
+            Print the names of newly made tables. The default is False.
+
+        Returns
+        -------
+        int
+            Number of rows actually inserted.
+        """
+        if self._dedup:
+            return self._insertDedup(src, time_retrieved, tles)
+
+        # Make all the tables first; only new satellites will issue any DDL
+        newTables = False
+        for name in tles:
+            # Create table if necessary
+            if self.makeSatelliteTable(src, name, reloadNow=False): # Don't reload in this loop
+                newTables = True
+                if verbose:
+                    print("Made table %s" % (name))
+
+        # Reload only at the end, and only if something was added
+        if newTables:
+            self.reloadTables()
+
+        # Then insert
+        inserted = 0
+        for name, tlelines in tles.items():
+            inserted += self._insertSatelliteRows(src, name, time_retrieved, tlelines)
+        return inserted
         
+    def insertCatalog(self, src: str, time_retrieved: int, catalog, verbose: bool=False):
+        """
+        Bulk inserts a TleCatalog from one source, as insertTleGroups() does for dictionaries,
+        but straight from the catalog's line arrays. Does not commit.
+        Returns the number of rows actually inserted.
+        """
+        names = catalog.names
+        line1 = catalog.line1.astype("U%d" % catalog.linewidth).tolist()
+        line2 = catalog.line2.astype("U%d" % catalog.linewidth).tolist()
+        if self._dedup:
+            return self._insertDedupRows(src, time_retrieved, names, line1, line2)
+
+        newTables = False
+        for name in names:
+            if self.makeSatelliteTable(src, name, reloadNow=False):
+                newTables = True
+                if verbose:
+                    print("Made table %s" % (name))
+        if newTables:
+            self.reloadTables()
+
+        # One table per satellite, so one statement each; the change count says whether it was new
+        new = []
+        for name, l1, l2 in zip(names, line1, line2):
+            before = self.con.total_changes
+            self.cur.execute('insert or ignore into "%s" values(?,?,?)' % (self._makeSatelliteTableName(src, name)), (time_retrieved, l1, l2))
+            if self.con.total_changes > before:
+                new.append((name, l1, l2))
+        self._recordChanges(src, time_retrieved, new)
+        return len(new)
+
     @property
     def usedSrcs(self):
         '''
@@ -238,7 +473,23 @@ class TleDatabase(sew.Database):
         if isinstance(srckeys, str):
             srckeys = [srckeys] # Make it into a list for them
         
-        self._usedSrcs = {key: self.srcs[key] for key in srckeys}
+        self._usedSrcs = {key: self._makeSrcLink(key) for key in srckeys}
+
+    def setSrcFormat(self, src: str, fmt: str):
+        '''
+        Selects the download format of a source: 'tle' (default), or the OMM formats 'csv' or 'json'.
+        The data is stored the same way regardless.
+        '''
+        if fmt not in ("tle", "csv", "json"):
+            raise ValueError("Unknown format %s; expected 'tle', 'csv' or 'json'." % fmt)
+        self.srcformats = dict(self.srcformats) # Don't modify the class attribute
+        self.srcformats[src] = fmt
+        if self._usedSrcs is not None and src in self._usedSrcs:
+            self._usedSrcs[src] = self._makeSrcLink(src)
+
+    def _makeSrcLink(self, src: str):
+        # CelesTrak serves every format from the same link
+        return re.sub("FORMAT=[a-z]+", "FORMAT=%s" % self.srcformats.get(src, "tle"), self.srcs[src])
         
     def download(self):
         '''
@@ -258,6 +509,7 @@ class TleDatabase(sew.Database):
         '''
         if self._usedSrcs is None:
             raise ValueError("No sources are activated. Please call setSrcs().")
+        import requests # Only needed here, so don't slow down imports
         
         data = dict()
         time_retrieved = dict()
@@ -271,11 +523,357 @@ class TleDatabase(sew.Database):
                 print("Could not download from %s" % link)
         
         return data, time_retrieved
+
+    async def adownload(self, client=None):
+        '''
+        Asynchronous version of download(), fetching every activated source concurrently
+        on a shared httpx.AsyncClient, see asyncfetch.py.
+
+        Parameters
+        ----------
+        client : httpx.AsyncClient, optional
+            Client to use. Default is the shared client.
+
+        Returns
+        -------
+        data : dict
+            This dictionary contains the raw text data with keys matching the activated sources.
+        time_retrieved : dict
+            This dictionary contains the time of download with keys matching the activated sources.
+        '''
+        if self._usedSrcs is None:
+            raise ValueError("No sources are activated. Please call setSrcs().")
+        from asyncfetch import fetchAll # Only needed here, so don't slow down imports
+
+        return await fetchAll(self._usedSrcs, client)
             
     #%% Helper methods
     def _makeSatelliteTableName(self, src: str, name: str):
         return "%s_%s" % (src, name)
+
+    def _satelliteTableSelect(self, tablename: str):
+        """
+        Returns a FROM clause and its parameters that behave like the legacy satellite table,
+        i.e. with columns (time_retrieved, line1, line2), for either layout.
+        """
+        if not self._dedup:
+            return '"%s"' % (tablename), ()
+
+        src, name = tablename.split("_", 1)
+        clause = (
+            "(select s.time_retrieved as time_retrieved, e.line1 as line1, e.line2 as line2 "
+            "from %s s join %s e on e.id = s.tle_id where s.src = ? and s.name = ?)" % (
+                self.tle_sources_tblname, self.tle_elements_tblname)
+        )
+        return clause, (src, name)
+
+    #%% Deduplicated layout
+    def _makeDedupTables(self):
+        if self.tle_sources_tblname in self._tables:
+            self._migrateDedupNames()
+        self.createTable(self.tle_elements_fmt, self.tle_elements_tblname, ifNotExists=True)
+        self.createTable(self.tle_sources_fmt, self.tle_sources_tblname, ifNotExists=True)
+        # Lookups are by source and name in the membership table
+        self.execute("drop index if exists %s_src" % (self.tle_sources_tblname))
+        self.execute("create index if not exists %s_srcname on %s(src, name, time_retrieved)" % (
+            self.tle_sources_tblname, self.tle_sources_tblname))
+        self.commit()
+        self.reloadTables()
+
+    def _migrateDedupNames(self):
+        # Older files kept the name on tle_elements, so a TLE carried under different names
+        # by different sources took the first one; move it onto the memberships
+        self.execute("select name from pragma_table_info('%s')" % (self.tle_sources_tblname))
+        if "name" in [row[0] for row in self.fetchall()]:
+            return
+        print("Moving satellite names into %s" % (self.tle_sources_tblname))
+        old = self.tle_sources_tblname + "_old"
+        self.execute("drop index if exists %s_src" % (self.tle_sources_tblname))
+        self.execute("drop index if exists %s_name" % (self.tle_elements_tblname))
+        self.execute("alter table %s rename to %s" % (self.tle_sources_tblname, old))
+        self.createTable(self.tle_sources_fmt, self.tle_sources_tblname, commitNow=False)
+        self.execute(
+            "insert into %s(tle_id, src, name, time_retrieved) "
+            "select s.tle_id, s.src, e.name, s.time_retrieved from %s s join %s e on e.id = s.tle_id order by s.rowid" % (
+                self.tle_sources_tblname, old, self.tle_elements_tblname)
+        )
+        self.execute("drop table %s" % (old))
+        self.commit()
+
+    def _insertDedup(self, src: str, time_retrieved: int, tles: dict):
+        names, line1, line2 = [], [], []
+        for name, tlelines in tles.items():
+            for l1, l2 in tlelines:
+                names.append(name)
+                line1.append(l1)
+                line2.append(l2)
+        return self._insertDedupRows(src, time_retrieved, names, line1, line2)
+
+    def _insertDedupRows(self, src: str, time_retrieved: int, names: list, line1: list, line2: list):
+        # Store each distinct TLE once
+        self.cur.executemany(
+            "insert or ignore into %s(line1, line2) values(?,?)" % (self.tle_elements_tblname),
+            zip(line1, line2)
+        )
+
+        # Then record that this source carried it; this is what counts as new for the source,
+        # as in the legacy layout
+        self.execute("select max(rowid) from %s" % (self.tle_sources_tblname))
+        lastRowid = self.fetchone()[0] or 0
+        self.cur.executemany(
+            "insert or ignore into %s(tle_id, src, name, time_retrieved) select id, ?, ?, ? from %s where line1 = ? and line2 = ?" % (
+                self.tle_sources_tblname, self.tle_elements_tblname),
+            ((src, name, time_retrieved, l1, l2) for name, l1, l2 in zip(names, line1, line2))
+        )
+
+        # Rows past the previous last rowid are exactly the ones just inserted
+        self.execute(
+            "select s.name, e.line1, e.line2 from %s s join %s e on e.id = s.tle_id where s.rowid > ? order by s.rowid" % (
+                self.tle_sources_tblname, self.tle_elements_tblname),
+            (lastRowid,)
+        )
+        new = [tuple(row) for row in self.fetchall()]
+        self._recordChanges(src, time_retrieved, new)
+        return len(new)
     
+    #%% Change feed
+    @staticmethod
+    def _epochSeconds(line1: str):
+        # TLE epoch as Unix seconds; two-digit years from 57 are 19xx, as in the TLE convention
+        yr = int(line1[18:20])
+        year = 1900 + yr if yr >= 57 else 2000 + yr
+        start = dt.datetime(year, 1, 1, tzinfo=dt.timezone.utc).timestamp()
+        return start + (float(line1[20:32]) - 1.0) * 86400.0
+
+    def _recordChanges(self, src: str, time_retrieved: int, new: list):
+        # Every insert path reports the (name, line1, line2) rows it actually inserted here, for the
+        # change feed and the derived state; rows that were already stored change neither
+        if len(new) == 0:
+            return
+        self.cur.executemany(
+            "insert into %s(src, name, epoch, time_retrieved) values(?,?,?,?)" % (self.tle_changes_tblname),
+            ((src, name, self._epochSeconds(l1), time_retrieved) for name, l1, _ in new)
+        ) # Committed together with the TLEs themselves
+        names, line1, line2 = zip(*new)
+        self._upsertSatelliteStateRows([src] * len(new), list(names), [time_retrieved] * len(new), list(line1), list(line2))
+
+    def getLatestChangeSeq(self):
+        """
+        Returns the sequence number of the latest change, or 0 if there are none.
+        Use this to start a cursor from now, without reading the existing history.
+        """
+        self.execute("select max(seq) from %s" % (self.tle_changes_tblname))
+        return self.fetchone()[0] or 0
+
+    def getChanges(self, since: int=0, limit: int=None, src: str=None, tablenames: list=None):
+        """
+        Returns the TLEs inserted after a cursor, oldest first.
+
+        Parameters
+        ----------
+        since : int, optional
+            Sequence number of the last change already seen. The default is 0, for all changes.
+        limit : int, optional
+            Maximum number of changes to return. The default is None, for no limit.
+        src : str, optional
+            Only return changes from this source. The default is None.
+        tablenames : list, optional
+            Only return changes for these "<src>_<name>" satellites. The default is None.
+
+        Returns
+        -------
+        list
+            Rows of (seq, src, name, epoch, time_retrieved), with epoch in Unix seconds.
+            Pass the seq of the last row as the next call's since; note that with filters or a
+            limit, this may be less than getLatestChangeSeq().
+
+        Example
+        -------
+        cursor = d.getLatestChangeSeq()
+        d.update()
+        for seq, src, name, epoch, time_retrieved in d.getChanges(cursor):
+            ...
+        """
+        stmt = "select seq, src, name, epoch, time_retrieved from %s where seq > ?" % (self.tle_changes_tblname)
+        params = [since]
+        if src is not None:
+            stmt += " and src = ?"
+            params.append(src)
+        if tablenames is not None:
+            # Filtered here rather than in SQL, since the list can be long
+            wanted = set(tablenames)
+        stmt += " order by seq"
+        if limit is not None and tablenames is None:
+            stmt += " limit %d" % (limit)
+
+        self.execute(stmt, params)
+        rows = self.fetchall()
+        if tablenames is not None:
+            rows = [row for row in rows if self._makeSatelliteTableName(row[1], row[2]) in wanted]
+            if limit is not None:
+                rows = rows[:limit]
+        return rows
+
+    def pruneChanges(self, olderThan: int):
+        """
+        Deletes changes retrieved before a time (Unix seconds), always keeping the latest so that
+        sequence numbers are never reused. Commits. Returns the number of rows deleted.
+        """
+        self.execute(
+            "delete from {0} where time_retrieved < ? and seq < (select max(seq) from {0})".format(self.tle_changes_tblname),
+            (olderThan,)
+        )
+        deleted = self.cur.rowcount
+        self.commit()
+        return deleted
+
+    #%% Derived orbital state
+    def _makeSatelliteStateTable(self):
+        self.createTable(self.satellite_state_fmt, self.satellite_state_tblname, ifNotExists=True, commitNow=False)
+        for suffix, cols in self.satellite_state_indexes.items():
+            self.execute("create index if not exists %s_%s on %s(%s)" % (
+                self.satellite_state_tblname, suffix, self.satellite_state_tblname, cols))
+        self.commit()
+        self.reloadTables()
+
+    @staticmethod
+    def computeSatelliteState(line1, line2):
+        """
+        Computes the derived quantities of satellite_state for many TLEs at once.
+
+        Returns
+        -------
+        dict
+            Column name to NumPy array (or list for the regime), for the columns derived from the lines.
+        """
+        import numpy as np
+        from tlearrays import decodeTles
+        from orbitprop import R_EARTH, semiMajorAxis, orbitalRegime
+
+        decoded = decodeTles(line1, line2)
+        mm = decoded["mean_motion_revperday"]
+        e = decoded["eccentricity"]
+        sma = semiMajorAxis(mm)
+        apogee = sma * (1.0 + e) - R_EARTH
+        with np.errstate(divide="ignore"):
+            period = 1440.0 / mm
+        return {
+            "satnumber": decoded["satnumber"],
+            "epoch": (decoded["epoch"] - np.datetime64(0, "us")) / np.timedelta64(1, "s"),
+            "inclination_deg": decoded["inclination_deg"],
+            "eccentricity": e,
+            "mean_motion_revperday": mm,
+            "semi_major_axis_km": sma,
+            "period_min": period,
+            "apogee_alt_km": apogee,
+            "perigee_alt_km": sma * (1.0 - e) - R_EARTH,
+            "regime": orbitalRegime(sma, e, apogee).tolist()
+        }
+
+    def _upsertSatelliteStateRows(self, srcs: list, names: list, time_retrieved: list, line1: list, line2: list):
+        # Only replaces a satellite's state with one from a TLE with a later epoch, or a later retrieval
+        # of the same epoch, which is the same order as rebuildSatelliteState() uses
+        if len(names) == 0:
+            return
+        state = self.computeSatelliteState(line1, line2)
+        cols = [col for col, _ in self.satellite_state_fmt['cols']]
+        columns = {"src": srcs, "name": names, "time_retrieved": time_retrieved}
+        columns.update({key: value.tolist() if hasattr(value, "tolist") else value for key, value in state.items()})
+
+        tbl = self.satellite_state_tblname
+        stmt = "insert into %s(%s) values(%s) on conflict(src, name) do update set %s " \
+            "where excluded.epoch > %s.epoch or (excluded.epoch = %s.epoch and excluded.time_retrieved > %s.time_retrieved)" % (
+            tbl, ",".join(cols), ",".join("?" * len(cols)),
+            ",".join("%s=excluded.%s" % (col, col) for col in cols[2:]), tbl, tbl, tbl)
+        self.cur.executemany(stmt, zip(*(columns[col] for col in cols)))
+
+    def rebuildSatelliteState(self):
+        """
+        Recomputes satellite_state from the TLE with the latest epoch of every satellite, as the
+        inserts maintain it, e.g. after rows were copied in without going through the insert methods. Commits.
+        """
+        self.execute("delete from %s" % (self.satellite_state_tblname))
+        latest = self.getTlesAsOf(float("inf"), by="epoch")
+        srcnames = [tablename.split("_", 1) for tablename in latest]
+        rows = list(latest.values())
+        self._upsertSatelliteStateRows(
+            [i[0] for i in srcnames], [i[1] for i in srcnames],
+            [i[0] for i in rows], [i[1] for i in rows], [i[2] for i in rows])
+        self.commit()
+
+    def getSatellitesInRange(
+        self,
+        perigee: tuple=None,
+        apogee: tuple=None,
+        inclination: tuple=None,
+        period: tuple=None,
+        semiMajorAxis: tuple=None,
+        eccentricity: tuple=None,
+        regime: str=None,
+        src: str=None
+    ):
+        """
+        Selects satellites by the derived quantities of their latest TLEs, using the indexes on satellite_state.
+        Each range is (low, high) inclusive, where either may be None for an open end.
+
+        Parameters
+        ----------
+        perigee : tuple, optional
+            Perigee altitude range in km.
+        apogee : tuple, optional
+            Apogee altitude range in km.
+        inclination : tuple, optional
+            Inclination range in degrees.
+        period : tuple, optional
+            Period range in minutes.
+        semiMajorAxis : tuple, optional
+            Semi-major axis range in km.
+        eccentricity : tuple, optional
+            Eccentricity range.
+        regime : str, optional
+            One of 'LEO', 'MEO', 'GEO' or 'HEO', see orbitprop.orbitalRegime().
+        src : str, optional
+            Only satellites from this source.
+
+        Returns
+        -------
+        list of sqlite3.Row
+            Rows of satellite_state; "<src>_<name>" gives the satellite table name.
+
+        Example
+        -------
+        d.getSatellitesInRange(perigee=(500, 600))
+        d.getSatellitesInRange(regime="GEO", inclination=(None, 1.0))
+        """
+        conds = []
+        params = []
+        ranges = [
+            ("perigee_alt_km", perigee), ("apogee_alt_km", apogee), ("inclination_deg", inclination),
+            ("period_min", period), ("semi_major_axis_km", semiMajorAxis), ("eccentricity", eccentricity)
+        ]
+        for col, bounds in ranges:
+            if bounds is None:
+                continue
+            low, high = bounds
+            if low is not None:
+                conds.append("%s >= ?" % col)
+                params.append(low)
+            if high is not None:
+                conds.append("%s <= ?" % col)
+                params.append(high)
+        if regime is not None:
+            conds.append("regime = ?")
+            params.append(regime)
+        if src is not None:
+            conds.append("src = ?")
+            params.append(src)
+
+        self.execute(
+            "select * from %s%s order by src, name" % (
+                self.satellite_state_tblname, (" where " + " and ".join(conds)) if len(conds) > 0 else ""),
+            params)
+        return self.fetchall()
+
     #%% TLE parsing
     @staticmethod
     def parseTle(lines: list) -> list:
@@ -293,7 +891,7 @@ class TleDatabase(sew.Database):
         if line1[0] != "1":
             raise ValueError("Line 1 does not start with 1.")
 
-        values.append(int(line1[2:7])) # Satellite number
+        values.append(TleDatabase.fromAlpha5(line1[2:7])) # Satellite number
         values.append(str(line1[7])) # classification
         values.append(int(line1[9:11])) # launch year
         values.append(int(line1[11:14])) # launch number
@@ -348,26 +946,80 @@ class TleDatabase(sew.Database):
         raise NotImplementedError("This function is still incomplete.")
 
 
+    @staticmethod
+    def fromAlpha5(satnumber: str):
+        """
+        Converts a catalog number field from a TLE to an integer, including Alpha-5 numbers e.g. 'A0001' is 100001.
+        """
+        satnumber = satnumber.strip()
+        if len(satnumber) > 0 and satnumber[0].isalpha():
+            return (TleDatabase.alpha5_letters.index(satnumber[0].upper()) + 10) * 10000 + int(satnumber[1:])
+        return int(satnumber)
+
+    @staticmethod
+    def toAlpha5(satnumber: int):
+        """
+        Converts a catalog number to the 5-character TLE field, using Alpha-5 above 99999.
+        """
+        if satnumber <= 99999:
+            return "%05d" % satnumber
+        if satnumber > TleDatabase.alpha5_max:
+            raise ValueError("Catalog number %d cannot be written in a TLE." % satnumber)
+        return "%s%04d" % (TleDatabase.alpha5_letters[satnumber // 10000 - 10], satnumber % 10000)
+
     @staticmethod # allow calls from outside a class object
     def parseTleData(datasrc: str):
-        tles = dict()
-        currentSat = None
-        for line in datasrc.strip().split("\n"): # Split into a list of lines
-            if not re.match("\\d \\d+", line): # Matches for the two lines
-                currentSat = line.strip()
-                tles[currentSat] = []
-            else: # Otherwise it's a name (hopefully)
-                tles[currentSat].append(line.strip())
-                assert(len(tles[currentSat]) <= 2)
+        """
+        Parses 3LE text into a TleCatalog, which behaves as a dictionary of names to [line1, line2].
+        If a name is repeated, the last of its TLEs is kept.
+        """
+        from tlecatalog import TleCatalog # Only needed here, and it imports numpy
+        return TleCatalog.fromText(datasrc)
+    
+    @staticmethod
+    def parseTleRecords(datasrc: str):
+        """
+        Parses TLE text into a list of (name, line1, line2) records.
+        Unlike parseTleData(), repeated satellites are all kept (as in historical archives),
+        and 2-line data without name lines is accepted; the satellite number is used as the name.
+        """
+        records = []
+        name = None
+        line1 = None
+        for line in datasrc.split("\n"):
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            # Element lines are long, whereas names are at most 24 characters
+            if len(line) > 60 and line.startswith("1 "):
+                line1 = line
+            elif len(line) > 60 and line.startswith("2 ") and line1 is not None:
+                # Fallback to the satellite number if there was no name line for this record
+                records.append((name if name is not None else line1[2:7].strip(), line1, line))
+                name = None
+                line1 = None
+            else:
+                name = line
+                line1 = None
                 
-        return tles
+        return records
     
     @staticmethod
-    def parseTleDataSrcs(data: dict):
+    def parseTleDataSrcs(data: dict, formats: dict=None):
+        """
+        Parses the raw data of each source, in the format given for it ('tle' by default).
+        Returns a dictionary of sources to TleCatalogs; see TleCatalog.mergeSources() to combine them.
+        """
         alltles = dict()
+        formats = dict() if formats is None else formats
         # Iterate over all sources
         for srckey in data:
-            tles = TleDatabase.parseTleData(data[srckey])
+            fmt = formats.get(srckey, "tle")
+            if fmt == "tle":
+                tles = TleDatabase.parseTleData(data[srckey])
+            else:
+                from omm import parseOmmData # Only needed here, and it imports numpy
+                tles = parseOmmData(data[srckey], fmt)
             # Merge into the collector
             alltles[srckey] = tles
             
@@ -376,18 +1028,29 @@ class TleDatabase(sew.Database):
         
     #%% Individual satellite tables
     def makeSatelliteTable(self, src: str, name: str, reloadNow: bool=True):
+        '''
+        Creates the table for a satellite if it is not already known.
+        Returns True if the table was created, False if it already existed.
+        '''
         # Prefix the src if provided; if already in the tablename then ignore
         tablename = self._makeSatelliteTableName(src, name) if src is not None else name
 
+        # Skip the DDL entirely if we already know about this table
+        if tablename in self._knownTables:
+            return False
+
         self.createTable(
             self.satellite_table_fmt, 
             tablename, 
             ifNotExists=True, encloseTableName=True,
             commitNow=False) # Explicitly do not commit
+        self._knownTables.add(tablename)
 
         if reloadNow: 
             self.reloadTables()
 
+        return True
+
     # def makeSatelliteTable_v2(self, src: str, name: str):
     #     # Prefix the src if provided; if already in the tablename then ignore
     #     tablename = self._makeSatelliteTableName(src, name) if src is not None else name
@@ -405,12 +1068,65 @@ class TleDatabase(sew.Database):
     #     self.reloadTables()
         
     def insertSatelliteTle(self, src: str, name: str, time_retrieved: int, line1: str, line2: str, replace: bool=False):
-        table = self._tables[self._makeSatelliteTableName(src, name)]
+        if self._dedup:
+            self._insertDedup(src, time_retrieved, {name: [(line1, line2)]})
+            return
+
+        # Insert by name directly, so that tables made without reloading are usable immediately
+        tablename = self._makeSatelliteTableName(src, name)
+        stmt = 'insert %s into "%s" values(?,?,?)' % ("or replace" if replace else "", tablename)
 
         try:
-            table.insertOne(time_retrieved, line1, line2, orReplace=replace, commitNow=False) # Explicitly do not commit
+            self.execute(stmt, (time_retrieved, line1, line2)) # Explicitly do not commit
+            self._recordChanges(src, time_retrieved, [(name, line1, line2)])
         except sq.IntegrityError as e:
-            print("Skipping insert for %s because record already exists." % (table._tbl))
+            print("Skipping insert for %s because record already exists." % (tablename))
+        
+    def insertSatelliteTles(self, src: str, name: str, time_retrieved: int, tlelines: list):
+        """
+        Bulk inserts many TLEs for one satellite, silently skipping those that already exist.
+
+        Parameters
+        ----------
+        src : str
+            Source of the TLEs.
+        name : str
+            Satellite name.
+        time_retrieved : int
+            Time retrieved for all the rows.
+        tlelines : list
+            List of (line1, line2) pairs.
+
+        Returns
+        -------
+        int
+            Number of rows actually inserted.
+        """
+        return self._insertSatelliteRows(src, name, time_retrieved, tlelines)
+
+    def _insertSatelliteRows(self, src: str, name: str, time_retrieved: int, tlelines: list):
+        # Shared by insertSatelliteTles() and insertTleGroups(), once the table exists
+        if self._dedup:
+            return self._insertDedup(src, time_retrieved, {name: tlelines})
+
+        tablename = self._makeSatelliteTableName(src, name)
+        if len(tlelines) == 1:
+            # The common case from downloads; the change count says whether it was new
+            before = self.con.total_changes
+            self.cur.execute('insert or ignore into "%s" values(?,?,?)' % (tablename), (time_retrieved,) + tuple(tlelines[0]))
+            new = [(name,) + tuple(tlelines[0])] if self.con.total_changes > before else []
+        else:
+            self.execute('select max(rowid) from "%s"' % (tablename))
+            lastRowid = self.fetchone()[0] or 0
+            self.cur.executemany(
+                'insert or ignore into "%s" values(?,?,?)' % (tablename),
+                ((time_retrieved, line1, line2) for line1, line2 in tlelines)
+            ) # Explicitly do not commit
+            self.execute('select line1, line2 from "%s" where rowid > ? order by rowid' % (tablename), (lastRowid,))
+            new = [(name, line1, line2) for line1, line2 in self.fetchall()]
+
+        self._recordChanges(src, time_retrieved, new)
+        return len(new)
         
     def getSatelliteTle(self, name: str, nearest_time_retrieved: int=None, src: str=None):
         """
@@ -441,30 +1157,409 @@ class TleDatabase(sew.Database):
         if src is not None:
             table = self._makeSatelliteTableName(src, name)
             # No easy way to select directly, so generate the custom statement
-            stmt = 'select * from "%s" order by ABS(? - time_retrieved) limit 1' % (table)
-            self.execute(stmt, (nearest_time_retrieved, ))
+            fromclause, fromparams = self._satelliteTableSelect(table)
+            stmt = 'select * from %s order by ABS(? - time_retrieved) limit 1' % (fromclause)
+            self.execute(stmt, fromparams + (nearest_time_retrieved, ))
             results = self.fetchone()
             
         else:
             # Search all tables that contain the name
-            tables = [i for i in self._tables if name in i]
+            tables = [i for i in self.satelliteTablenames if name in i]
 
             # Pick the one that is closest
             results = []
             for table in tables:
                 # No easy way to select directly, so generate the custom statement
-                stmt = 'select * from "%s" order by ABS(? - time_retrieved) limit 1' % (table)
-                self.execute(stmt, (nearest_time_retrieved, ))
+                fromclause, fromparams = self._satelliteTableSelect(table)
+                stmt = 'select * from %s order by ABS(? - time_retrieved) limit 1' % (fromclause)
+                self.execute(stmt, fromparams + (nearest_time_retrieved, ))
                 results.append(self.cur.fetchone())
                 
             # Compute the ordering
-            ordering = np.abs([i[0]-nearest_time_retrieved for i in results])
-            idx = np.argmin(ordering)
+            ordering = [abs(i[0]-nearest_time_retrieved) for i in results]
+            idx = ordering.index(min(ordering))
             
             # Extract the result
             results = results[idx]
+            table = tables[idx]
    
         return results, table
+
+    def getNearestTles(self, requests: list, chunksize: int=200):
+        """
+        Batched lookup of the TLE retrieved nearest to a time, for many satellite tables at once.
+        Each chunk of requests is a single compound query, rather than one query per table.
+
+        Parameters
+        ----------
+        requests : list
+            List of (tablename, nearest_time_retrieved).
+        chunksize : int, optional
+            Requests per query; SQLite limits the number of compound terms. The default is 200.
+
+        Returns
+        -------
+        dict
+            (tablename, nearest_time_retrieved) to (time_retrieved, line1, line2), for those that have rows.
+        """
+        requests = list(dict.fromkeys(requests)) # Unique, in order
+        results = dict()
+        for i in range(0, len(requests), chunksize):
+            terms = []
+            params = []
+            for j, (tablename, nearest) in enumerate(requests[i:i+chunksize]):
+                fromclause, fromparams = self._satelliteTableSelect(tablename)
+                terms.append(
+                    "select * from (select %d, time_retrieved, line1, line2 from %s order by ABS(? - time_retrieved) limit 1)" % (
+                        i + j, fromclause))
+                params.extend(fromparams + (nearest,))
+            self.execute(" union all ".join(terms), params)
+            for idx, time_retrieved, line1, line2 in self.fetchall():
+                results[requests[idx]] = (time_retrieved, line1, line2)
+
+        return results
+
+    def getLatestTles(self, src: str=None, chunksize: int=200):
+        """
+        Returns the most recently retrieved TLE of every satellite, in one pass over the database.
+
+        Parameters
+        ----------
+        src : str, optional
+            Only return satellites from this source. The default is None, which returns all sources.
+        chunksize : int, optional
+            Tables per query for the legacy layout, see getNearestTles(). The default is 200.
+
+        Returns
+        -------
+        dict
+            Table name i.e. "<src>_<name>" to (time_retrieved, line1, line2).
+        """
+        results = dict()
+        if self._dedup:
+            # A bare-column max() returns the other columns from the row with the maximum
+            stmt = (
+                "select s.src, s.name, max(s.time_retrieved), e.line1, e.line2 "
+                "from %s s join %s e on e.id = s.tle_id%s group by s.src, s.name" % (
+                    self.tle_sources_tblname, self.tle_elements_tblname, " where s.src = ?" if src is not None else "")
+            )
+            self.execute(stmt, (src,) if src is not None else ())
+            for tsrc, name, time_retrieved, line1, line2 in self.fetchall():
+                results[self._makeSatelliteTableName(tsrc, name)] = (time_retrieved, line1, line2)
+            return results
+
+        tablenames = [i for i in self.satelliteTablenames if src is None or i.split("_", 1)[0] == src]
+        for i in range(0, len(tablenames), chunksize):
+            chunk = tablenames[i:i+chunksize]
+            self.execute(" union all ".join(
+                'select %d, max(time_retrieved), line1, line2 from "%s"' % (j, tablename) for j, tablename in enumerate(chunk)
+            ))
+            for j, time_retrieved, line1, line2 in self.fetchall():
+                if time_retrieved is not None: # Empty tables still return a row of NULLs
+                    results[chunk[j]] = (time_retrieved, line1, line2)
+
+        return results
+
+    def getLatestCatalog(self, src: str=None):
+        """
+        Returns the latest TLE of every satellite as a TleCatalog keyed by name, see getLatestTles().
+        Satellites carried by several sources are given once, from the TLE with the latest epoch.
+        """
+        return self._mergeCatalog(self.getLatestTles(src))
+
+    def _mergeCatalog(self, tles: dict):
+        # From table names to (time_retrieved, line1, line2), to one TleCatalog over all sources
+        from tlecatalog import TleCatalog
+        bysrc = dict()
+        for tablename, (time_retrieved, line1, line2) in tles.items():
+            tsrc, name = tablename.split("_", 1)
+            bysrc.setdefault(tsrc, []).append((name, line1, line2))
+        return TleCatalog.mergeSources({tsrc: TleCatalog.fromRecords(records) for tsrc, records in bysrc.items()})
+
+    # TLE epochs as a sortable number, year * 1000 + day of year, computed from line1 in SQL.
+    # Two-digit years from 57 are 19xx, as in the TLE convention
+    _epoch_key_sql = (
+        "((case when cast(substr({0}, 19, 2) as integer) < 57 then 2000 else 1900 end"
+        " + cast(substr({0}, 19, 2) as integer)) * 1000 + cast(substr({0}, 21, 12) as real))"
+    )
+
+    @staticmethod
+    def _epochKey(t: float):
+        # Unix seconds to the same key as _epoch_key_sql
+        if t in (float("inf"), float("-inf")):
+            return t
+        t = dt.datetime.fromtimestamp(t, tz=dt.timezone.utc)
+        start = dt.datetime(t.year, 1, 1, tzinfo=dt.timezone.utc)
+        return t.year * 1000 + (t - start).total_seconds() / 86400.0 + 1.0
+
+    def _asOfOrdering(self, T: float, by: str, trcol: str, line1col: str):
+        # Column to compare against the instant, its value, and the tie-breaker
+        epochcol = self._epoch_key_sql.format(line1col)
+        if by == "time_retrieved":
+            return trcol, T, epochcol
+        elif by == "epoch":
+            return epochcol, self._epochKey(T), trcol
+        raise ValueError("by must be 'time_retrieved' or 'epoch', not %s" % (by))
+
+    def getTlesAsOf(self, T: float, by: str="time_retrieved", src: str=None, chunksize: int=200):
+        """
+        Returns the TLE of every satellite that was current at an instant, in one pass over the database.
+
+        Parameters
+        ----------
+        T : float
+            Instant in Unix seconds.
+        by : str, optional
+            'time_retrieved' gives the latest TLE retrieved at or before T, i.e. what the database
+            held at the time. 'epoch' gives the TLE with the latest epoch at or before T, regardless
+            of when it was retrieved. Ties are broken by the other one. The default is 'time_retrieved'.
+        src : str, optional
+            Only return satellites from this source. The default is None, which returns all sources.
+        chunksize : int, optional
+            Tables per query for the legacy layout, see getNearestTles(). The default is 200.
+
+        Returns
+        -------
+        dict
+            Table name i.e. "<src>_<name>" to (time_retrieved, line1, line2), as for getLatestTles().
+            Satellites with nothing before T are left out.
+        """
+        results = dict()
+        if self._dedup:
+            keycol, key, tiecol = self._asOfOrdering(T, by, "s.time_retrieved", "e.line1")
+            self.execute(
+                "select src, name, time_retrieved, line1, line2 from ("
+                "select s.src, s.name, s.time_retrieved, e.line1, e.line2, "
+                "row_number() over (partition by s.src, s.name order by %s desc, %s desc) as r "
+                "from %s s join %s e on e.id = s.tle_id where %s <= ?%s"
+                ") where r = 1" % (
+                    keycol, tiecol, self.tle_sources_tblname, self.tle_elements_tblname, keycol,
+                    " and s.src = ?" if src is not None else ""),
+                (key, src) if src is not None else (key,)
+            )
+            for tsrc, name, time_retrieved, line1, line2 in self.fetchall():
+                results[self._makeSatelliteTableName(tsrc, name)] = (time_retrieved, line1, line2)
+            return results
+
+        keycol, key, tiecol = self._asOfOrdering(T, by, "time_retrieved", "line1")
+        tablenames = [i for i in self.satelliteTablenames if src is None or i.split("_", 1)[0] == src]
+        for i in range(0, len(tablenames), chunksize):
+            chunk = tablenames[i:i+chunksize]
+            self.execute(" union all ".join(
+                'select * from (select %d, time_retrieved, line1, line2 from "%s" where %s <= ? order by %s desc, %s desc limit 1)' % (
+                    j, tablename, keycol, keycol, tiecol) for j, tablename in enumerate(chunk)
+            ), (key,) * len(chunk))
+            for j, time_retrieved, line1, line2 in self.fetchall():
+                results[chunk[j]] = (time_retrieved, line1, line2)
+
+        return results
+
+    def getCatalogAsOf(self, T: float, by: str="time_retrieved", src: str=None):
+        """
+        Returns the TLE of every satellite that was current at an instant as a TleCatalog keyed by name,
+        see getTlesAsOf(). Satellites carried by several sources are given once, from the TLE with the
+        latest epoch. Use TleCatalog.toText() or TleCatalog.save() to keep it, or exportAsOf() for a
+        database file with the sources kept separate.
+        """
+        return self._mergeCatalog(self.getTlesAsOf(T, by, src))
+
+    def getSatelliteNumber(self, tablename: str):
+        """
+        Returns the NORAD satellite number for a satellite table, or None if it has no rows.
+        """
+        fromclause, fromparams = self._satelliteTableSelect(tablename)
+        self.execute("select line1 from %s limit 1" % (fromclause), fromparams)
+        result = self.fetchone()
+        return self.fromAlpha5(result[0][2:7]) if result is not None else None
+
+    def getSatelliteHistory(self, names, start: float=None, stop: float=None, src: str=None, savez: str=None):
+        """
+        Returns the full element history of one or more satellites as a NumPy structured array.
+        Rows are decoded in a vectorized manner, see tlearrays.py for the fields.
+
+        Parameters
+        ----------
+        names : str or list
+            Satellite name(s) or table name(s).
+        start : float, optional
+            Only rows retrieved after this time are returned.
+        stop : float, optional
+            Only rows retrieved before this time are returned.
+        src : str, optional
+            Source of the satellite TLEs e.g. 'geo'. If not specified, all sources are used,
+            and identical TLEs from different sources are only returned once.
+        savez : str, optional
+            If specified, the array is also saved as a .npz file at this path, with one array per field.
+
+        Returns
+        -------
+        history : np.ndarray
+            Structured array of tlearrays.tle_dtype, sorted by satellite number and then epoch.
+        """
+        import numpy as np
+        import tlearrays
+
+        if isinstance(names, str):
+            names = [names] # Make it into a list for them
+
+        # Find the tables to read from; unlike getSatelliteTle(), the names must match exactly
+        tables = []
+        for table in self.satelliteTablenames:
+            tsrc, tname = table.split("_", 1)
+            if (src is None or tsrc == src) and (tname in names or table in names):
+                tables.append(table)
+
+        # Read the raw lines
+        clause, params = self._makeTimeWindowConditions(start, stop)
+        rows = []
+        for table in tables:
+            fromclause, fromparams = self._satelliteTableSelect(table)
+            self.execute('select time_retrieved, line1, line2 from %s%s' % (fromclause, clause), fromparams + params)
+            rows.extend(self.fetchall())
+        if len(rows) == 0:
+            history = np.zeros(0, dtype=tlearrays.tle_dtype)
+
+        else:
+            time_retrieved, line1, line2 = (np.array(i) for i in zip(*rows))
+            line1 = line1.astype("S69")
+            line2 = line2.astype("S69")
+            # The same TLE may have been retrieved from multiple sources; keep the first retrieval only
+            order = np.argsort(time_retrieved, kind="stable")
+            _, first = np.unique(np.char.add(line1[order], line2[order]), return_index=True)
+            keep = order[first]
+            history = tlearrays.decodeTles(line1[keep], line2[keep], time_retrieved[keep])
+            history = history[np.lexsort((history["epoch"], history["satnumber"]))]
+
+        if savez is not None:
+            tlearrays.saveNpz(savez, history)
+
+        return history
+
+    #%% Exports
+    @staticmethod
+    def _makeTimeWindowConditions(start: float=None, stop: float=None):
+        # Returns the WHERE clause and parameters for a (start, stop) window on time_retrieved
+        conds = []
+        params = []
+        if start is not None:
+            conds.append("time_retrieved > ?")
+            params.append(start)
+        if stop is not None:
+            conds.append("time_retrieved < ?")
+            params.append(stop)
+        clause = " WHERE " + " AND ".join(conds) if len(conds) > 0 else ""
+        return clause, tuple(params)
+
+    def getHighWaterMark(self, tablenames: list):
+        """
+        Returns a number that increases whenever rows are added to any of the satellite tables,
+        since rows are only ever appended. Useful to tell whether an export is out of date.
+        """
+        if self._dedup:
+            # All memberships share one table
+            self.execute("select max(rowid) from %s" % (self.tle_sources_tblname))
+            return self.fetchone()[0] or 0
+
+        mark = 0
+        for tablename in tablenames:
+            if tablename in self._knownTables:
+                self.execute('select max(rowid) from "%s"' % (tablename))
+                mark += self.fetchone()[0] or 0
+        return mark
+
+    def getAsOfMark(self, T: float, by: str="time_retrieved", src: str=None):
+        """
+        Returns a value that changes whenever getTlesAsOf() for these arguments may have changed,
+        from the change feed. Inserts retrieved (or with epochs) after T do not change it, so
+        snapshots of past instants stay valid while the database keeps updating.
+        """
+        if by not in ("time_retrieved", "epoch"):
+            raise ValueError("by must be 'time_retrieved' or 'epoch', not %s" % (by))
+        # The minimum moves when changes are pruned, so marks are never reused
+        self.execute(
+            "select (select min(seq) from {0}), max(seq) from {0} where {1} <= ?{2}".format(
+                self.tle_changes_tblname, by, " and src = ?" if src is not None else ""),
+            (T, src) if src is not None else (T,)
+        )
+        first, last = self.fetchone()
+        return "%d-%d" % (first or 0, last or 0)
+
+    def getMaxTimeRetrieved(self, tablenames: list):
+        """
+        Returns the latest time_retrieved over the satellite tables, or None if they are empty.
+        """
+        latest = None
+        for tablename in tablenames:
+            fromclause, fromparams = self._satelliteTableSelect(tablename)
+            self.execute("select max(time_retrieved) from %s" % (fromclause), fromparams)
+            tr = self.fetchone()[0]
+            if tr is not None and (latest is None or tr > latest):
+                latest = tr
+        return latest
+
+    def exportTables(self, tablenames: list, dbpath: str, start: float=None, stop: float=None):
+        """
+        Copies the rows of the specified satellite tables into a separate database file.
+        The exported database always uses the per-satellite table layout.
+
+        Parameters
+        ----------
+        tablenames : list
+            Satellite table names i.e. "<src>_<name>".
+        dbpath : str
+            File path of the exported database. Tables are created if necessary.
+        start : float, optional
+            Only rows retrieved after this time are exported.
+        stop : float, optional
+            Only rows retrieved before this time are exported.
+        """
+        # Create the tables in the new db
+        exportdb = TleDatabase(dbpath)
+        for tablename in tablenames:
+            exportdb.makeSatelliteTable(None, tablename, reloadNow=False)
+        exportdb.commit()
+        exportdb.close() # We don't need it to be open any more
+
+        # Attach the new db and copy the rows over directly
+        clause, params = self._makeTimeWindowConditions(start, stop)
+        self.execute("ATTACH DATABASE ? AS exportdb", (dbpath,))
+        try:
+            for tablename in tablenames:
+                fromclause, fromparams = self._satelliteTableSelect(tablename)
+                self.execute(
+                    'INSERT OR IGNORE INTO exportdb."%s" SELECT * FROM %s%s' % (tablename, fromclause, clause),
+                    fromparams + params
+                )
+            self.commit()
+        finally:
+            self.execute("DETACH DATABASE exportdb")
+
+        # The rows were copied directly, so the derived state has to be computed there
+        exportdb = TleDatabase(dbpath)
+        exportdb.rebuildSatelliteState()
+        exportdb.close()
+
+    def exportAsOf(self, T: float, dbpath: str, by: str="time_retrieved", src: str=None):
+        """
+        Writes the TLE of every satellite that was current at an instant (see getTlesAsOf()) into
+        a separate database file. The exported database uses the deduplicated layout, so it holds
+        one row per TLE rather than one table per satellite; open it with TleDatabase(dbpath, dedup=True).
+        Returns the number of TLEs written.
+        """
+        tles = self.getTlesAsOf(T, by, src)
+        groups = dict()
+        for tablename, (time_retrieved, line1, line2) in tles.items():
+            tsrc, name = tablename.split("_", 1)
+            groups.setdefault((tsrc, time_retrieved), dict())[name] = [(line1, line2)]
+
+        exportdb = TleDatabase(dbpath, dedup=True)
+        for (tsrc, time_retrieved), group in groups.items():
+            exportdb.insertTleGroups(tsrc, time_retrieved, group)
+        # A snapshot has no history to follow
+        exportdb.execute("delete from %s" % (exportdb.tle_changes_tblname))
+        exportdb.commit()
+        exportdb.close()
+        return len(tles)
         
     
         
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Command-line entry point for the TLE and bulletin databases.
+
+Installed as the 'tledb' script. Only the standard library is imported at startup;
+the database modules (and their dependencies) are imported by the subcommand that needs them,
+so single lookups from cron jobs and shell pipelines stay fast.
+
+Examples
+--------
+tledb update --srcs geo stations --bulletins dailyiau2000
+tledb load archive.txt geo --time 1672800000
+tledb backfill archives/ active --pattern "*.txt.gz"
+tledb query "ISS (ZARYA)"
+tledb export "ISS (ZARYA)" --start 1672800000 --out iss.db
+tledb snapshot 1672790400 --by epoch --out catalog.npz
+tledb stats
+"""
+
+import argparse
+import sys
+import json
+import sqlite3 as sq
+
+#%% Subcommands
+def _openTleDatabase(args):
+    from tledatabase import TleDatabase
+    return TleDatabase(args.db, dedup=args.dedup)
+
+def _selectTables(d, names: list, src: str=None):
+    # Match either full table names or satellite names, optionally restricted to a source
+    tables = []
+    for table in d.satelliteTablenames:
+        tsrc, tname = table.split("_", 1)
+        if src is not None and tsrc != src:
+            continue
+        if len(names) == 0 or table in names or tname in names:
+            tables.append(table)
+    return tables
+
+def update(args):
+    d = _openTleDatabase(args)
+    d.setSrcs(args.srcs)
+    d.update(verbose=args.verbose)
+    d.close()
+
+    if args.bulletins:
+        from bulletindatabase import BulletinDatabase
+        b = BulletinDatabase(args.bulletin_db)
+        b.setSrcs(args.bulletins)
+        b.update()
+        b.close()
+
+def load(args):
+    d = _openTleDatabase(args)
+    d.loadTleFile(args.file, args.src, args.time, verbose=args.verbose)
+    d.close()
+
+def backfill(args):
+    from backfill import Backfill
+    d = _openTleDatabase(args)
+    b = Backfill(d, args.src, workers=args.workers)
+    b.run(args.dir, args.pattern)
+    d.close()
+
+def query(args):
+    d = _openTleDatabase(args)
+    try:
+        result, table = d.getSatelliteTle(args.name, args.time, args.src)
+    except (ValueError, sq.OperationalError):
+        # No matching tables at all, or the specified source table doesn't exist
+        result = None
+    if result is None:
+        print("No TLE found for %s" % args.name, file=sys.stderr)
+        return 1
+
+    time_retrieved, line1, line2 = result[0], result[1], result[2]
+    if args.json:
+        print(json.dumps({
+            "table": table,
+            "time_retrieved": time_retrieved,
+            "line1": line1,
+            "line2": line2
+        }))
+    else:
+        print("%s\n%s\n%s" % (table.split("_", 1)[1], line1, line2))
+    return 0
+
+def export(args):
+    d = _openTleDatabase(args)
+    tables = _selectTables(d, args.names, args.src)
+
+    if args.out is not None:
+        # Export to a separate database, like the bot does
+        d.exportTables(tables, args.out, args.start, args.stop)
+
+    else:
+        # Otherwise write 3LE text to stdout
+        clause, params = d._makeTimeWindowConditions(args.start, args.stop)
+        for table in tables:
+            name = table.split("_", 1)[1]
+            fromclause, fromparams = d._satelliteTableSelect(table)
+            d.execute('SELECT line1, line2 FROM %s%s ORDER BY time_retrieved' % (fromclause, clause), fromparams + params)
+            for line1, line2 in d.fetchall():
+                sys.stdout.write("%s\n%s\n%s\n" % (name, line1, line2))
+
+    d.close()
+
+def snapshot(args):
+    d = _openTleDatabase(args)
+
+    if args.out is None:
+        sys.stdout.write(d.getCatalogAsOf(args.time, args.by, args.src).toText())
+    elif args.out.endswith(".npz"):
+        d.getCatalogAsOf(args.time, args.by, args.src).save(args.out)
+    elif args.out.endswith((".tle", ".txt")):
+        d.getCatalogAsOf(args.time, args.by, args.src).toText(args.out)
+    else:
+        d.exportAsOf(args.time, args.out, args.by, args.src)
+
+    d.close()
+
+def stats(args):
+    d = _openTleDatabase(args)
+    srcs = d.getSatellites(remove_src=False)
+    total = 0
+    for src, names in sorted(srcs.items()):
+        line = "%-12s %6d satellites" % (src, len(names))
+        if args.rows:
+            rows = 0
+            for name in names:
+                fromclause, fromparams = d._satelliteTableSelect(d._makeSatelliteTableName(src, name))
+                d.execute('SELECT COUNT(*) FROM %s' % (fromclause), fromparams)
+                rows += d.fetchone()[0]
+            line += " %9d rows" % (rows)
+        total += len(names)
+        print(line)
+    print("%-12s %6d tables" % ("total", total))
+    d.close()
+
+#%% Argument parsing
+def makeParser():
+    parser = argparse.ArgumentParser(prog="tledb", description="TLE and IERS bulletin database tools.")
+    parser.add_argument("--db", default="tles.db", help="TLE database path. Default is tles.db.")
+    parser.add_argument("--dedup", action="store_true", help="Use the deduplicated TLE storage layout.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    p = subparsers.add_parser("update", help="Download and insert the latest data.")
+    p.add_argument("--srcs", nargs="+", default=["geo"], help="TLE sources to download.")
+    p.add_argument("--bulletins", nargs="*", default=[], help="Bulletin sources to download, if any.")
+    p.add_argument("--bulletin-db", default="bulletins.db", help="Bulletin database path. Default is bulletins.db.")
+    p.add_argument("-v", "--verbose", action="store_true")
+    p.set_defaults(func=update)
+
+    p = subparsers.add_parser("load", help="Insert a local TLE text file.")
+    p.add_argument("file")
+    p.add_argument("src", help="Source to file the TLEs under e.g. geo.")
+    p.add_argument("--time", type=int, default=None, help="Time retrieved to tag the rows with. Default is now.")
+    p.add_argument("-v", "--verbose", action="store_true")
+    p.set_defaults(func=load)
+
+    p = subparsers.add_parser("backfill", help="Insert a directory of (compressed) archive files in parallel.")
+    p.add_argument("dir")
+    p.add_argument("src", help="Source to file the TLEs under e.g. active.")
+    p.add_argument("--pattern", default="*", help="Glob pattern for archive files. Default is *.")
+    p.add_argument("--workers", type=int, default=None, help="Parsing processes. Default is the number of cores.")
+    p.set_defaults(func=backfill)
+
+    p = subparsers.add_parser("query", help="Print the TLE retrieved nearest to a time.")
+    p.add_argument("name", help="Satellite name or table name.")
+    p.add_argument("--time", type=int, default=None, help="Nearest time retrieved. Default is now.")
+    p.add_argument("--src", default=None)
+    p.add_argument("--json", action="store_true", help="Print as JSON instead of 3LE text.")
+    p.set_defaults(func=query)
+
+    p = subparsers.add_parser("export", help="Export satellite tables as 3LE text or a database.")
+    p.add_argument("names", nargs="*", help="Satellite or table names. Default is all.")
+    p.add_argument("--src", default=None)
+    p.add_argument("--start", type=float, default=None)
+    p.add_argument("--stop", type=float, default=None)
+    p.add_argument("--out", default=None, help="Database path to export to. Default writes text to stdout.")
+    p.set_defaults(func=export)
+
+    p = subparsers.add_parser("snapshot", help="Write the TLE of every satellite as of a time.")
+    p.add_argument("time", type=float, help="Unix time of the snapshot.")
+    p.add_argument("--by", choices=["time_retrieved", "epoch"], default="time_retrieved",
+                   help="Latest TLE retrieved by the time, or latest epoch up to it. Default is time_retrieved.")
+    p.add_argument("--src", default=None)
+    p.add_argument("--out", default=None,
+                   help="Output path; .npz for arrays, .tle/.txt for 3LE text, otherwise a database. Default writes text to stdout.")
+    p.set_defaults(func=snapshot)
+
+    p = subparsers.add_parser("stats", help="Summarise the database contents.")
+    p.add_argument("--rows", action="store_true", help="Also count rows (slower).")
+    p.set_defaults(func=stats)
+
+    return parser
+
+def main(argv: list=None):
+    args = makeParser().parse_args(argv)
+    return args.func(args)
+
+#%%
+if __name__ == "__main__":
+    sys.exit(main())
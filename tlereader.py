@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Memory-mapped reader for local TLE text files.
+
+Record boundaries are found directly in the mapped bytes, so large archives are not
+copied into an intermediate string or list of lines. Records can be iterated as
+memoryviews into the mapping, or gathered straight into fixed-width NumPy arrays.
+"""
+
+import os
+import mmap
+
+#%%
+class TleFileReader:
+    """
+    Memory-maps a 2LE/3LE text file.
+
+    Example
+    -------
+    with TleFileReader("archive.txt") as reader:
+        for name, line1, line2 in reader.records():
+            ...
+    """
+    # Widths of the fixed-width arrays returned by toArrays()
+    namewidth = 24
+    linewidth = 69
+
+    _whitespace = b" \t\r\n"
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self._fid = open(filepath, "rb")
+        # mmap cannot map empty files
+        if os.fstat(self._fid.fileno()).st_size > 0:
+            self._mm = mmap.mmap(self._fid.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._mm = b""
+        self._view = memoryview(self._mm)
+
+    def close(self):
+        """
+        Releases the mapping. Any memoryviews from records() must no longer be in use.
+        """
+        self._view.release()
+        if isinstance(self._mm, mmap.mmap):
+            self._mm.close()
+        self._fid.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    #%% Boundaries
+    def spans(self):
+        """
+        Yields (start, stop) byte offsets of every non-empty line, with surrounding whitespace excluded.
+        """
+        mm = self._mm
+        size = len(mm)
+        ws = self._whitespace
+        pos = 0
+        while pos < size:
+            end = mm.find(b"\n", pos)
+            if end < 0:
+                end = size
+            # Strip without copying, by moving the offsets
+            start, stop = pos, end
+            while start < stop and mm[start] in ws:
+                start += 1
+            while stop > start and mm[stop - 1] in ws:
+                stop -= 1
+            if stop > start:
+                yield start, stop
+            pos = end + 1
+
+    def recordSpans(self):
+        """
+        Yields ((namestart, namestop), (start1, stop1), (start2, stop2)) for every record.
+        The name span is None for 2-line data; the rules match TleDatabase.parseTleRecords().
+        """
+        mm = self._mm
+        name = None
+        line1 = None
+        for start, stop in self.spans():
+            # Element lines are long, whereas names are at most 24 characters
+            iselement = stop - start > 60 and mm[start + 1] == 0x20
+            if iselement and mm[start] == 0x31: # '1'
+                line1 = (start, stop)
+            elif iselement and mm[start] == 0x32 and line1 is not None: # '2'
+                yield name, line1, (start, stop)
+                name = None
+                line1 = None
+            else:
+                name = (start, stop)
+                line1 = None
+
+    #%% Outputs
+    def records(self):
+        """
+        Yields (name, line1, line2) as memoryviews into the mapping (name is None for 2-line data).
+        The views must be released (or deleted) before the reader is closed.
+        """
+        view = self._view
+        for name, line1, line2 in self.recordSpans():
+            yield (
+                view[name[0]:name[1]] if name is not None else None,
+                view[line1[0]:line1[1]],
+                view[line2[0]:line2[1]]
+            )
+
+    def toDict(self):
+        """
+        Returns a dictionary of names to [line1, line2], in the same format as TleDatabase.parseTleData().
+        2-line data is keyed by the satellite number.
+        """
+        mm = self._mm
+        tles = dict()
+        for name, line1, line2 in self.recordSpans():
+            l1 = mm[line1[0]:line1[1]].decode()
+            key = mm[name[0]:name[1]].decode() if name is not None else l1[2:7].strip()
+            tles[key] = [l1, mm[line2[0]:line2[1]].decode()]
+        return tles
+
+    def groupRecords(self):
+        """
+        Returns a dictionary of names to lists of every (line1, line2) for that name,
+        as for historical archives with repeated satellites. 2-line data is keyed by the satellite number.
+        """
+        mm = self._mm
+        tles = dict()
+        for name, line1, line2 in self.recordSpans():
+            l1 = mm[line1[0]:line1[1]].decode()
+            key = mm[name[0]:name[1]].decode() if name is not None else l1[2:7].strip()
+            tles.setdefault(key, []).append((l1, mm[line2[0]:line2[1]].decode()))
+        return tles
+
+    def toArrays(self):
+        """
+        Gathers all records straight from the mapping into fixed-width byte arrays.
+
+        Returns
+        -------
+        names : np.ndarray
+            'S24' array of names (empty for 2-line data).
+        line1 : np.ndarray
+            'S69' array of first lines.
+        line2 : np.ndarray
+            'S69' array of second lines.
+        """
+        import numpy as np
+        spans = list(self.recordSpans())
+        buf = np.frombuffer(self._mm, dtype=np.uint8) if len(self._mm) > 0 else np.zeros(0, np.uint8)
+
+        namespans = np.array([i[0] if i[0] is not None else (0, 0) for i in spans], dtype=np.int64).reshape(-1, 2)
+        line1spans = np.array([i[1] for i in spans], dtype=np.int64).reshape(-1, 2)
+        line2spans = np.array([i[2] for i in spans], dtype=np.int64).reshape(-1, 2)
+
+        return (
+            self._gather(buf, namespans, self.namewidth),
+            self._gather(buf, line1spans, self.linewidth),
+            self._gather(buf, line2spans, self.linewidth)
+        )
+
+    @staticmethod
+    def _gather(buf, spans, width: int):
+        # Fancy-index every span at once into an (N, width) block, zero-padding short spans
+        import numpy as np
+        offsets = np.arange(width)
+        idx = spans[:, :1] + offsets
+        valid = offsets < (spans[:, 1:] - spans[:, :1])
+        out = np.zeros((len(spans), width), dtype=np.uint8)
+        if len(buf) > 0:
+            out[valid] = buf[idx[valid]]
+        return out.view("S%d" % width).reshape(-1)
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Adaptive polling intervals for the download sources.
+
+Each source's downloaded content is hashed; sources whose content keeps changing are polled
+more often, and those that rarely change are backed off, within configured bounds.
+The state is kept in a JSON file so that intervals survive restarts.
+"""
+
+import os
+import json
+import time
+import random
+from hashlib import blake2s
+
+#%%
+class AdaptiveSchedule:
+    """
+    Tracks how often each source's content changes and suggests when to poll it next.
+
+    Example
+    -------
+    schedule = AdaptiveSchedule("schedule.json")
+    changed = schedule.observe("tle:starlink", text)
+    delay = schedule.nextDelay("tle:starlink")
+    """
+    def __init__(
+        self,
+        statepath: str=None,
+        minInterval: float=600.0,
+        maxInterval: float=86400.0,
+        initialInterval: float=7200.0,
+        speedup: float=0.5,
+        slowdown: float=1.5,
+        jitter: float=0.1
+    ):
+        """
+        Parameters
+        ----------
+        statepath : str, optional
+            JSON file to persist the state in. The default is None, which does not persist anything.
+        minInterval : float, optional
+            Shortest polling interval in seconds. The default is 600.
+        maxInterval : float, optional
+            Longest polling interval in seconds. The default is 86400.
+        initialInterval : float, optional
+            Polling interval for sources that have not been seen before. The default is 7200.
+        speedup : float, optional
+            Factor applied to the interval when the content changed. The default is 0.5.
+        slowdown : float, optional
+            Factor applied to the interval when the content did not change. The default is 1.5.
+        jitter : float, optional
+            Fractional random spread applied to each delay, so that sources do not poll in bursts.
+            The default is 0.1.
+        """
+        self.statepath = statepath
+        self.minInterval = minInterval
+        self.maxInterval = maxInterval
+        self.initialInterval = initialInterval
+        self.speedup = speedup
+        self.slowdown = slowdown
+        self.jitter = jitter
+
+        self.state = dict()
+        self.load()
+
+    #%% Persistence
+    def load(self):
+        """
+        Loads the state from the JSON file, if it exists.
+        """
+        if self.statepath is not None and os.path.exists(self.statepath):
+            with open(self.statepath, "r") as fid:
+                self.state = json.load(fid)
+
+    def save(self):
+        """
+        Saves the state to the JSON file, replacing it atomically.
+        """
+        if self.statepath is None:
+            return
+        tmppath = self.statepath + ".tmp"
+        with open(tmppath, "w") as fid:
+            json.dump(self.state, fid, indent=2)
+        os.replace(tmppath, self.statepath)
+
+    #%% Tracking
+    def _getEntry(self, key: str):
+        if key not in self.state:
+            self.state[key] = {
+                "interval": min(max(self.initialInterval, self.minInterval), self.maxInterval),
+                "hash": None,
+                "lastChecked": None,
+                "lastChanged": None,
+                "checks": 0,
+                "changes": 0
+            }
+        return self.state[key]
+
+    def interval(self, key: str):
+        """
+        Returns the current polling interval of a source in seconds.
+        """
+        return self._getEntry(key)["interval"]
+
+    def observe(self, key: str, content: str, now: float=None):
+        """
+        Records a download of a source and adapts its interval.
+
+        Returns
+        -------
+        changed : bool
+            True if the content differs from the last download (or there was none).
+        """
+        now = time.time() if now is None else now
+        entry = self._getEntry(key)
+
+        digest = blake2s(content.encode("utf-8"), digest_size=16).hexdigest()
+        changed = digest != entry["hash"]
+
+        # The first download is always a change, but says nothing about the rate
+        if entry["hash"] is not None:
+            factor = self.speedup if changed else self.slowdown
+            entry["interval"] = min(max(entry["interval"] * factor, self.minInterval), self.maxInterval)
+
+        entry["hash"] = digest
+        entry["lastChecked"] = now
+        entry["checks"] += 1
+        if changed:
+            entry["lastChanged"] = now
+            entry["changes"] += 1
+        self.save()
+
+        return changed
+
+    def nextDelay(self, key: str, now: float=None):
+        """
+        Returns the number of seconds until a source should next be polled, with jitter.
+        Sources that are overdue (e.g. after a restart) get a short random delay within the minimum interval.
+        """
+        now = time.time() if now is None else now
+        entry = self._getEntry(key)
+        spread = random.uniform(-self.jitter, self.jitter)
+
+        if entry["lastChecked"] is None:
+            return random.uniform(1.0, max(self.minInterval * self.jitter, 1.0))
+
+        remaining = entry["lastChecked"] + entry["interval"] * (1.0 + spread) - now
+        if remaining <= 0:
+            return random.uniform(1.0, max(self.minInterval * self.jitter, 1.0))
+        return remaining